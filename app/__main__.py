@@ -14,6 +14,14 @@ import moderngl
 
 def main(argv: Optional[List[str]] = None) -> None:
     """Entrypoint when running moderngl module."""
+    # python -m app render ... でカメラの経路をまとめてレンダリングする（app/batch.py）
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ['render']:
+        from app.batch import main as render_main
+        render_main(argv[1:])
+        return
+
     version = 'moderngl %s' % moderngl.__version__
 
     if os.path.isfile(os.path.join(os.path.dirname(__file__), 'README.md')):
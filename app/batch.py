@@ -0,0 +1,226 @@
+import argparse
+import csv
+import json
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from app import cpu
+from app.render import Context
+
+# カメラの経路の各姿勢が持つパラメータ（省略した場合は 0）
+CAMERA_PARAMETERS = ("theta", "phi", "move_x", "move_y")
+FORMAT_LIST = ["jpg", "png", "webp", "hdr"]
+
+
+def interpolate_keyframes(keyframe_list, frame_count=None):
+    # "frame" を持つキーフレームの間を線形補間し，フレームごとの姿勢を返す
+    keyframe_list = sorted(keyframe_list, key=lambda keyframe: keyframe["frame"])
+    if frame_count is None:
+        frame_count = keyframe_list[-1]["frame"] + 1
+    frame_array = [keyframe["frame"] for keyframe in keyframe_list]
+    return [
+        {
+            name: float(
+                np.interp(
+                    frame,
+                    frame_array,
+                    [keyframe.get(name, 0) for keyframe in keyframe_list],
+                )
+            )
+            for name in CAMERA_PARAMETERS
+        }
+        for frame in range(frame_count)
+    ]
+
+
+def turntable(frames, theta=(0, 2 * math.pi), phi=0, move_x=0, move_y=0):
+    # theta を frames 等分して一周する（終点は含まない）
+    return [
+        {
+            "theta": theta[0] + (theta[1] - theta[0]) * frame / frames,
+            "phi": phi,
+            "move_x": move_x,
+            "move_y": move_y,
+        }
+        for frame in range(frames)
+    ]
+
+
+def load_camera_path(path):
+    # カメラの姿勢のリストを読み込む
+    # - CSV: 1行が1つの姿勢（列は theta, phi, move_x, move_y, name）
+    # - JSON: 姿勢のリスト，{"turntable": {...}} または {"keyframes": [...], "frames": N}
+    if path.endswith(".csv"):
+        with open(path, encoding="utf-8", newline="") as f:
+            pose_list = list(csv.DictReader(f))
+    else:
+        with open(path, encoding="utf-8") as f:
+            camera_path = json.load(f)
+        if isinstance(camera_path, list):
+            pose_list = camera_path
+        elif "turntable" in camera_path:
+            pose_list = turntable(**camera_path["turntable"])
+        elif "keyframes" in camera_path:
+            pose_list = interpolate_keyframes(
+                camera_path["keyframes"], camera_path.get("frames")
+            )
+        else:
+            raise ValueError(f"unknown camera path: {path}")
+
+    result = []
+    for index, pose in enumerate(pose_list):
+        camera = {name: float(pose.get(name) or 0) for name in CAMERA_PARAMETERS}
+        camera["name"] = pose.get("name") or f"{index:04d}"
+        result.append(camera)
+    return result
+
+
+def create_context(config):
+    ctx = Context(
+        width=config["width"],
+        height=config["height"],
+        sample_per_frame=config["sample_per_frame"],
+    )
+    ctx.bind_data(env_map_path=config["env_map"], scene_path=config["scene"])
+    ctx.create_program()
+    ctx.use_preset(config["preset"])
+    return ctx
+
+
+def render_frames_cpu(config, pose_list):
+    # GL コンテキストを使わず，NumPy で姿勢を順にレンダリングする（app/cpu.py）
+    scene = cpu.load_scene(config["scene"])
+    env_map = cpu.load_env_map(config["env_map"])
+    preset = Context.PRESET_DICT[config["preset"]]
+    for pose in pose_list:
+        camera = {name: pose[name] for name in CAMERA_PARAMETERS}
+        start = time.perf_counter()
+        spp = 0
+        radiance = 0
+        while True:
+            sample_max = config["sample_per_frame"]
+            if config["spp"]:
+                sample_max = min(sample_max, config["spp"] - spp)
+            radiance = radiance + sample_max * cpu.render(
+                scene,
+                env_map,
+                config["width"],
+                config["height"],
+                sample_max,
+                camera,
+                sample_offset=spp,
+                **preset,
+            )
+            spp += sample_max
+            if config["spp"] and spp >= config["spp"]:
+                break
+            if config["time_budget"] and (
+                time.perf_counter() - start >= config["time_budget"]
+            ):
+                break
+        radiance /= spp
+
+        path = os.path.join(config["output"], f"{pose['name']}.{config['format']}")
+        if config["format"] == "hdr":
+            buffer = cv2.cvtColor(np.flipud(radiance).astype("f4"), cv2.COLOR_RGB2BGR)
+        else:
+            buffer = cpu.tone_map(radiance)
+        if not cv2.imwrite(path, buffer):
+            raise RuntimeError(f"failed to write image: {pose['name']}")
+        print(f"{path}: {spp} spp, {time.perf_counter() - start:.2f} s", flush=True)
+    return len(pose_list)
+
+
+def render_frames(config, pose_list):
+    # 1つのコンテキストで姿勢を順にレンダリングする
+    # 画像の書き出しはスレッドプールで行い，その間に次の姿勢のレンダリングを進める
+    if config["cpu"]:
+        return render_frames_cpu(config, pose_list)
+    ctx = create_context(config)
+    executor = ThreadPoolExecutor(max_workers=1)
+    future_list = []
+    for pose in pose_list:
+        for name in CAMERA_PARAMETERS:
+            setattr(ctx, name, pose[name])
+
+        # 目標のサンプル数に達するか，時間の予算を使い切るまでサンプリングする（最低 1 回）
+        start = time.perf_counter()
+        spp = 0
+        while True:
+            sample_max = ctx.sample_per_frame
+            if config["spp"]:
+                sample_max = min(sample_max, config["spp"] - spp)
+            ctx.current_sample = spp + 1
+            spp += ctx.render(sample_max)
+            if config["spp"] and spp >= config["spp"]:
+                break
+            if config["time_budget"] and (
+                time.perf_counter() - start >= config["time_budget"]
+            ):
+                break
+
+        path = os.path.join(config["output"], f"{pose['name']}.{config['format']}")
+        if config["format"] == "hdr":
+            # トーンマッピング前の放射輝度をそのまま書き出す
+            buffer = cv2.cvtColor(
+                np.flipud(ctx.read_accumulation()[0]), cv2.COLOR_RGBA2BGR
+            )
+        else:
+            buffer = ctx.get_buffer()
+        future_list.append(executor.submit(cv2.imwrite, path, buffer))
+        print(f"{path}: {spp} spp, {time.perf_counter() - start:.2f} s", flush=True)
+
+    executor.shutdown()
+    for future, pose in zip(future_list, pose_list):
+        if not future.result():
+            raise RuntimeError(f"failed to write image: {pose['name']}")
+    return len(pose_list)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app render")
+    parser.add_argument("camera_path", help="JSON or CSV file of camera poses")
+    parser.add_argument("-o", "--output", default="output")
+    parser.add_argument("--format", choices=FORMAT_LIST, default="png")
+    parser.add_argument("--width", type=int, default=960)
+    parser.add_argument("--height", type=int, default=540)
+    parser.add_argument("--spp", type=int, default=0, help="samples per pixel")
+    parser.add_argument(
+        "--time-budget", type=float, default=0, help="seconds per frame"
+    )
+    parser.add_argument("--sample-per-frame", type=int, default=16)
+    parser.add_argument("--env-map", default="assets/hdr/museum_of_ethnography_1k.hdr")
+    parser.add_argument("--scene", default="assets/scene/default.json")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--preset", choices=list(Context.PRESET_DICT), default="final")
+    parser.add_argument(
+        "--cpu", action="store_true", help="render with NumPy instead of OpenGL"
+    )
+    args = parser.parse_args(argv)
+    if not args.spp and not args.time_budget:
+        parser.error("either --spp or --time-budget is required")
+
+    config = vars(args)
+    pose_list = load_camera_path(args.camera_path)
+    os.makedirs(args.output, exist_ok=True)
+
+    if args.processes <= 1:
+        render_frames(config, pose_list)
+        return
+
+    # 姿勢を順に振り分け，それぞれ GL コンテキストを持つ子プロセスでレンダリングする
+    mp_context = multiprocessing.get_context("spawn")
+    with mp_context.Pool(args.processes) as pool:
+        pool.starmap(
+            render_frames,
+            [
+                (config, pose_list[i :: args.processes])
+                for i in range(min(args.processes, len(pose_list)))
+            ],
+        )
@@ -0,0 +1,366 @@
+import json
+import multiprocessing
+
+import cv2
+import numpy as np
+
+# GL を使わずに NumPy でパストレーシングする（GL コンテキストを作れない環境での代替と，テストの参照解）
+# カメラ，球のシーン，材質，環境マップの参照は fragment_shader_path_trace.glsl と同じ
+# 光線はまとめて配列として追跡し，反射ごとに終了した光線を取り除く
+# 光源の直接サンプリング (next event estimation) は行わないが，期待値は GPU と一致する
+
+MATERIAL_LIST = ["background", "diffuse", "mirror", "glass"]
+DELTA = 0.01
+EYE = np.array([0.0, 0.0, 18.0])
+# 最初の光線とそれ以降の光線が交差を探す距離の上限（シェーダーの hit.t の初期値）
+T_MAX_FIRST = 1000.0
+T_MAX = 10000.0
+# 屈折率（ガラスの内側）
+REFRACTIVE_INDEX = 1.5
+# 交差判定で一度に扱う (光線 x 球) の数の上限
+INTERSECTION_BUDGET = 1 << 22
+
+# 子プロセスで共有するシーンと環境マップ（Pool の initializer で設定する）
+shared_dict = {}
+
+
+def load_scene(path):
+    # シーン（球のリスト）を (中心, 半径, 散乱成分, 放出成分, 材質) の配列の辞書として読み込む
+    with open(path, encoding="utf-8") as f:
+        sphere_list = json.load(f)["spheres"]
+    if not sphere_list:
+        raise ValueError("scene has no primitives")
+    return {
+        "center": np.array([sphere["center"] for sphere in sphere_list], dtype="f8"),
+        "radius": np.array([sphere["radius"] for sphere in sphere_list], dtype="f8"),
+        "scatter": np.array([sphere["scatter"] for sphere in sphere_list], dtype="f8"),
+        "emission": np.array(
+            [sphere["emission"] for sphere in sphere_list], dtype="f8"
+        ),
+        "material": np.array(
+            [MATERIAL_LIST.index(sphere["material"]) for sphere in sphere_list]
+        ),
+    }
+
+
+def load_env_map(path):
+    # 環境マップを RGB の配列として読み込む（1行目が真上）
+    env_map = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if env_map is None:
+        raise ValueError(f"failed to read environment map: {path}")
+    return cv2.cvtColor(env_map, cv2.COLOR_BGR2RGB).astype("f4")
+
+
+def camera_matrix(theta, phi):
+    # シェーダーの M1 * M2（GLSL の mat3 は列優先のため転置する）
+    m1 = np.array(
+        [
+            [np.cos(theta), 0, np.sin(theta)],
+            [0, 1, 0],
+            [-np.sin(theta), 0, np.cos(theta)],
+        ]
+    ).T
+    m2 = np.array(
+        [
+            [1, 0, 0],
+            [0, np.cos(phi), -np.sin(phi)],
+            [0, np.sin(phi), np.cos(phi)],
+        ]
+    ).T
+    return m1 @ m2
+
+
+def camera_rays(width, height, x, y, camera, rng):
+    # 画素 (x, y)（y は下の行から）を通る光線の始点と方向（画素内の位置は一様乱数）
+    matrix = camera_matrix(camera["theta"], camera["phi"])
+    position_screen = np.stack(
+        [
+            (x + rng.random(len(x))) / width * 16 - 8,
+            (y + rng.random(len(y))) / height * 9 - 4.5,
+            np.full(len(x), EYE[2] - 9),
+        ],
+        axis=1,
+    )
+    direction = position_screen - EYE
+    direction /= np.linalg.norm(direction, axis=1, keepdims=True)
+    origin = matrix @ (EYE + [camera["move_x"], camera["move_y"], 0])
+    return np.broadcast_to(origin, direction.shape).copy(), direction @ matrix.T
+
+
+def intersect(scene, origin, direction, t_max):
+    # 光線ごとに最も近い球との交点までの距離と球の番号（交わらない場合は t_max と -1）
+    # (光線 x 球) の配列が INTERSECTION_BUDGET を超えないよう，球をまとめて分割する
+    t_min = np.full(len(origin), t_max)
+    index_min = np.full(len(origin), -1)
+    step = max(1, INTERSECTION_BUDGET // max(len(origin), 1))
+    for start in range(0, len(scene["radius"]), step):
+        center = scene["center"][start : start + step]
+        radius = scene["radius"][start : start + step]
+        b = np.sum(origin * direction, axis=1)[:, np.newaxis] - direction @ center.T
+        c = (
+            np.sum(origin**2, axis=1)[:, np.newaxis]
+            - 2 * origin @ center.T
+            + np.sum(center**2, axis=1)
+            - radius**2
+        )
+        d = b**2 - c
+        with np.errstate(invalid="ignore", divide="ignore"):
+            t1 = np.abs(b) + np.sqrt(d)
+            t1 = np.where(b < 0, t1, -t1)
+            t2 = c / t1
+            near = np.minimum(t1, t2)
+            far = np.maximum(t1, t2)
+            t = np.where(near > 0, near, far)
+            t = np.where((d > 0) & (t > 0), t, np.inf)
+        index = np.argmin(t, axis=1)
+        t = t[np.arange(len(t)), index]
+        closer = t < t_min
+        t_min[closer] = t[closer]
+        index_min[closer] = index[closer] + start
+    return t_min, index_min
+
+
+def sample_env_map(env_map, direction):
+    # 正距円筒図法の環境マップを双線形補間で参照する（テクスチャの既定の REPEAT と同じく端は繰り返す）
+    height, width = env_map.shape[:2]
+    u = -np.arctan2(direction[:, 0], direction[:, 2]) / (2 * np.pi)
+    v = np.arccos(np.clip(direction[:, 1], -1, 1)) / np.pi
+    fx = u * width - 0.5
+    fy = v * height - 0.5
+    x0 = np.floor(fx).astype(np.int64)
+    y0 = np.floor(fy).astype(np.int64)
+    wx = (fx - x0)[:, np.newaxis]
+    wy = (fy - y0)[:, np.newaxis]
+    x0, x1 = x0 % width, (x0 + 1) % width
+    y0, y1 = y0 % height, (y0 + 1) % height
+    return (
+        env_map[y0, x0] * (1 - wx) * (1 - wy)
+        + env_map[y0, x1] * wx * (1 - wy)
+        + env_map[y1, x0] * (1 - wx) * wy
+        + env_map[y1, x1] * wx * wy
+    )
+
+
+def sample_cosine(normal, rng):
+    # 法線の周りで余弦に比例する方向を選ぶ
+    u = rng.random(len(normal))
+    angle = rng.random(len(normal)) * 2 * np.pi
+    z = np.sqrt(u)[:, np.newaxis]
+    r = np.sqrt(1 - u)[:, np.newaxis]
+    helper = np.where(np.abs(normal[:, :1]) > 0.9, [[0.0, 1.0, 0.0]], [[1.0, 0.0, 0.0]])
+    tangent = np.cross(helper, normal)
+    tangent /= np.linalg.norm(tangent, axis=1, keepdims=True)
+    bitangent = np.cross(normal, tangent)
+    return (
+        tangent * r * np.cos(angle)[:, np.newaxis]
+        + bitangent * r * np.sin(angle)[:, np.newaxis]
+        + normal * z
+    )
+
+
+def trace(scene, env_map, origin, direction, depth_max, roulette_depth, rng):
+    # 光線ごとの放射輝度（シェーダーの main のループと同じ順で散乱成分と放出成分を更新する）
+    ray_count = len(origin)
+    color = np.zeros((ray_count, 3))
+    scatter = np.ones((ray_count, 3))
+    depth = np.zeros(ray_count, dtype=np.int64)
+    pixel = np.arange(ray_count)
+    t_max = T_MAX_FIRST
+
+    while len(pixel):
+        t, index = intersect(scene, origin, direction, t_max)
+        emission = np.zeros((len(pixel), 3))
+
+        # 背景（環境マップ）
+        background = index < 0
+        emission[background] = sample_env_map(env_map, direction[background])
+        depth[background] = depth_max
+
+        hit = ~background
+        sphere = index[hit]
+        position = origin[hit] + t[hit, np.newaxis] * direction[hit]
+        normal = position - scene["center"][sphere]
+        normal /= np.linalg.norm(normal, axis=1, keepdims=True)
+        material = scene["material"][sphere]
+        albedo = scene["scatter"][sphere]
+        emission[hit] = scene["emission"][sphere]
+        incoming = direction[hit]
+        cos_incoming = -np.sum(incoming * normal, axis=1)
+        new_origin = origin[hit]
+        new_direction = incoming.copy()
+        new_scatter = scatter[hit]
+        new_depth = depth[hit]
+
+        # ガラス面：フレネル反射の確率または全反射の場合は鏡面として扱い，それ以外は屈折する
+        glass = material == MATERIAL_LIST.index("glass")
+        new_depth[glass] += 1
+        inside = cos_incoming <= 0
+        eta = np.where(inside, REFRACTIVE_INDEX, 1 / REFRACTIVE_INDEX)
+        facing = np.where(inside[:, np.newaxis], -normal, normal)
+        cos_theta = np.abs(cos_incoming)
+        f0 = ((eta - 1) / (eta + 1)) ** 2
+        fresnel = f0 + (1 - f0) * (1 - cos_theta) ** 5
+        sin_theta = np.linalg.norm(np.cross(facing, -incoming), axis=1)
+        reflect = (rng.random(len(sphere)) < fresnel) | (eta * sin_theta > 1)
+        refract = glass & ~reflect
+        k = np.maximum(1 - eta**2 * (1 - cos_incoming**2), 0)
+        refracted = (
+            eta[:, np.newaxis] * incoming
+            + facing * (eta * cos_theta - np.sqrt(k))[:, np.newaxis]
+        )
+        refracted /= np.linalg.norm(refracted, axis=1, keepdims=True)
+        new_origin[refract] = position[refract] - facing[refract] * DELTA
+        new_direction[refract] = refracted[refract]
+        new_scatter[refract] *= albedo[refract]
+
+        # 鏡面（裏側から当たった場合は打ち切る）
+        mirror = (material == MATERIAL_LIST.index("mirror")) | (glass & reflect)
+        mirror_back = mirror & (cos_incoming < 0)
+        mirror_front = mirror & ~mirror_back
+        new_depth[mirror_back] = depth_max
+        new_depth[mirror_front] += 1
+        new_origin[mirror_front] = position[mirror_front] + normal[mirror_front] * DELTA
+        new_direction[mirror_front] = (
+            incoming[mirror_front]
+            + 2 * cos_incoming[mirror_front, np.newaxis] * normal[mirror_front]
+        )
+        new_scatter[mirror_front] *= albedo[mirror_front]
+
+        # 完全拡散反射面（裏側から当たった場合は打ち切る）
+        diffuse = material == MATERIAL_LIST.index("diffuse")
+        diffuse_back = diffuse & (cos_incoming < 0)
+        diffuse_front = diffuse & ~diffuse_back
+        new_depth[diffuse_back] = depth_max
+        new_scatter[diffuse_back] = 0
+        new_depth[diffuse_front] += 1
+        new_origin[diffuse_front] = (
+            position[diffuse_front] + normal[diffuse_front] * DELTA
+        )
+        new_direction[diffuse_front] = sample_cosine(normal[diffuse_front], rng)
+        new_scatter[diffuse_front] *= albedo[diffuse_front]
+
+        origin[hit] = new_origin
+        direction[hit] = new_direction
+        scatter[hit] = new_scatter
+        depth[hit] = new_depth
+
+        color[pixel] += emission * scatter
+
+        # ロシアンルーレット
+        roulette = (depth >= roulette_depth) & (depth < depth_max)
+        survival = np.clip(scatter.max(axis=1), 0.05, 1)
+        terminate = roulette & (rng.random(len(pixel)) >= survival)
+        depth[terminate] = depth_max
+        survive = roulette & ~terminate
+        scatter[survive] /= survival[survive, np.newaxis]
+
+        alive = depth < depth_max
+        origin, direction, scatter, depth, pixel = (
+            origin[alive],
+            direction[alive],
+            scatter[alive],
+            depth[alive],
+            pixel[alive],
+        )
+        t_max = T_MAX
+    return color
+
+
+def render_rows(
+    width,
+    height,
+    row_start,
+    row_end,
+    sample_count,
+    camera,
+    depth_max,
+    roulette_depth,
+    seed,
+    sample_offset,
+):
+    # row_start から row_end までの行（下の行から）の放射輝度の和
+    # 乱数は (seed, 行の範囲, サンプルの番号) から生成するため，プロセス数によらず同じ結果となる
+    scene, env_map = shared_dict["scene"], shared_dict["env_map"]
+    y, x = np.mgrid[row_start:row_end, 0:width]
+    x, y = x.ravel(), y.ravel()
+    radiance = np.zeros((len(x), 3))
+    for sample in range(sample_offset, sample_offset + sample_count):
+        rng = np.random.default_rng([seed, row_start, sample])
+        origin, direction = camera_rays(width, height, x, y, camera, rng)
+        radiance += trace(
+            scene, env_map, origin, direction, depth_max, roulette_depth, rng
+        )
+    return radiance.reshape(row_end - row_start, width, 3)
+
+
+def initialize(scene, env_map):
+    shared_dict["scene"] = scene
+    shared_dict["env_map"] = env_map
+
+
+def render(
+    scene,
+    env_map,
+    width,
+    height,
+    sample_count,
+    camera=None,
+    depth_max=16,
+    roulette_depth=4,
+    seed=0,
+    sample_offset=0,
+    processes=1,
+    chunk_size=1 << 14,
+):
+    # sample_count サンプルの平均の放射輝度 (高さ, 幅, 3) を返す（上下は Context.read_accumulation と同じく下の行から）
+    # 画像を chunk_size 画素程度の行の範囲に分け，processes が 2 以上の場合は子プロセスに分配する
+    # sample_offset を変えて呼び出すと，続きの独立したサンプルが得られる
+    camera = {"theta": 0, "phi": 0, "move_x": 0, "move_y": 0, **(camera or {})}
+    row_step = max(1, chunk_size // width)
+    args_list = [
+        (
+            width,
+            height,
+            row_start,
+            min(row_start + row_step, height),
+            sample_count,
+            camera,
+            depth_max,
+            roulette_depth,
+            seed,
+            sample_offset,
+        )
+        for row_start in range(0, height, row_step)
+    ]
+    if processes <= 1:
+        initialize(scene, env_map)
+        result_list = [render_rows(*args) for args in args_list]
+    else:
+        mp_context = multiprocessing.get_context("spawn")
+        with mp_context.Pool(
+            processes, initializer=initialize, initargs=(scene, env_map)
+        ) as pool:
+            result_list = pool.starmap(render_rows, args_list)
+    return np.concatenate(result_list) / sample_count
+
+
+def tone_map(radiance, key_value=0.18, gamma=2.2):
+    # fragment_shader_post_process.glsl と同じトーンマッピングとガンマ補正を行い，
+    # 上下を反転した 8 bit の BGR 画像（Context.get_buffer と同じ形式）を返す
+    # 輝度の対数平均値と最大値は Context.reduce_luminance_numpy と同じく画像全体から求める
+    luminance = (
+        0.27 * radiance[:, :, 0] + 0.67 * radiance[:, :, 1] + 0.06 * radiance[:, :, 2]
+    )
+    luminance_average = np.exp(np.mean(np.log(np.finfo(np.float32).tiny + luminance)))
+    luminance_max = radiance.max()
+    luminance_fixed = key_value * luminance / luminance_average
+    luminance_max_fixed = key_value * luminance_max / luminance_average
+    luminance_mapped = (
+        luminance_fixed
+        * (1 + luminance_fixed / luminance_max_fixed**2)
+        / (1 + luminance_fixed)
+    )
+    with np.errstate(invalid="ignore", divide="ignore"):
+        color = radiance * (luminance_mapped / luminance)[:, :, np.newaxis]
+    color = np.clip(np.nan_to_num(color), 0, 1) ** (1 / gamma)
+    return np.flipud(np.rint(color[:, :, ::-1] * 255)).astype(np.uint8)
@@ -0,0 +1,155 @@
+import itertools
+import multiprocessing
+import os
+
+import numpy as np
+
+
+class RenderFarm:
+    # サンプル数を複数のレンダリングプロセスに分配し，結果を合成する
+    # GPU の無いノードでは Mesa の llvmpipe で描画するが，1つのコンテキストでは全コアを使い切れない
+    # そこで，それぞれ GL コンテキストを持つ子プロセスに異なるシード画像でサンプリングさせる
+    def __init__(self, context_factory, worker_count, threads_per_worker=None):
+        mp_context = multiprocessing.get_context("spawn")
+        self.request_queue_list = [mp_context.Queue() for _ in range(worker_count)]
+        self.result_queue = mp_context.Queue()
+        self.process_list = [
+            mp_context.Process(
+                target=RenderFarm.run,
+                args=(
+                    context_factory,
+                    index,
+                    threads_per_worker,
+                    request_queue,
+                    self.result_queue,
+                ),
+                daemon=True,
+            )
+            for index, request_queue in enumerate(self.request_queue_list)
+        ]
+
+    def __getstate__(self):
+        # RenderWorker の子プロセスに渡せるよう，キューのみを受け渡す
+        state = self.__dict__.copy()
+        state["process_list"] = []
+        return state
+
+    def start(self):
+        for process in self.process_list:
+            process.start()
+
+    def stop(self):
+        for request_queue in self.request_queue_list:
+            request_queue.put(None)
+        for process in self.process_list:
+            process.join()
+
+    def close(self, key):
+        # key に対応するセッションを各プロセスで破棄する
+        for request_queue in self.request_queue_list:
+            request_queue.put(("close", key))
+
+    def render(self, context, sample_max, key=None):
+        # 有効なセッションのカメラなどで sample_max サンプルを各プロセスに分配し，
+        # 各プロセスの平均値をサンプル数で重み付けして，context の累積画像に足し合わせる
+        # 輝度の2次モーメントも同様に足し合わせ，収束判定をやり直す（収束済みの画素も各プロセスはサンプリングする）
+        # その後のトーンマッピングなどは context 上で行われ，Context.render と同じ状態になる
+        worker_count = len(self.request_queue_list)
+        parameters = {
+            name: getattr(context, name)
+            for name in context.session.ACCUMULATION_PARAMETERS
+        }
+        share_list = [
+            sample_max // worker_count + (index < sample_max % worker_count)
+            for index in range(worker_count)
+        ]
+        for request_queue, share in zip(self.request_queue_list, share_list):
+            request_queue.put(("render", key, parameters, share))
+
+        shape = (context.height, context.width, 4)
+        sample_count = context.current_sample - 1
+        accumulation = np.zeros(shape, dtype="f8")
+        moment = np.zeros(shape, dtype="f8")
+        if sample_count > 0:
+            texture_list = context.accumulation_texture_list()
+            accumulation += sample_count * np.frombuffer(
+                texture_list[0].read(), dtype="f4"
+            ).reshape(shape)
+            moment += sample_count * np.frombuffer(
+                texture_list[2].read(), dtype="f4"
+            ).reshape(shape)
+        for _ in range(worker_count):
+            index, binary_list = self.result_queue.get()
+            if binary_list is not None:
+                accumulation += share_list[index] * np.frombuffer(
+                    binary_list[0], dtype="f4"
+                ).reshape(shape)
+                moment += share_list[index] * np.frombuffer(
+                    binary_list[1], dtype="f4"
+                ).reshape(shape)
+        sample_count += sample_max
+        accumulation /= sample_count
+        moment /= sample_count
+
+        # モーメント画像は (輝度の2次モーメント, サンプル数, 収束済みか否か, 0)
+        # 収束判定はパストレーシングのシェーダーと同じ（DELTA = 0.01）
+        luminance = (
+            0.27 * accumulation[:, :, 0]
+            + 0.67 * accumulation[:, :, 1]
+            + 0.06 * accumulation[:, :, 2]
+        )
+        variance = np.maximum(moment[:, :, 0] - luminance**2, 0)
+        moment[:, :, 1] = sample_count
+        moment[:, :, 2] = (
+            context.convergence_threshold > 0
+            and sample_count >= context.convergence_sample_min
+        ) & (
+            np.sqrt(variance / sample_count)
+            <= context.convergence_threshold * (luminance + 0.01)
+        )
+        moment[:, :, 3] = 0
+
+        context.load_accumulation(
+            sample_count, [accumulation.astype("f4"), None, moment.astype("f4")]
+        )
+        context.redisplay()
+        context.read_output_async()
+
+    @staticmethod
+    def run(context_factory, index, threads_per_worker, request_queue, result_queue):
+        # llvmpipe が1プロセスで使うスレッド数（None の場合はコア数）
+        if threads_per_worker:
+            os.environ["LP_NUM_THREADS"] = str(threads_per_worker)
+        context = context_factory()
+        session_dict = {}
+        session_counter = itertools.count()
+
+        while True:
+            request = request_queue.get()
+            if request is None:
+                break
+
+            if request[0] == "close":
+                _, key = request
+                if key in session_dict:
+                    context.release_session(session_dict.pop(key))
+            elif request[0] == "render":
+                _, key, parameters, sample_max = request
+                if key not in session_dict:
+                    # プロセスごと，セッションごとに異なるシード画像を用いる
+                    session_dict[key] = context.create_session(
+                        seed=[index, next(session_counter)]
+                    )
+                context.use_session(session_dict[key])
+                for name, value in parameters.items():
+                    setattr(context, name, value)
+
+                # 累積はせず，このフレームの sample_max サンプルの平均値とモーメント画像のみを返す
+                # シード画像はセッションごとに更新され続けるため，フレームごとに異なる乱数となる
+                binary_list = None
+                if sample_max > 0:
+                    context.current_sample = 1
+                    context.path_trace(sample_max, context.program_path_trace)
+                    texture_list = context.accumulation_texture_list()
+                    binary_list = [texture_list[0].read(), texture_list[2].read()]
+                result_queue.put((index, binary_list))
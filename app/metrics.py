@@ -0,0 +1,81 @@
+import numpy as np
+
+# 計測する段階（Context.measure の段階名と，サーバで計測するもの）
+STAGE_LIST = [
+    "path_trace",
+    "reduce_luminance",
+    "denoise",
+    "post_process",
+    "upscale",
+    "readback",
+    "encode",
+    "send",
+    "render",
+]
+
+
+class Metrics:
+    # 段階ごとの時間 [ms] を直近 capacity フレーム分のリングバッファに記録する
+    # 記録は配列への代入のみで，パーセンタイルなどの集計は取り出す時にまとめて行う
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        # 計測されなかった段階は NaN とし，集計から除く
+        self.buffer = np.full((capacity, len(STAGE_LIST)), np.nan)
+        self.index = 0
+        self.count = 0
+        # 起動してからの段階ごとの合計（Prometheus の _count, _sum）
+        self.total_count = np.zeros(len(STAGE_LIST), dtype=np.int64)
+        self.total_sum = np.zeros(len(STAGE_LIST))
+
+    def record(self, timing_dict):
+        # 1フレーム分の {段階名: 時間 [ms]} を記録する（STAGE_LIST に無い段階は無視する）
+        row = self.buffer[self.index]
+        row[:] = np.nan
+        for stage, value in timing_dict.items():
+            if stage in STAGE_LIST:
+                row[STAGE_LIST.index(stage)] = value
+        measured = ~np.isnan(row)
+        self.total_count += measured
+        self.total_sum[measured] += row[measured]
+        self.index = (self.index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def summary(self, percentiles=(50, 90, 99)):
+        # 直近のフレームについて，段階ごとの {"count", "mean", "p50", ...} を返す
+        result = {}
+        buffer = self.buffer[: self.count]
+        for index, stage in enumerate(STAGE_LIST):
+            value = buffer[:, index]
+            value = value[~np.isnan(value)]
+            if len(value) == 0:
+                continue
+            result[stage] = {"count": len(value), "mean": float(value.mean())}
+            for percentile, quantile in zip(
+                percentiles, np.percentile(value, percentiles)
+            ):
+                result[stage][f"p{percentile}"] = float(quantile)
+        return result
+
+    def prometheus(self, percentiles=(50, 90, 99)):
+        # Prometheus のテキスト形式（summary 型，単位は秒）で返す
+        line_list = [
+            "# HELP vc2_stage_seconds Time spent in each stage of a frame.",
+            "# TYPE vc2_stage_seconds summary",
+        ]
+        summary = self.summary(percentiles)
+        for index, stage in enumerate(STAGE_LIST):
+            for percentile in percentiles:
+                if stage in summary:
+                    quantile = summary[stage][f"p{percentile}"] / 1000
+                    line_list.append(
+                        f'vc2_stage_seconds{{stage="{stage}",'
+                        f'quantile="{percentile / 100}"}} {quantile}'
+                    )
+            line_list.append(
+                f'vc2_stage_seconds_count{{stage="{stage}"}} {self.total_count[index]}'
+            )
+            line_list.append(
+                f'vc2_stage_seconds_sum{{stage="{stage}"}} '
+                f"{self.total_sum[index] / 1000}"
+            )
+        return "\n".join(line_list) + "\n"
@@ -0,0 +1,86 @@
+import struct
+
+# サーバからクライアントへ送るフレームメッセージのヘッダ（リトルエンディアン，40 バイト）
+#
+#  offset  型       内容
+#  0       char[4]  マジックナンバー "VC2F"
+#  4       uint8    プロトコルのバージョン
+#  5       uint8    画像のコーデック（CODEC_LIST のインデックス）
+#  6       uint16   ヘッダの大きさ（画像はこの位置から始まる）
+#  8       uint32   フレーム番号（セッションごとに増える）
+#  12      uint32   パラメータの世代番号
+#  16      uint32   1画素あたりのサンプル数
+#  20      uint16   画像の幅
+#  22      uint16   画像の高さ
+#  24      float32  レンダリングに要した時間 [ms]
+#  28      float32  エンコードに要した時間 [ms]
+#  32      uint16   収束マップの幅（適応サンプリングを行わない場合は 0）
+#  34      uint16   収束マップの高さ
+#  36      float32  収束済みの画素の割合（0 から 1）
+#
+# ヘッダの直後に収束マップ（ブロックごとの収束済みの割合を uint8 で表した画像，上の行から順），
+# その直後にエンコード済み画像が続く（raw の場合は RGBA を上の行から順に並べたもの）
+HEADER = struct.Struct("<4sBBHIIIHHffHHf")
+MAGIC = b"VC2F"
+VERSION = 2
+
+CODEC_LIST = ["jpeg", "webp", "png", "raw"]
+
+
+def pack_frame(frame):
+    header = HEADER.pack(
+        MAGIC,
+        VERSION,
+        CODEC_LIST.index(frame["codec"]),
+        HEADER.size,
+        frame["frame_id"],
+        frame["generation"],
+        frame["spp"],
+        frame["width"],
+        frame["height"],
+        frame["render_time"],
+        frame["encode_time"],
+        frame["map_width"],
+        frame["map_height"],
+        frame["converged"],
+    )
+    return header + frame["convergence_map"] + frame["payload"]
+
+
+def unpack_frame(message):
+    (
+        magic,
+        version,
+        codec,
+        header_size,
+        frame_id,
+        generation,
+        spp,
+        width,
+        height,
+        render_time,
+        encode_time,
+        map_width,
+        map_height,
+        converged,
+    ) = HEADER.unpack_from(message)
+    if magic != MAGIC:
+        raise ValueError("invalid magic number")
+    if version != VERSION:
+        raise ValueError(f"unsupported protocol version: {version}")
+    payload_offset = header_size + map_width * map_height
+    return {
+        "codec": CODEC_LIST[codec],
+        "frame_id": frame_id,
+        "generation": generation,
+        "spp": spp,
+        "width": width,
+        "height": height,
+        "render_time": render_time,
+        "encode_time": encode_time,
+        "map_width": map_width,
+        "map_height": map_height,
+        "converged": converged,
+        "convergence_map": message[header_size:payload_offset],
+        "payload": message[payload_offset:],
+    }
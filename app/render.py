@@ -1,6 +1,12 @@
+import contextlib
+import hashlib
 import io
+import json
 import os
 import platform
+import tempfile
+import time
+from collections import OrderedDict, deque
 from string import Template
 
 import cv2
@@ -8,15 +14,549 @@ import numpy as np
 import moderngl
 
 
+def surface_area(lower, upper):
+    extent = upper - lower
+    return 2 * (
+        extent[..., 0] * extent[..., 1]
+        + extent[..., 1] * extent[..., 2]
+        + extent[..., 2] * extent[..., 0]
+    )
+
+
+def build_bvh(lower, upper, leaf_size=4):
+    # 各プリミティブの境界ボックス (lower, upper) から BVH を構築する
+    # 各軸について重心の順に並べた全ての分割位置のうち，SAH（表面積 x プリミティブ数の和）が
+    # 最小となる位置で二分し，leaf_size 個以下になるまで続ける
+    # 床のような巨大なプリミティブは早い段階で他から切り離されるため，中央値で分割するより効率が良い
+    # 節点は深さ優先順に並べ，(最小座標, スキップ先または最初のプリミティブ, 最大座標, プリミティブの数) で表す
+    # スキップ先は部分木の直後の節点であり，境界ボックスと交わらない場合に部分木を飛ばすために用いる
+    # 葉が参照するプリミティブは連続するように，並べ替えの順序 order も返す
+    centroid = (lower + upper) / 2
+    node_list = []
+    order = []
+
+    def build(index):
+        node = len(node_list)
+        node_list.append(None)
+        box_lower = lower[index].min(axis=0)
+        box_upper = upper[index].max(axis=0)
+        if len(index) <= leaf_size:
+            node_list[node] = [*box_lower, len(order), *box_upper, len(index)]
+            order.extend(index)
+            return
+
+        count = np.arange(1, len(index))
+        cost_min = np.inf
+        for axis in range(3):
+            sorted_index = index[np.argsort(centroid[index, axis], kind="stable")]
+            sorted_lower = lower[sorted_index]
+            sorted_upper = upper[sorted_index]
+            left_area = surface_area(
+                np.minimum.accumulate(sorted_lower),
+                np.maximum.accumulate(sorted_upper),
+            )[:-1]
+            right_area = surface_area(
+                np.minimum.accumulate(sorted_lower[::-1])[::-1],
+                np.maximum.accumulate(sorted_upper[::-1])[::-1],
+            )[1:]
+            cost = left_area * count + right_area * (len(index) - count)
+            if cost.min() < cost_min:
+                cost_min = cost.min()
+                split = np.argmin(cost) + 1
+                split_index = sorted_index
+
+        build(split_index[:split])
+        build(split_index[split:])
+        node_list[node] = [*box_lower, len(node_list), *box_upper, 0]
+
+    build(np.arange(len(lower)))
+    return np.array(node_list, dtype="f4"), np.array(order)
+
+
+def build_env_map_cdf(env_map):
+    # 環境マップ (高さ, 幅, RGBA) の輝度 x sin(theta) に比例する分布の累積分布関数を求める
+    # sin(theta) は正距円筒図法で極に近い行ほど画素の立体角が小さくなることを補正する
+    # 戻り値は行ごとの条件付き累積分布関数と (u, v) 平面での画素ごとの確率密度 (高さ, 幅, 2)，
+    # および行の周辺累積分布関数 (高さ,)
+    height, width = env_map.shape[:2]
+    theta = (np.arange(height) + 0.5) / height * np.pi
+    luminance = (
+        0.27 * env_map[:, :, 0] + 0.67 * env_map[:, :, 1] + 0.06 * env_map[:, :, 2]
+    )
+    weight = np.maximum(luminance, 0).astype("f8") * np.sin(theta)[:, np.newaxis]
+    if weight.sum() <= 0:
+        weight = np.ones_like(weight) * np.sin(theta)[:, np.newaxis]
+
+    row_sum = weight.sum(axis=1)
+    conditional = np.cumsum(weight, axis=1)
+    conditional /= np.where(row_sum > 0, row_sum, 1)[:, np.newaxis]
+    conditional[row_sum <= 0] = (np.arange(width) + 1) / width
+    marginal = np.cumsum(row_sum) / row_sum.sum()
+    pdf = weight / weight.mean()
+    return np.dstack([conditional, pdf]).astype("f4"), marginal.astype("f4")
+
+
+class EnvMapStore:
+    # 環境マップの2段のキャッシュ
+    # 1. ディスク: HDR を一度だけ復号し，RGBA 画像と累積分布関数の表を .npy として保存する
+    #    ファイルの内容のハッシュ値をキーとし，次回からはメモリマップで読み込む（復号も変換も不要）
+    #    cache_dir が None の場合はディスクに書き出さず，毎回メモリ上で復号する
+    # 2. GPU: テクスチャを LRU で保持し，合計の大きさが vram_budget [bytes] を超えたら古いものから解放する
+    def __init__(self, context, cache_dir, vram_budget, dtype="f4"):
+        self.context = context
+        self.cache_dir = cache_dir
+        self.vram_budget = vram_budget
+        # 環境マップのテクスチャの型（"f2" の場合は転送量と VRAM が半分になる）
+        self.dtype = dtype
+        self.hash_dict = {}
+        self.texture_dict = OrderedDict()
+        self.size_dict = {}
+
+    def hash(self, path):
+        # 同じファイルを何度も読まないよう，更新時刻と大きさが変わらない間はハッシュ値を使い回す
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        if key not in self.hash_dict:
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+            self.hash_dict[key] = digest.hexdigest()
+        return self.hash_dict[key]
+
+    def decode(self, path):
+        # HDR を復号し，(RGBA 画像, 条件付き累積分布関数と確率密度, 周辺累積分布関数) を返す
+        env_map = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        if env_map is None:
+            raise ValueError(f"failed to read environment map: {path}")
+        env_map = cv2.cvtColor(env_map, cv2.COLOR_BGRA2RGBA)
+        conditional, marginal = build_env_map_cdf(env_map)
+        if self.dtype == "f2":
+            env_map = np.minimum(env_map, np.finfo(np.float16).max)
+        return [env_map.astype(self.dtype), conditional, marginal]
+
+    def load(self, path):
+        # (RGBA 画像, 条件付き累積分布関数と確率密度, 周辺累積分布関数) をメモリマップで返す
+        if self.cache_dir is None:
+            return self.decode(path)
+        prefix = os.path.join(self.cache_dir, self.hash(path))
+        path_list = [
+            f"{prefix}-{self.dtype}.npy",
+            f"{prefix}-conditional.npy",
+            f"{prefix}-marginal.npy",
+        ]
+        if not all(os.path.exists(cache_path) for cache_path in path_list):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            for cache_path, array in zip(path_list, self.decode(path)):
+                # 書き込み途中のファイルを読まないよう，書き終えてから置き換える
+                with open(f"{cache_path}.{os.getpid()}.tmp", "wb") as f:
+                    np.save(f, array)
+                os.replace(f"{cache_path}.{os.getpid()}.tmp", cache_path)
+        return [np.load(cache_path, mmap_mode="r") for cache_path in path_list]
+
+    def get(self, path):
+        # (環境マップ, 条件付き累積分布関数, 周辺累積分布関数) のテクスチャを返す
+        if path in self.texture_dict:
+            self.texture_dict.move_to_end(path)
+            return self.texture_dict[path]
+
+        env_map, conditional, marginal = self.load(path)
+        texture_list = [
+            self.context.texture(
+                (env_map.shape[1], env_map.shape[0]), 4, env_map, dtype=self.dtype
+            ),
+            self.context.texture(
+                (conditional.shape[1], conditional.shape[0]), 2, conditional, dtype="f4"
+            ),
+            self.context.texture((marginal.shape[0], 1), 1, marginal, dtype="f4"),
+        ]
+        self.texture_dict[path] = texture_list
+        self.size_dict[path] = env_map.nbytes + conditional.nbytes + marginal.nbytes
+        # 予算を超えた場合は，使われていない期間が長いものから解放する（今読み込んだものは残す）
+        while self.size() > self.vram_budget and len(self.texture_dict) > 1:
+            evicted_path, evicted_list = self.texture_dict.popitem(last=False)
+            self.size_dict.pop(evicted_path)
+            for texture in evicted_list:
+                texture.release()
+        return texture_list
+
+    def size(self):
+        return sum(self.size_dict.values())
+
+    def release(self):
+        for texture_list in self.texture_dict.values():
+            for texture in texture_list:
+                texture.release()
+        self.texture_dict.clear()
+        self.size_dict.clear()
+
+
+class AccumulationCache:
+    # カメラの状態をキーとして，累積画像などのスナップショットを LRU で保持する
+    # 1. メモリ: 合計の大きさが memory_budget [bytes] を超えたら古いものから 2. に移す
+    # 2. ディスク（spill_dir が None の場合は使わない）: np.memmap で書き出し，
+    #    合計の大きさが disk_budget [bytes] を超えたら古いものから削除する
+    def __init__(self, memory_budget, spill_dir=None, disk_budget=1024**3):
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.disk_budget = disk_budget
+        # キー -> (サンプル数, 配列のリスト)
+        self.memory_dict = OrderedDict()
+        # キー -> (サンプル数, ファイルのパスのリスト)
+        self.disk_dict = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def sample_count(self, key):
+        # キャッシュにあるスナップショットのサンプル数（無い場合は 0）
+        for entry_dict in [self.memory_dict, self.disk_dict]:
+            if key in entry_dict:
+                return entry_dict[key][0]
+        return 0
+
+    def put(self, key, sample_count, array_list):
+        self.discard(key)
+        self.memory_dict[key] = (sample_count, array_list)
+        while self.memory_size() > self.memory_budget and self.memory_dict:
+            evicted_key, (evicted_count, evicted_list) = self.memory_dict.popitem(
+                last=False
+            )
+            if self.spill_dir is not None:
+                self.spill(evicted_key, evicted_count, evicted_list)
+
+    def get(self, key):
+        # (サンプル数, 配列のリスト) を返す（無い場合は None）
+        # ディスクにあったものはメモリに読み戻す
+        if key in self.memory_dict:
+            self.memory_dict.move_to_end(key)
+            self.memory_hits += 1
+            return self.memory_dict[key]
+        if key in self.disk_dict:
+            sample_count, path_list = self.disk_dict.pop(key)
+            array_list = [np.array(np.load(path, mmap_mode="r")) for path in path_list]
+            for path in path_list:
+                os.remove(path)
+            self.disk_hits += 1
+            self.put(key, sample_count, array_list)
+            return sample_count, array_list
+        self.misses += 1
+        return None
+
+    def spill(self, key, sample_count, array_list):
+        os.makedirs(self.spill_dir, exist_ok=True)
+        digest = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+        path_list = []
+        for i, array in enumerate(array_list):
+            path = os.path.join(self.spill_dir, f"{digest}-{i}.npy")
+            memmap = np.lib.format.open_memmap(
+                path, mode="w+", dtype=array.dtype, shape=array.shape
+            )
+            memmap[:] = array
+            memmap.flush()
+            del memmap
+            path_list.append(path)
+        self.disk_dict[key] = (sample_count, path_list)
+        while self.disk_size() > self.disk_budget and self.disk_dict:
+            _, (_, evicted_list) = self.disk_dict.popitem(last=False)
+            for path in evicted_list:
+                os.remove(path)
+
+    def discard(self, key):
+        self.memory_dict.pop(key, None)
+        _, path_list = self.disk_dict.pop(key, (0, []))
+        for path in path_list:
+            os.remove(path)
+
+    def memory_size(self):
+        return sum(
+            array.nbytes
+            for _, array_list in self.memory_dict.values()
+            for array in array_list
+        )
+
+    def disk_size(self):
+        return sum(
+            os.path.getsize(path)
+            for _, path_list in self.disk_dict.values()
+            for path in path_list
+        )
+
+    def statistics(self):
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_entries": len(self.memory_dict),
+            "memory_size": self.memory_size(),
+            "disk_entries": len(self.disk_dict),
+            "disk_size": self.disk_size(),
+        }
+
+    def clear(self):
+        for key in list(self.disk_dict):
+            self.discard(key)
+        self.memory_dict.clear()
+
+
+class TileScheduler:
+    # パストレーシングを，1回の描画が time_budget [s] に収まるタイル（シザー矩形）とサンプル数のスライスに分ける
+    # 1画素1サンプルあたりの時間を描画ごとに計測して指数移動平均で見積もり，タイルの一辺とスライスのサンプル数を決める
+    # タイルは中央に近い順（order が "noise" の場合は相対誤差の大きい順）に描画する
+    ORDER_LIST = ["centre", "noise"]
+    TILE_SIZE_MIN = 16
+    SMOOTHING = 0.5
+
+    def __init__(self, time_budget, tile_size=256, order="centre"):
+        if order not in TileScheduler.ORDER_LIST:
+            raise ValueError(f"unknown tile order: {order}")
+        self.time_budget = time_budget
+        self.tile_size = tile_size
+        self.order = order
+        # 1画素1サンプルあたりの時間 [s]（計測するまでは None）
+        self.cost = None
+
+    def plan(self, sample_max):
+        # (タイルの一辺, スライスのサンプル数) を返す
+        # 1サンプルでも time_budget を超える場合は，TILE_SIZE_MIN まで一辺を半分にする
+        if self.cost is None:
+            return self.tile_size, 1
+        size = self.tile_size
+        while size > TileScheduler.TILE_SIZE_MIN and (
+            self.cost * size * size > self.time_budget
+        ):
+            size //= 2
+        sample_count = int(self.time_budget / (self.cost * size * size))
+        return size, min(max(sample_count, 1), sample_max)
+
+    def update(self, pixel_count, sample_count, elapsed):
+        if pixel_count * sample_count == 0:
+            return
+        cost = elapsed / (pixel_count * sample_count)
+        if self.cost is None:
+            self.cost = cost
+        else:
+            self.cost += TileScheduler.SMOOTHING * (cost - self.cost)
+
+    def tiles(self, width, height, size, error=None):
+        # 画像を一辺 size のタイル (x, y, 幅, 高さ) に分け，描画する順に並べる
+        # error は画素ごとの相対誤差（order が "noise" の場合に，タイル内の平均が大きい順に並べる）
+        tile_list = [
+            (x, y, min(size, width - x), min(size, height - y))
+            for y in range(0, height, size)
+            for x in range(0, width, size)
+        ]
+
+        def key(tile):
+            x, y, tile_width, tile_height = tile
+            distance = np.hypot(
+                x + tile_width / 2 - width / 2, y + tile_height / 2 - height / 2
+            )
+            if self.order != "noise" or error is None:
+                return (0.0, distance)
+            noise = np.mean(error[y : y + tile_height, x : x + tile_width])
+            return (-noise, distance)
+
+        return sorted(tile_list, key=key)
+
+
+class Session:
+    # コネクションごとに持つ状態（カメラ，累積画像，乱数のシード画像など）
+    # Context.use_session で有効化している間は，Context の同名の属性を通して読み書きする
+
+    # 変更すると累積画像が無効になるパラメータ（サンプリングをやり直す）
+    ACCUMULATION_PARAMETERS = (
+        "theta",
+        "phi",
+        "move_x",
+        "move_y",
+        "env_map",
+        "resolution",
+        "depth_max",
+        "roulette_depth",
+    )
+    # 表示のみに影響するパラメータ（累積画像はそのままに post_process のみやり直す）
+    DISPLAY_PARAMETERS = ("key_value", "gamma", "codec", "quality")
+
+    ATTRIBUTES = (
+        "width",
+        "height",
+        "seed",
+        "current_sample",
+        "accumulated_sample_count",
+        "theta",
+        "phi",
+        "move_x",
+        "move_y",
+        "env_map",
+        "depth_max",
+        "roulette_depth",
+        "max_spp",
+        "key_value",
+        "gamma",
+        "codec",
+        "quality",
+        "luminance_average",
+        "luminance_max",
+        "converged_ratio",
+        "convergence_map",
+        "switch",
+        "output_image",
+        "input_image_list",
+        "seed_image_list",
+        "moment_image_list",
+        "readback_buffer_list",
+        "readback_index",
+        "readback_pending",
+        "readback_binary",
+        "reduction_fbo_list",
+        "albedo_image",
+        "normal_image",
+        "denoise_fbo_list",
+        "denoised_image",
+        "preview_session",
+        "preview_image",
+        "fbo",
+    )
+
+    def __init__(self, width=960, height=540, seed=0):
+        # 解像度と乱数のシード画像の種（Context.resize で解像度を変えても同じ種を使う）
+        self.width = width
+        self.height = height
+        self.seed = seed
+        self.current_sample = 1
+        # 直前のフレームのサンプルまで含めた名目のサンプル数（denoise と redisplay が参照する）
+        # 収束していない画素はいずれもこの数以上のサンプル（モーメント画像の g）を持つ
+        self.accumulated_sample_count = 0
+        self.theta = 0
+        self.phi = 0
+        self.move_x = 0
+        self.move_y = 0
+        # 環境マップのパス（None の場合は bind_data で指定したもの）
+        self.env_map = None
+        # 反射の最大回数と，ロシアンルーレットを始める反射の回数（Context.PRESET_DICT を参照）
+        self.depth_max = Context.PRESET_DICT["balanced"]["depth_max"]
+        self.roulette_depth = Context.PRESET_DICT["balanced"]["roulette_depth"]
+        self.max_spp = 0
+        self.key_value = 0.18
+        self.gamma = 2.2
+        # 送信用画像のコーデック（Context.CODEC_LIST）と品質（1 から 100，None の場合は OpenCV の既定値）
+        self.codec = "jpeg"
+        self.quality = None
+
+        # 直前のフレームの輝度の対数平均値と最大値（表示のみをやり直す際に用いる）
+        self.luminance_average = None
+        self.luminance_max = None
+
+        # 直前のフレームで収束済みの画素の割合と，ブロックごとの収束済みの割合（適応サンプリング）
+        self.converged_ratio = 0.0
+        self.convergence_map = None
+
+        self.switch = 0
+        self.output_image = None
+        self.input_image_list = None
+        self.seed_image_list = None
+        self.moment_image_list = None
+        self.readback_buffer_list = None
+        self.readback_index = 0
+        self.readback_pending = deque()
+        self.readback_binary = deque()
+        self.reduction_fbo_list = None
+
+        # デノイズに用いる最初の衝突面のアルベドと法線，フィルタを交互に適用する画像，およびその結果
+        # denoised_image が None でない間は，トーンマッピングの入力はこれ
+        self.albedo_image = None
+        self.normal_image = None
+        self.denoise_fbo_list = None
+        self.denoised_image = None
+
+        # カメラの操作中に低解像度でレンダリングするためのセッションと，その累積画像
+        # preview_image が None でない間は，送信用画像はこれを拡大したもの
+        self.preview_session = None
+        self.preview_image = None
+
+        self.fbo = None
+
+
 class Context:
     ATTACHMENT_INDEX_OUTPUT_COLOR = 0
     ATTACHMENT_INDEX_INPUT_COLOR = 1
     ATTACHMENT_INDEX_SEED_VALUE = 2
+    ATTACHMENT_INDEX_MOMENT_VALUE = 3
+    ATTACHMENT_INDEX_ALBEDO_VALUE = 4
+    ATTACHMENT_INDEX_NORMAL_VALUE = 5
     TEXTURE_UNIT_INPUT_IMAGE = 1
     TEXTURE_UNIT_SEED_IMAGE = 2
     TEXTURE_UNIT_BACKGROUND_IMAGE = 3
+    TEXTURE_UNIT_REDUCTION_SOURCE = 4
+    TEXTURE_UNIT_MOMENT_IMAGE = 5
+    TEXTURE_UNIT_SCENE_IMAGE = 6
+    TEXTURE_UNIT_BVH_IMAGE = 7
+    TEXTURE_UNIT_ENV_CONDITIONAL_IMAGE = 8
+    TEXTURE_UNIT_ENV_MARGINAL_IMAGE = 9
+    TEXTURE_UNIT_ALBEDO_IMAGE = 10
+    TEXTURE_UNIT_NORMAL_IMAGE = 11
+    TEXTURE_UNIT_DENOISE_SOURCE = 12
+    TEXTURE_UNIT_DENOISE_RAW = 13
+    # シーンおよび BVH を格納する画像の幅（texel 数）
+    SCENE_TEXTURE_WIDTH = 1024
+    MATERIAL_LIST = ["background", "diffuse", "mirror", "glass"]
+    REDUCTION_BLOCK_SIZE = 8
+    # 収束済みの画素の分を残りの画素に回す際の，1画素あたりのサンプル数の最大倍率
+    ADAPTIVE_SAMPLE_SCALE_MAX = 4
+    # プレビューの解像度の最小の倍率
+    PREVIEW_SCALE_MIN = 1 / 16
+    # デノイズの重みの鋭さ（輝度の差は標準誤差の何倍までぼかすか，法線の cos の指数，アルベドの差）
+    DENOISE_SIGMA_COLOR = 4.0
+    DENOISE_SIGMA_NORMAL = 128.0
+    DENOISE_SIGMA_ALBEDO = 0.1
+    # 画質のプリセット（反射の最大回数と，ロシアンルーレットで経路を打ち切り始める反射の回数）
+    # interactive はカメラの操作向けに浅く，final は屈折の多い経路も打ち切らないよう深くする
+    PRESET_DICT = {
+        "interactive": {"depth_max": 8, "roulette_depth": 3},
+        "balanced": {"depth_max": 16, "roulette_depth": 4},
+        "final": {"depth_max": 32, "roulette_depth": 8},
+    }
+    # コーデックごとの (拡張子, 品質のパラメータ)
+    # raw は RGBA をそのまま送る（回線の速いローカル接続向け），png は可逆圧縮で品質の指定は無い
+    CODEC_DICT = {
+        "jpeg": (".jpg", cv2.IMWRITE_JPEG_QUALITY),
+        "webp": (".webp", cv2.IMWRITE_WEBP_QUALITY),
+        "png": (".png", None),
+        "raw": (None, None),
+    }
 
-    def __init__(self, width=960, height=540, sample_per_frame=1):
+    def __init__(
+        self,
+        width=960,
+        height=540,
+        sample_per_frame=1,
+        gpu_reduction=True,
+        readback_buffer_count=0,
+        convergence_threshold=0.0,
+        convergence_sample_min=16,
+        bvh_leaf_size=4,
+        light_sampling=True,
+        env_map_cache_dir=None,
+        env_map_vram_budget=256 * 1024**2,
+        env_map_dtype="f4",
+        preview_delay=0.0,
+        preview_scale=0.25,
+        preview_sample_max=1,
+        preview_frame_time=1 / 30,
+        accumulation_cache_budget=0,
+        accumulation_cache_spill=False,
+        accumulation_cache_disk_budget=1024**3,
+        accumulation_cache_quantum=1e-3,
+        profile=False,
+        frame_skip_psnr=0.0,
+        keyframe_interval=1.0,
+        denoise_sample_max=0,
+        denoise_iterations=5,
+        dispatch_time_budget=0.0,
+        tile_size=256,
+        tile_order="centre",
+    ):
         kwargs = {
             "standalone": True,
             "require": 330,
@@ -25,9 +565,72 @@ class Context:
             kwargs["backend"] = "egl"
         self.context = moderngl.create_context(**kwargs)
 
-        self.width = width
-        self.height = height
+        # 新しいセッションの解像度（セッションごとに Context.resize で変えられる）
+        self.default_resolution = (width, height)
         self.sample_per_frame = sample_per_frame
+        # True の場合は輝度の平均値と最大値を GPU 上で計算する（False の場合は NumPy）
+        self.gpu_reduction = gpu_reduction
+        # 非同期読み出しに用いるピクセルバッファの数（0 の場合は同期読み出しのみ，2 でダブルバッファ）
+        self.readback_buffer_count = readback_buffer_count
+        # 適応サンプリングの収束判定に用いる，輝度に対する標準誤差の割合（0 の場合は全画素を均等にサンプリングする）
+        self.convergence_threshold = convergence_threshold
+        # 収束判定を始めるまでに必要な1画素あたりのサンプル数
+        self.convergence_sample_min = convergence_sample_min
+        # BVH の葉に含めるプリミティブの最大数
+        self.bvh_leaf_size = bvh_leaf_size
+        # True の場合は拡散反射面で環境マップを光源として直接サンプリングし，MIS で重み付けする
+        self.light_sampling = light_sampling
+        # 環境マップのディスクおよび GPU のキャッシュ（env_map_cache_dir が None の場合はディスクに書き出さない）
+        self.env_map_store = EnvMapStore(
+            self.context,
+            env_map_cache_dir and os.path.expanduser(env_map_cache_dir),
+            env_map_vram_budget,
+            env_map_dtype,
+        )
+        # カメラが止まってから preview_delay [s] の間は，解像度を preview_scale 倍，
+        # サンプル数を preview_sample_max に落としてレンダリングする（0 の場合はプレビューを行わない）
+        # preview_scale は1フレームが preview_frame_time [s] に収まるよう adjust_preview_scale で調整される
+        self.preview_delay = preview_delay
+        self.preview_scale = preview_scale
+        self.preview_sample_max = preview_sample_max
+        self.preview_frame_time = preview_frame_time
+        # カメラの状態ごとの累積画像のキャッシュ（accumulation_cache_budget が 0 の場合は使わない）
+        # accumulation_cache_spill が True の場合，メモリから溢れたものは一時ディレクトリに書き出す
+        # カメラの状態は accumulation_cache_quantum 単位に丸めてキーとする
+        self.accumulation_spill_dir = None
+        if accumulation_cache_spill:
+            self.accumulation_spill_dir = tempfile.TemporaryDirectory(
+                prefix="vc2-accumulation-"
+            )
+        self.accumulation_cache = AccumulationCache(
+            accumulation_cache_budget,
+            self.accumulation_spill_dir and self.accumulation_spill_dir.name,
+            accumulation_cache_disk_budget,
+        )
+        self.accumulation_cache_quantum = accumulation_cache_quantum
+        # True の場合は段階ごとの時間を計測する（GPU の段階はタイマークエリ，それ以外は CPU の経過時間）
+        # 計測結果は collect_timings で段階名から [ms] への辞書として取り出す
+        self.profile = profile
+        # RenderWorker は，前回送った画像との PSNR が frame_skip_psnr [dB] 以上のフレームを送らない
+        # （0 の場合は毎フレーム送る）．ただし keyframe_interval [s] ごとと最後のフレームは必ず送る
+        self.frame_skip_psnr = frame_skip_psnr
+        self.keyframe_interval = keyframe_interval
+        # サンプル数が denoise_sample_max 未満の間は，トーンマッピングの前に à-trous ウェーブレットで
+        # denoise_iterations 回平滑化する．サンプル数が増えるほど弱め，denoise_sample_max で元の画像に戻す
+        # （0 の場合はデノイズしない）
+        self.denoise_sample_max = denoise_sample_max
+        self.denoise_iterations = denoise_iterations
+        # dispatch_time_budget [s] が 0 より大きい場合，パストレーシングを1回の描画がこの時間に収まる
+        # タイル（一辺は最大 tile_size）とサンプル数のスライスに分け，描画ごとに完了を待つ
+        # （0 の場合は全画面を1回で描画する．TileScheduler を参照）
+        self.tile_scheduler = None
+        if dispatch_time_budget > 0:
+            self.tile_scheduler = TileScheduler(
+                dispatch_time_budget, tile_size, tile_order
+            )
+        self.query_dict = {}
+        self.query_pending_set = set()
+        self.timing_dict = {}
 
         with open("assets/glsl/vertex_shader.glsl", encoding="utf-8") as vs_f:
             self.vertex_shader_str = vs_f.read()
@@ -39,32 +642,100 @@ class Context:
             "assets/glsl/fragment_shader_post_process.glsl", encoding="utf-8"
         ) as fs_f:
             self.post_process_str = fs_f.read()
+        with open(
+            "assets/glsl/fragment_shader_reduce_luminance.glsl", encoding="utf-8"
+        ) as fs_f:
+            self.reduce_luminance_str = fs_f.read()
+        with open("assets/glsl/fragment_shader_denoise.glsl", encoding="utf-8") as fs_f:
+            self.denoise_str = fs_f.read()
 
-        self.current_sample = 1
-        self.theta = 0
-        self.phi = 0
-        self.move_x = 0
-        self.move_y = 0
-        self.max_spp = 0
-        self.key_value = 0.18
-
-        self.switch = 0
-        self.output_image = None
-        self.input_image_list = None
-        self.seed_image_list = None
+        # 既定のセッション（解像度，カメラや累積画像など）
+        self.session = None
+        self.use_session(Session(*self.default_resolution))
 
+        # 全セッションで共有する資源（プログラム，VAO，環境マップ，シーン）
+        # プログラムは (シェーダーのハッシュ値, 置換する定数) をキーとして，コンパイル結果を使い回す
+        self.program_dict = {}
+        self.vbo = None
+        self.scene_image = None
+        self.bvh_image = None
+        self.bvh_node_count = 0
+        self.scene_hash = None
+        self.env_map_path = None
         self.program_path_trace = None
         self.program_post_process = None
+        self.program_reduce_luminance = None
+        self.program_denoise = None
         self.vao_path_trace = None
         self.vao_post_process = None
+        self.vao_reduce_luminance = None
+        self.vao_denoise = None
+
+    def use_session(self, session):
+        # 有効なセッションの状態を退避し，指定したセッションの状態を読み込む
+        if session is self.session:
+            return
+        if self.session is not None:
+            for name in Session.ATTRIBUTES:
+                setattr(self.session, name, getattr(self, name))
+        for name in Session.ATTRIBUTES:
+            setattr(self, name, getattr(session, name))
+        self.session = session
+
+    def create_session(self, seed=0):
+        # 新しいセッションを生成して有効化する（プログラムや環境マップは共有する）
+        session = Session(*self.default_resolution, seed=seed)
+        self.use_session(session)
+        self.create_textures()
+        return session
+
+    def release_session(self, session):
+        # セッションが持つ GPU 資源を解放する
+        self.use_session(session)
+        self.release_textures()
+        self.session = None
+        self.use_session(Session(*self.default_resolution))
+
+    def release_textures(self):
+        for resource in [
+            self.fbo,
+            self.output_image,
+            *(self.input_image_list or []),
+            *(self.seed_image_list or []),
+            *(self.moment_image_list or []),
+            *(self.readback_buffer_list or []),
+            self.albedo_image,
+            self.normal_image,
+        ]:
+            if resource is not None:
+                resource.release()
+        for fbo in [*(self.reduction_fbo_list or []), *(self.denoise_fbo_list or [])]:
+            fbo.color_attachments[0].release()
+            fbo.release()
         self.fbo = None
+        self.reduction_fbo_list = None
+        self.albedo_image = None
+        self.normal_image = None
+        self.denoise_fbo_list = None
+        self.denoised_image = None
+
+        # プレビュー用のセッションの画像も解放する
+        if self.preview_session is not None:
+            session, preview_session = self.session, self.preview_session
+            self.preview_session = None
+            self.preview_image = None
+            self.use_session(preview_session)
+            self.release_textures()
+            self.use_session(session)
+
+    def create_textures(self):
+        self.release_textures()
 
-    def bind_data(self, env_map_path):
         data = np.zeros((self.height, self.width, 4)).astype("float32").tobytes()
 
-        # 送信用画像（トーンマップおよびガンマ変換適用済み）
+        # 送信用画像（トーンマップおよびガンマ変換適用済み，上下反転済みの 8 bit）
         self.output_image = self.context.texture(
-            (self.width, self.height), components=4, dtype="f4"
+            (self.width, self.height), components=4, dtype="f1"
         )
 
         # サンプリングを再開するために用いる raw 画像
@@ -74,7 +745,7 @@ class Context:
         ]
 
         seed = (
-            np.random.default_rng(0)
+            np.random.default_rng(self.seed)
             .integers(
                 low=0, high=2**32, size=(self.width, self.height, 4), dtype=np.uint32
             )
@@ -87,77 +758,341 @@ class Context:
             self.context.texture((self.width, self.height), 4, seed, dtype="u4"),
         ]
 
-        # 環境マップ画像
-        env_map = cv2.imread(env_map_path, cv2.IMREAD_UNCHANGED)
-        env_map = cv2.cvtColor(env_map, cv2.COLOR_BGRA2RGBA)
-        env_map = env_map.reshape((env_map.shape[1], env_map.shape[0], 4))
-        background_image = self.context.texture(
-            (env_map.shape[0], env_map.shape[1]), 4, env_map, dtype="f4"
+        # 適応サンプリング用の画像（輝度の2次モーメント，サンプル数，収束済みか否か）
+        self.moment_image_list = [
+            self.context.texture((self.width, self.height), 4, data, dtype="f4"),
+            self.context.texture((self.width, self.height), 4, data, dtype="f4"),
+        ]
+        self.converged_ratio = 0.0
+        self.convergence_map = None
+
+        # デノイズ用の画像（最初の衝突面のアルベドと法線，およびフィルタを交互に適用する2枚の画像）
+        self.albedo_image = self.context.texture(
+            (self.width, self.height), 4, dtype="f2"
+        )
+        self.normal_image = self.context.texture(
+            (self.width, self.height), 4, dtype="f2"
+        )
+        self.denoise_fbo_list = [
+            self.context.framebuffer(
+                self.context.texture((self.width, self.height), 4, dtype="f4")
+            )
+            for _ in range(2)
+        ]
+        self.denoised_image = None
+
+        # 非同期読み出し用のピクセルバッファ（送信用画像と同じ大きさ）
+        self.readback_buffer_list = [
+            self.context.buffer(reserve=self.width * self.height * 4)
+            for _ in range(self.readback_buffer_count)
+        ]
+        self.readback_index = 0
+        self.readback_pending.clear()
+        self.readback_binary.clear()
+
+        # 輝度のリダクション用の画像（1 辺を REDUCTION_BLOCK_SIZE 分の 1 ずつ縮小し，1x1 まで続ける）
+        self.reduction_fbo_list = []
+        width, height = self.width, self.height
+        while width > 1 or height > 1:
+            width = -(-width // Context.REDUCTION_BLOCK_SIZE)
+            height = -(-height // Context.REDUCTION_BLOCK_SIZE)
+            self.reduction_fbo_list.append(
+                self.context.framebuffer(
+                    self.context.texture((width, height), 4, dtype="f4")
+                )
+            )
+
+    @property
+    def resolution(self):
+        return self.width, self.height
+
+    @resolution.setter
+    def resolution(self, resolution):
+        self.resize(*resolution)
+
+    def resize(self, width, height):
+        # 有効なセッションの画像のみを作り直す（プログラムはコンパイルし直さない）
+        # 累積画像は破棄されるため，サンプリングは始めからやり直しとなる
+        width, height = int(width), int(height)
+        if width <= 0 or height <= 0:
+            raise ValueError(f"invalid resolution: {width}x{height}")
+        if (width, height) == (self.width, self.height):
+            return
+        self.width = width
+        self.height = height
+        self.create_textures()
+        self.current_sample = 1
+        self.accumulated_sample_count = 0
+        self.luminance_average = None
+        self.luminance_max = None
+
+    def use_preset(self, name):
+        # 有効なセッションに画質のプリセットを適用する（累積画像はサンプリングし直すこと）
+        if name not in Context.PRESET_DICT:
+            raise ValueError(f"unknown preset: {name}")
+        for parameter, value in Context.PRESET_DICT[name].items():
+            setattr(self, parameter, value)
+
+    def accumulation_key(self):
+        # 量子化したカメラの状態，解像度，反射の回数，シーンおよび環境マップの組
+        camera = tuple(
+            round(float(getattr(self, name)) / self.accumulation_cache_quantum)
+            for name in ["theta", "phi", "move_x", "move_y"]
+        )
+        env_map_hash = self.env_map_store.hash(self.env_map or self.env_map_path)
+        return (
+            camera,
+            self.width,
+            self.height,
+            self.depth_max,
+            self.roulette_depth,
+            self.scene_hash,
+            env_map_hash,
+        )
+
+    def save_accumulation(self, sample_count):
+        # 有効なセッションの累積画像，シード画像，モーメント画像をキャッシュに退避する
+        # カメラなどを変える前に呼び出す
+        if self.accumulation_cache.memory_budget <= 0 or sample_count <= 0:
+            return
+        key = self.accumulation_key()
+        if self.accumulation_cache.sample_count(key) >= sample_count:
+            return
+        self.accumulation_cache.put(key, sample_count, self.read_accumulation())
+
+    def restore_accumulation(self):
+        # 現在のカメラなどに対応する累積画像がキャッシュにあれば読み込み，そのサンプル数を返す（無い場合は 0）
+        # 読み込んだ場合は輝度を集計し直すため，すぐに redisplay で表示できる
+        if self.accumulation_cache.memory_budget <= 0:
+            return 0
+        entry = self.accumulation_cache.get(self.accumulation_key())
+        if entry is None:
+            return 0
+        sample_count, array_list = entry
+        self.load_accumulation(sample_count, array_list)
+        return sample_count
+
+    def accumulation_texture_list(self):
+        # 直前のパストレーシング結果の (累積画像, シード画像, モーメント画像)
+        index = ~self.switch & 1
+        return [
+            self.input_image_list[index],
+            self.seed_image_list[index],
+            self.moment_image_list[index],
+        ]
+
+    def read_accumulation(self):
+        return [
+            np.frombuffer(texture.read(), dtype=dtype).reshape(
+                self.height, self.width, 4
+            )
+            for texture, dtype in zip(
+                self.accumulation_texture_list(), ["f4", "u4", "f4"]
+            )
+        ]
+
+    def load_accumulation(self, sample_count, array_list):
+        # read_accumulation と同じ順の画像を書き込み，輝度を集計し直す（None の画像はそのまま）
+        for texture, array in zip(self.accumulation_texture_list(), array_list):
+            if array is not None:
+                texture.write(np.ascontiguousarray(array))
+        self.current_sample = sample_count + 1
+        self.accumulated_sample_count = sample_count
+        self.preview_image = None
+        # デノイズに用いるアルベドと法線は保存していないため，サンプリングせずに書き出し直す
+        if self.denoise_sample_max > 0:
+            self.path_trace(0, self.program_path_trace)
+        (
+            self.luminance_average,
+            self.luminance_max,
+            self.converged_ratio,
+        ) = self.reduce_luminance()
+        if self.convergence_threshold > 0:
+            self.convergence_map = self.reduce_convergence_map()
+
+    def bind_data(self, env_map_path, scene_path="assets/scene/default.json"):
+        self.create_textures()
+
+        with open(scene_path, encoding="utf-8") as f:
+            self.bind_scene(json.load(f))
+
+        # 既定の環境マップ（セッションごとに env_map で切り替えられる）
+        self.env_map_path = env_map_path
+        self.bind_env_map(env_map_path)
+
+    def bind_env_map(self, env_map_path):
+        # 環境マップと，重点的サンプリングに用いる累積分布関数の表を有効化する
+        # キャッシュに無い場合のみ読み込むため，フレームごとに呼び出してもよい
+        background_image, conditional_image, marginal_image = self.env_map_store.get(
+            env_map_path
         )
-        background_image.write(data=env_map.astype("float32").tobytes())
-        self.context.sampler(texture=background_image).use(
-            Context.TEXTURE_UNIT_BACKGROUND_IMAGE
+        background_image.use(Context.TEXTURE_UNIT_BACKGROUND_IMAGE)
+        conditional_image.use(Context.TEXTURE_UNIT_ENV_CONDITIONAL_IMAGE)
+        marginal_image.use(Context.TEXTURE_UNIT_ENV_MARGINAL_IMAGE)
+
+    def bind_scene(self, scene):
+        # シーン（球のリスト）から BVH を構築し，シェーダーから参照する画像に格納する
+        sphere_list = scene["spheres"]
+        if not sphere_list:
+            raise ValueError("scene has no primitives")
+        center = np.array([sphere["center"] for sphere in sphere_list], dtype="f4")
+        radius = np.array([sphere["radius"] for sphere in sphere_list], dtype="f4")
+        node_array, order = build_bvh(
+            center - radius[:, np.newaxis],
+            center + radius[:, np.newaxis],
+            self.bvh_leaf_size,
         )
 
+        sphere_array = np.zeros((len(sphere_list), 3, 4), dtype="f4")
+        for i, sphere in enumerate(sphere_list[j] for j in order):
+            sphere_array[i, 0] = [*sphere["center"], sphere["radius"]]
+            sphere_array[i, 1] = [
+                *sphere["scatter"],
+                Context.MATERIAL_LIST.index(sphere["material"]),
+            ]
+            sphere_array[i, 2, :3] = sphere["emission"]
+
+        for image in [self.scene_image, self.bvh_image]:
+            if image is not None:
+                image.release()
+        self.scene_image = self.create_texel_texture(sphere_array)
+        self.bvh_image = self.create_texel_texture(node_array)
+        self.bvh_node_count = len(node_array)
+        self.scene_hash = hashlib.sha256(sphere_array.tobytes()).hexdigest()
+        self.scene_image.use(Context.TEXTURE_UNIT_SCENE_IMAGE)
+        self.bvh_image.use(Context.TEXTURE_UNIT_BVH_IMAGE)
+
+    def create_texel_texture(self, array):
+        # 配列を texel (RGBA) の列とみなし，幅 SCENE_TEXTURE_WIDTH の画像に詰めて格納する
+        texel = array.reshape(-1, 4)
+        height = -(-len(texel) // Context.SCENE_TEXTURE_WIDTH)
+        data = np.zeros((height * Context.SCENE_TEXTURE_WIDTH, 4), dtype="f4")
+        data[: len(texel)] = texel
+        texture = self.context.texture(
+            (Context.SCENE_TEXTURE_WIDTH, height), 4, data.tobytes(), dtype="f4"
+        )
+        texture.filter = (moderngl.Context.NEAREST, moderngl.Context.NEAREST)
+        return texture
+
+    def get_program(self, fragment_shader_str, defines, fragment_outputs=None):
+        # 同じシェーダーと定数の組み合わせは一度だけコンパイルする
+        # 解像度は uniform で渡すため，Context.resize でコンパイルし直す必要は無い
+        # ModernGL はプログラムバイナリの取得や読み込みに対応していないため，キャッシュはメモリ上のみ
+        # （プロセスの再起動をまたぐキャッシュは，ドライバのシェーダーキャッシュに任せる）
+        digest = hashlib.sha256(
+            (self.vertex_shader_str + fragment_shader_str).encode("utf-8")
+        ).hexdigest()
+        key = (digest, tuple(sorted(defines.items())))
+        if key not in self.program_dict:
+            self.program_dict[key] = self.context.program(
+                vertex_shader=self.vertex_shader_str,
+                fragment_shader=Template(fragment_shader_str).substitute(defines),
+                fragment_outputs=fragment_outputs,
+            )
+        return self.program_dict[key]
+
     def create_program(self):
-        self.program_path_trace = self.context.program(
-            vertex_shader=self.vertex_shader_str,
-            fragment_shader=Template(self.fragment_shader_str).substitute(
-                width=self.width,
-                height=self.height,
-            ),
+        self.program_path_trace = self.get_program(
+            self.fragment_shader_str,
+            {"scene_texture_width": Context.SCENE_TEXTURE_WIDTH},
             fragment_outputs={
                 "output_color": Context.ATTACHMENT_INDEX_OUTPUT_COLOR,
                 "input_color": Context.ATTACHMENT_INDEX_INPUT_COLOR,
                 "seed_value": Context.ATTACHMENT_INDEX_SEED_VALUE,
+                "moment_value": Context.ATTACHMENT_INDEX_MOMENT_VALUE,
+                "albedo_value": Context.ATTACHMENT_INDEX_ALBEDO_VALUE,
+                "normal_value": Context.ATTACHMENT_INDEX_NORMAL_VALUE,
             },
         )
-        self.program_post_process = self.context.program(
-            vertex_shader=self.vertex_shader_str,
-            fragment_shader=Template(self.post_process_str).substitute(
-                width=self.width,
-                height=self.height,
-            ),
+        self.program_post_process = self.get_program(
+            self.post_process_str,
+            {},
             fragment_outputs={
                 "output_color": Context.ATTACHMENT_INDEX_OUTPUT_COLOR,
             },
         )
-        vbo = self.context.buffer(
-            np.array(
-                [
-                    [-1, -1],
-                    [-1, 3],
-                    [3, -1],
-                ],
-                dtype="f4",
-            )
+        self.program_reduce_luminance = self.get_program(
+            self.reduce_luminance_str,
+            {"block_size": Context.REDUCTION_BLOCK_SIZE},
         )
+        self.program_denoise = self.get_program(self.denoise_str, {})
+        if self.vbo is None:
+            self.vbo = self.context.buffer(
+                np.array(
+                    [
+                        [-1, -1],
+                        [-1, 3],
+                        [3, -1],
+                    ],
+                    dtype="f4",
+                )
+            )
+        for vao in [
+            self.vao_path_trace,
+            self.vao_post_process,
+            self.vao_reduce_luminance,
+            self.vao_denoise,
+        ]:
+            if vao is not None:
+                vao.release()
         self.vao_path_trace = self.context.vertex_array(
             self.program_path_trace,
-            [(vbo, "2f /v", "position_vertices")],
+            [(self.vbo, "2f /v", "position_vertices")],
         )
         self.vao_post_process = self.context.vertex_array(
             self.program_post_process,
-            [(vbo, "2f /v", "position_vertices")],
+            [(self.vbo, "2f /v", "position_vertices")],
+        )
+        self.vao_reduce_luminance = self.context.vertex_array(
+            self.program_reduce_luminance,
+            [(self.vbo, "2f /v", "position_vertices")],
         )
+        self.vao_denoise = self.context.vertex_array(
+            self.program_denoise,
+            [(self.vbo, "2f /v", "position_vertices")],
+        )
+
+    def path_trace(self, sample_max, program, tile_list=None, interrupt=None):
+        # tile_list を指定した場合はタイルごとに描画し，interrupt() が True を返したら残りのタイルは
+        # サンプリングせずに前回の累積画像を書き写す（全タイルをサンプリングした場合に True を返す）
+        self.bind_env_map(self.env_map or self.env_map_path)
 
-    def path_trace(self, sample_max, program):
+        program["group_num"].value = (self.width, self.height)
         program["sample_max"].value = sample_max
         program["current_sample"].value = self.current_sample
         program["theta"].value = self.theta
         program["phi"].value = self.phi
         program["move_x"].value = self.move_x
         program["move_y"].value = self.move_y
+        program["bvh_node_count"].value = self.bvh_node_count
+        program["light_sampling"].value = self.light_sampling
+        program["depth_max"].value = self.depth_max
+        program["roulette_depth"].value = self.roulette_depth
+        program["convergence_threshold"].value = self.convergence_threshold
+        program["convergence_sample_min"].value = self.convergence_sample_min
+        program["write_feature"].value = self.denoise_sample_max > 0
 
         program["input_image"].value = Context.TEXTURE_UNIT_INPUT_IMAGE
         program["seed_image"].value = Context.TEXTURE_UNIT_SEED_IMAGE
         program["background_image"].value = Context.TEXTURE_UNIT_BACKGROUND_IMAGE
+        program["moment_image"].value = Context.TEXTURE_UNIT_MOMENT_IMAGE
+        program["scene_image"].value = Context.TEXTURE_UNIT_SCENE_IMAGE
+        program["bvh_image"].value = Context.TEXTURE_UNIT_BVH_IMAGE
+        program["env_conditional_image"].value = (
+            Context.TEXTURE_UNIT_ENV_CONDITIONAL_IMAGE
+        )
+        program["env_marginal_image"].value = Context.TEXTURE_UNIT_ENV_MARGINAL_IMAGE
 
+        if self.fbo is not None:
+            self.fbo.release()
         self.fbo = self.context.framebuffer(
             [
                 self.output_image,
                 self.input_image_list[self.switch],
                 self.seed_image_list[self.switch],
+                self.moment_image_list[self.switch],
+                self.albedo_image,
+                self.normal_image,
             ]
         )
         self.fbo.use()
@@ -170,15 +1105,92 @@ class Context:
             texture=self.seed_image_list[self.switch],
             filter=(moderngl.Context.NEAREST, moderngl.Context.NEAREST),
         ).use(Context.ATTACHMENT_INDEX_SEED_VALUE)
+        self.context.sampler(
+            texture=self.moment_image_list[self.switch],
+            filter=(moderngl.Context.NEAREST, moderngl.Context.NEAREST),
+        ).use(Context.TEXTURE_UNIT_MOMENT_IMAGE)
         self.context.clear()
-        self.vao_path_trace.render(moderngl.Context.TRIANGLES)
+        if tile_list is None:
+            self.vao_path_trace.render(moderngl.Context.TRIANGLES)
+            return True
+
+        # 描画の完了を待たないとコマンドがキューに溜まるだけで，時間の計測も中断もできない
+        completed = True
+        for index, tile in enumerate(tile_list):
+            if completed and index > 0 and interrupt is not None and interrupt():
+                program["sample_max"].value = 0
+                completed = False
+            self.fbo.scissor = tile
+            start = time.perf_counter()
+            self.vao_path_trace.render(moderngl.Context.TRIANGLES)
+            if completed:
+                self.context.finish()
+                self.tile_scheduler.update(
+                    tile[2] * tile[3], sample_max, time.perf_counter() - start
+                )
+        self.fbo.scissor = None
+        return completed
+
+    def path_trace_sliced(self, sample_max, program, interrupt=None):
+        # 1画素あたり sample_max サンプルを，tile_scheduler が決めるサンプル数のスライスに分けてパストレーシングする
+        # スライスごとに累積画像を切り替え，タイルは中央に近い順（または相対誤差の大きい順）に描画する
+        # 最初のスライスで全画素に1回はサンプリングしてから interrupt を確かめる
+        # 収束していない全画素に追加したサンプル数を返す（中断したスライスでは，描画済みのタイルの画素のみサンプル数が多い）
+        current_sample = self.current_sample
+        error = None
+        if self.tile_scheduler.order == "noise" and current_sample > 1:
+            error = self.relative_error()
+        sample_count = 0
+        try:
+            while sample_count < sample_max:
+                size, slice_sample = self.tile_scheduler.plan(sample_max - sample_count)
+                tile_list = self.tile_scheduler.tiles(
+                    self.width, self.height, size, error
+                )
+                self.current_sample = current_sample + sample_count
+                if not self.path_trace(
+                    slice_sample,
+                    program,
+                    tile_list,
+                    interrupt if self.current_sample > 1 else None,
+                ):
+                    break
+                sample_count += slice_sample
+        finally:
+            self.current_sample = current_sample
+        return sample_count
+
+    def relative_error(self):
+        # 直前のパストレーシング結果の，画素ごとの輝度の標準誤差と平均値の比
+        # サンプリングしていない画素は inf，収束済みの画素は 0 とする
+        color = np.frombuffer(
+            self.input_image_list[~self.switch & 1].read(), dtype="f4"
+        ).reshape(self.height, self.width, 4)
+        moment = np.frombuffer(
+            self.moment_image_list[~self.switch & 1].read(), dtype="f4"
+        ).reshape(self.height, self.width, 4)
+        luminance = (
+            0.27 * color[:, :, 0] + 0.67 * color[:, :, 1] + 0.06 * color[:, :, 2]
+        )
+        sample_count = moment[:, :, 1]
+        variance = np.maximum(moment[:, :, 0] - luminance**2, 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            error = np.sqrt(variance / sample_count) / (luminance + 1e-4)
+        error[sample_count == 0] = np.inf
+        error[moment[:, :, 2] > 0.5] = 0
+        return error
 
     def post_process(self, luminance_average, luminance_max, program):
+        program["group_num"].value = (self.width, self.height)
         program["input_image"].value = Context.TEXTURE_UNIT_INPUT_IMAGE
         program["luminance_average"].value = luminance_average
         program["luminance_max"].value = luminance_max
         program["key_value"].value = self.key_value
+        program["gamma"].value = self.gamma
+        program["swap_red_blue"].value = self.codec != "raw"
 
+        if self.fbo is not None:
+            self.fbo.release()
         self.fbo = self.context.framebuffer(
             [
                 self.output_image,
@@ -188,8 +1200,12 @@ class Context:
         )
         self.fbo.use()
         self.switch = ~self.switch & 1
+        # デノイズした場合はその結果をトーンマッピングする
+        input_image = self.input_image_list[self.switch]
+        if self.denoised_image is not None:
+            input_image = self.denoised_image
         self.context.sampler(
-            texture=self.input_image_list[self.switch],
+            texture=input_image,
             filter=(moderngl.Context.NEAREST, moderngl.Context.NEAREST),
         ).use(Context.ATTACHMENT_INDEX_INPUT_COLOR)
         self.context.sampler(
@@ -199,20 +1215,194 @@ class Context:
         self.context.clear()
         self.vao_post_process.render(moderngl.Context.TRIANGLES)
 
-    def read_buffer(self, attachment):
+    def denoise(self):
+        # 直前のパストレーシング結果（raw 画像）を à-trous ウェーブレットで平滑化し，denoised_image とする
+        # タップの間隔を 1, 2, 4, ... 画素と広げながら，denoise_fbo_list の2枚の画像に交互に書き込む
+        # 最後のパスで，画素ごとのサンプル数 / denoise_sample_max の割合で元の画像と混ぜる
+        self.denoised_image = None
+        if (
+            self.denoise_sample_max <= 0
+            or self.accumulated_sample_count >= self.denoise_sample_max
+        ):
+            return
+
+        program = self.program_denoise
+        program["source_image"].value = Context.TEXTURE_UNIT_DENOISE_SOURCE
+        program["raw_image"].value = Context.TEXTURE_UNIT_DENOISE_RAW
+        program["albedo_image"].value = Context.TEXTURE_UNIT_ALBEDO_IMAGE
+        program["normal_image"].value = Context.TEXTURE_UNIT_NORMAL_IMAGE
+        program["moment_image"].value = Context.TEXTURE_UNIT_MOMENT_IMAGE
+        program["sample_count"].value = self.accumulated_sample_count
+        program["sample_max"].value = self.denoise_sample_max
+        program["sigma_color"].value = Context.DENOISE_SIGMA_COLOR
+        program["sigma_normal"].value = Context.DENOISE_SIGMA_NORMAL
+        program["sigma_albedo"].value = Context.DENOISE_SIGMA_ALBEDO
+
+        source = self.input_image_list[~self.switch & 1]
+        source.use(Context.TEXTURE_UNIT_DENOISE_RAW)
+        self.albedo_image.use(Context.TEXTURE_UNIT_ALBEDO_IMAGE)
+        self.normal_image.use(Context.TEXTURE_UNIT_NORMAL_IMAGE)
+        self.moment_image_list[~self.switch & 1].use(Context.TEXTURE_UNIT_MOMENT_IMAGE)
+        with self.measure("denoise", gpu=True):
+            for iteration in range(self.denoise_iterations):
+                fbo = self.denoise_fbo_list[iteration % 2]
+                program["iteration"].value = iteration
+                program["is_last_pass"].value = iteration == self.denoise_iterations - 1
+                source.use(Context.TEXTURE_UNIT_DENOISE_SOURCE)
+                fbo.use()
+                self.vao_denoise.render(moderngl.Context.TRIANGLES)
+                source = fbo.color_attachments[0]
+        self.denoised_image = source
+
+    def output_components(self):
+        # raw は RGBA（ブラウザの ImageData と同じ），それ以外は BGR で読み出す
+        return 4 if self.codec == "raw" else 3
+
+    def read_output(self):
+        # 送信用画像を 8 bit のまま読み出す（上下の反転とチャンネルの並べ替えはシェーダーで済んでいる）
         if self.fbo is None:
             raise RuntimeError("frame buffer object has not been assigned")
 
+        components = self.output_components()
         return np.frombuffer(
             self.fbo.read(
-                components=4,
-                dtype="f4",
-                attachment=attachment,
+                components=components,
+                dtype="f1",
+                attachment=Context.ATTACHMENT_INDEX_OUTPUT_COLOR,
             ),
-            dtype="f4",
+            dtype=np.uint8,
+        ).reshape(self.height, self.width, components)
+
+    def reduce_luminance_numpy(self):
+        # 直前のパストレーシング結果（raw 画像）を CPU に読み出して計算する
+        buffer = np.frombuffer(
+            self.input_image_list[~self.switch & 1].read(), dtype="f4"
         ).reshape(self.height, self.width, 4)
+        luminance = (
+            0.27 * buffer[:, :, 0] + 0.67 * buffer[:, :, 1] + 0.06 * buffer[:, :, 2]
+        )
+        luminance_average = np.exp(
+            np.mean(np.log(np.finfo(np.float32).tiny + luminance))
+        )
+        luminance_max = buffer.max()
+        moment = np.frombuffer(
+            self.moment_image_list[~self.switch & 1].read(), dtype="f4"
+        ).reshape(self.height, self.width, 4)
+        converged_ratio = np.mean(moment[:, :, 2])
+        return luminance_average, luminance_max, converged_ratio
+
+    def reduce_luminance_gpu(self, program):
+        if self.reduction_fbo_list is None:
+            raise RuntimeError("reduction_fbo_list has not been assigned")
+
+        # 直前のパストレーシング結果（raw 画像）を GPU 上で 1x1 まで縮約し，数値のみを読み出す
+        program["source_image"].value = Context.TEXTURE_UNIT_REDUCTION_SOURCE
+        program["moment_image"].value = Context.TEXTURE_UNIT_MOMENT_IMAGE
+        self.moment_image_list[~self.switch & 1].use(Context.TEXTURE_UNIT_MOMENT_IMAGE)
+        source = self.input_image_list[~self.switch & 1]
+        program["is_first_pass"].value = True
+        for fbo in self.reduction_fbo_list:
+            program["source_size"].value = source.size
+            source.use(Context.TEXTURE_UNIT_REDUCTION_SOURCE)
+            fbo.use()
+            self.vao_reduce_luminance.render(moderngl.Context.TRIANGLES)
+            program["is_first_pass"].value = False
+            source = fbo.color_attachments[0]
+
+        log_luminance_sum, luminance_max, converged_count, _ = np.frombuffer(
+            self.reduction_fbo_list[-1].read(components=4, dtype="f4"), dtype="f4"
+        )
+        luminance_average = np.exp(log_luminance_sum / (self.width * self.height))
+        converged_ratio = converged_count / (self.width * self.height)
+        return luminance_average, luminance_max, converged_ratio
+
+    def reduce_luminance(self):
+        if self.gpu_reduction:
+            return self.reduce_luminance_gpu(self.program_reduce_luminance)
+        return self.reduce_luminance_numpy()
+
+    def reduce_convergence_map(self):
+        # REDUCTION_BLOCK_SIZE 四方のブロックごとの収束済みの画素の割合を 0 から 255 で表す（上下は送信用画像に揃える）
+        if self.gpu_reduction:
+            # リダクションの最初のパスの結果がそのままブロックごとの集計になっている
+            fbo = self.reduction_fbo_list[0]
+            block = np.frombuffer(
+                fbo.read(components=4, dtype="f4"), dtype="f4"
+            ).reshape(fbo.height, fbo.width, 4)
+            converged_map = block[:, :, 2] / block[:, :, 3]
+        else:
+            moment = np.frombuffer(
+                self.moment_image_list[~self.switch & 1].read(), dtype="f4"
+            ).reshape(self.height, self.width, 4)
+            size = Context.REDUCTION_BLOCK_SIZE
+            height, width = -(-self.height // size), -(-self.width // size)
+            converged = np.full((height * size, width * size), np.nan, dtype="f4")
+            converged[: self.height, : self.width] = moment[:, :, 2]
+            converged_map = np.nanmean(
+                converged.reshape(height, size, width, size), axis=(1, 3)
+            )
+        return np.flipud(np.rint(converged_map * 255)).astype(np.uint8)
+
+    def adaptive_sample_count(self, sample_max):
+        # 直前のフレームで収束済みの画素に割り当てていたサンプル数を，残りの画素に割り当てる
+        # 1フレームあたりの総サンプル数（GPU の負荷）は均等にサンプリングする場合と変わらない
+        # ただし max_spp を指定した場合は，1画素あたりのサンプル数がそれを超えないようにする
+        if self.convergence_threshold <= 0:
+            return sample_max
+        scale = 1 / max(1 - self.converged_ratio, 1 / Context.ADAPTIVE_SAMPLE_SCALE_MAX)
+        adaptive_sample_max = int(sample_max * scale)
+        if self.max_spp:
+            adaptive_sample_max = min(
+                adaptive_sample_max, int(self.max_spp) - (self.current_sample - 1)
+            )
+        return max(sample_max, adaptive_sample_max)
+
+    @contextlib.contextmanager
+    def measure(self, stage, gpu=False):
+        # with ブロック内の処理時間を stage に加算する（profile が False の場合は何もしない）
+        if not self.profile:
+            yield
+            return
+        if not gpu:
+            start = time.perf_counter()
+            yield
+            self.timing_dict[stage] = (
+                self.timing_dict.get(stage, 0.0) + (time.perf_counter() - start) * 1000
+            )
+            return
+
+        # タイマークエリは段階ごとに1つを使い回す（同じフレームで再び使う場合は先に結果を回収する）
+        if stage in self.query_pending_set:
+            self.collect_query(stage)
+        query = self.query_dict.get(stage)
+        if query is None:
+            query = self.context.query(time=True)
+            self.query_dict[stage] = query
+        with query:
+            yield
+        self.query_pending_set.add(stage)
+
+    def collect_query(self, stage):
+        # GPU の処理が終わるまで待って結果を読み出す
+        # llvmpipe では結果が得られない場合に 2^32 - 1 [ns] が返るため，その値は捨てる
+        self.query_pending_set.discard(stage)
+        elapsed = self.query_dict[stage].elapsed
+        if elapsed < 2**32 - 1:
+            self.timing_dict[stage] = self.timing_dict.get(stage, 0.0) + elapsed / 1e6
 
-    def render(self, sample_max):
+    def collect_timings(self):
+        # 前回の呼び出しから計測した段階ごとの時間 [ms] を返す
+        # タイマークエリの回収は GPU と同期するため，読み出しの後に呼び出す
+        for stage in list(self.query_pending_set):
+            self.collect_query(stage)
+        timing_dict = self.timing_dict
+        self.timing_dict = {}
+        return timing_dict
+
+    def render(self, sample_max, readback=True, interrupt=None):
+        # 収束していない全画素に追加したサンプル数（名目のサンプル数）を返す
+        # 適応サンプリングでは収束済みの画素の分を割り当てるため sample_max より多く，tile_scheduler が
+        # ある場合に interrupt() が True を返すと残りのスライスを打ち切るため少なくなる
         if self.program_path_trace is None:
             raise RuntimeError("program_path_trace has not been created")
         if self.program_post_process is None:
@@ -221,6 +1411,8 @@ class Context:
             raise RuntimeError("vao_path_trace has not been assigned")
         if self.vao_post_process is None:
             raise RuntimeError("vao_path_process has not been assigned")
+        if self.vao_reduce_luminance is None:
+            raise RuntimeError("vao_reduce_luminance has not been assigned")
         if self.output_image is None:
             raise RuntimeError("output_image has not been assigned")
         if self.input_image_list is None:
@@ -228,33 +1420,213 @@ class Context:
         if self.seed_image_list is None:
             raise RuntimeError("seed_image_list has not been assigned")
 
+        if self.current_sample == 1:
+            self.converged_ratio = 0.0
+        self.preview_image = None
+        adaptive_sample_max = self.adaptive_sample_count(sample_max)
+        with self.measure("path_trace", gpu=True):
+            if self.tile_scheduler is None or adaptive_sample_max == 0:
+                self.path_trace(adaptive_sample_max, self.program_path_trace)
+                sample_count = adaptive_sample_max
+            else:
+                sample_count = self.path_trace_sliced(
+                    adaptive_sample_max, self.program_path_trace, interrupt
+                )
+        # current_sample は呼び出し側が進めるため，このフレームのサンプルを足した数を別に保持する
+        self.accumulated_sample_count = self.current_sample - 1 + sample_count
+
+        # GPU がパストレーシングを実行している間に，前フレームの読み出し結果をエンコードする
+        self.encode_pending()
+
+        # GPU で縮約する場合，CPU の経過時間にはパストレーシングの完了待ちが含まれるためタイマークエリで計測する
+        with self.measure("reduce_luminance", gpu=self.gpu_reduction):
+            (
+                self.luminance_average,
+                self.luminance_max,
+                self.converged_ratio,
+            ) = self.reduce_luminance()
+            if self.convergence_threshold > 0:
+                self.convergence_map = self.reduce_convergence_map()
+
+        self.denoise()
+
+        with self.measure("post_process", gpu=True):
+            self.post_process(
+                self.luminance_average, self.luminance_max, self.program_post_process
+            )
+
+        self.switch = ~self.switch & 1
+
+        if readback:
+            self.read_output_async()
+        return sample_count
+
+    def render_preview(self, sample_max):
+        # 解像度を preview_scale 倍に落としてパストレーシングし，GPU 上で拡大して送信用画像に書き込む
+        # カメラなどが前回から変わっていなければ，プレビューの累積画像にサンプルを足していく
+        width = max(1, round(self.width * self.preview_scale))
+        height = max(1, round(self.height * self.preview_scale))
+        camera_list = [
+            name for name in Session.ACCUMULATION_PARAMETERS if name != "resolution"
+        ]
+        session = self.session
+        preview_session = self.preview_session
+        if preview_session is None:
+            preview_session = Session(width, height, self.seed)
+            self.preview_session = preview_session
+        if any(
+            getattr(preview_session, name) != getattr(self, name)
+            for name in camera_list
+        ):
+            preview_session.current_sample = 1
+        for name in camera_list + list(Session.DISPLAY_PARAMETERS):
+            setattr(preview_session, name, getattr(self, name))
+
+        self.use_session(preview_session)
+        try:
+            if self.output_image is None:
+                self.create_textures()
+            self.resize(width, height)
+            self.current_sample += self.render(sample_max, readback=False)
+            luminance_average, luminance_max = (
+                self.luminance_average,
+                self.luminance_max,
+            )
+            # デノイズした場合はその結果を拡大する
+            preview_image = self.input_image_list[~self.switch & 1]
+            if self.denoised_image is not None:
+                preview_image = self.denoised_image
+        finally:
+            self.use_session(session)
+
+        self.luminance_average = luminance_average
+        self.luminance_max = luminance_max
+        self.converged_ratio = 0.0
+        self.convergence_map = None
+        self.preview_image = preview_image
+        self.encode_pending()
+        with self.measure("upscale", gpu=True):
+            self.upscale()
+        self.read_output_async()
+
+    def upscale(self):
+        # プレビューの累積画像を線形補間で拡大しながらトーンマッピングする
+        program = self.program_post_process
+        program["group_num"].value = (self.width, self.height)
+        program["input_image"].value = Context.TEXTURE_UNIT_INPUT_IMAGE
+        program["luminance_average"].value = self.luminance_average
+        program["luminance_max"].value = self.luminance_max
+        program["key_value"].value = self.key_value
+        program["gamma"].value = self.gamma
+        program["swap_red_blue"].value = self.codec != "raw"
+
         if self.fbo is not None:
             self.fbo.release()
+        self.fbo = self.context.framebuffer([self.output_image])
+        self.fbo.use()
+        self.context.sampler(
+            texture=self.preview_image,
+            filter=(moderngl.Context.LINEAR, moderngl.Context.LINEAR),
+            repeat_x=False,
+            repeat_y=False,
+        ).use(Context.TEXTURE_UNIT_INPUT_IMAGE)
+        self.context.clear()
+        self.vao_post_process.render(moderngl.Context.TRIANGLES)
 
-        self.path_trace(sample_max, self.program_path_trace)
+    def adjust_preview_scale(self, frame_time):
+        # 1フレームにかかった時間 frame_time [s] に応じて，プレビューの解像度を縦横 2 倍ずつ調整する
+        if frame_time > self.preview_frame_time:
+            self.preview_scale = max(self.preview_scale / 2, Context.PREVIEW_SCALE_MIN)
+        elif frame_time * 4 < self.preview_frame_time:
+            self.preview_scale = min(self.preview_scale * 2, 1)
 
-        buffer = self.read_buffer(Context.ATTACHMENT_INDEX_INPUT_COLOR)
-        luminance = (
-            0.27 * buffer[:, :, 0] + 0.67 * buffer[:, :, 1] + 0.06 * buffer[:, :, 2]
-        )
-        luminance_average = np.exp(
-            np.mean(np.log(np.finfo(np.float32).tiny + luminance))
-        )
-        luminance_max = buffer.max()
+    def redisplay(self):
+        # 累積画像はそのままに，トーンマッピングとガンマ補正のみをやり直す
+        if self.luminance_average is None:
+            raise RuntimeError("no frame has been rendered")
+
+        if self.preview_image is not None:
+            with self.measure("upscale", gpu=True):
+                self.upscale()
+            return
 
-        self.post_process(luminance_average, luminance_max, self.program_post_process)
+        self.denoise()
+
+        with self.measure("post_process", gpu=True):
+            self.post_process(
+                self.luminance_average, self.luminance_max, self.program_post_process
+            )
 
         self.switch = ~self.switch & 1
 
+    def encode_pending(self):
+        # 前フレームの読み出し結果をエンコードする（readback_buffer_count - 1 フレームまでは待たせる）
+        while (
+            self.readback_pending
+            and len(self.readback_pending) >= self.readback_buffer_count - 1
+        ):
+            self.encode_readback()
+
+    def read_output_async(self):
+        # 送信用画像をピクセルバッファへ非同期に読み出す（CPU は完了を待たない）
+        if self.readback_buffer_list:
+            buffer = self.readback_buffer_list[self.readback_index]
+            components = self.output_components()
+            self.fbo.read_into(
+                buffer,
+                components=components,
+                attachment=Context.ATTACHMENT_INDEX_OUTPUT_COLOR,
+                dtype="f1",
+            )
+            self.readback_pending.append((buffer, components, self.codec, self.quality))
+            self.readback_index = (self.readback_index + 1) % len(
+                self.readback_buffer_list
+            )
+
+    def encode_readback(self):
+        buffer, components, codec, quality = self.readback_pending.popleft()
+        buffer = np.frombuffer(
+            buffer.read(size=self.height * self.width * components), dtype=np.uint8
+        ).reshape(self.height, self.width, components)
+        self.readback_binary.append(self.encode_buffer(buffer, codec, quality))
+
+    def encode_buffer(self, buffer, codec=None, quality=None):
+        # codec と quality を省略した場合は，有効なセッションのものを用いる
+        # エンコードを別のスレッドで行う場合は，読み出した時点のものを渡すこと
+        if codec is None:
+            codec, quality = self.codec, self.quality
+        if codec not in Context.CODEC_DICT:
+            raise ValueError(f"unknown codec: {codec}")
+        extension, quality_flag = Context.CODEC_DICT[codec]
+        if extension is None:
+            return buffer.tobytes()
+        parameters = []
+        if quality_flag is not None and quality is not None:
+            parameters = [quality_flag, int(quality)]
+        is_success, binary = cv2.imencode(extension, buffer, parameters)
+        if not is_success:
+            raise RuntimeError(f"failed to encode frame: {codec}")
+        with io.BytesIO(binary) as b:
+            return b.getvalue()
+
     def get_buffer(self):
-        buffer = self.read_buffer(Context.ATTACHMENT_INDEX_OUTPUT_COLOR)
-        buffer = np.flipud(buffer)
-        buffer = cv2.cvtColor(buffer, cv2.COLOR_RGBA2BGRA)
-        buffer = (buffer * 255).astype(np.uint8)
-        return buffer
+        with self.measure("readback"):
+            return self.read_output()
 
     def get_binary(self):
         buffer = self.get_buffer()
-        is_success, binary = cv2.imencode(".jpg", buffer)
-        with io.BytesIO(binary) as b:
-            return b.getvalue()
+        return self.encode_buffer(buffer)
+
+    def get_binary_async(self):
+        # readback_buffer_count - 1 フレーム前のエンコード結果を返す（まだ無い場合は None）
+        if not self.readback_binary:
+            return None
+        return self.readback_binary.popleft()
+
+    def flush_binary_async(self):
+        # 読み出し待ちのフレームをすべてエンコードして返す（最後のフレームを送信する際に用いる）
+        while self.readback_pending:
+            self.encode_readback()
+        binary_list = list(self.readback_binary)
+        self.readback_binary.clear()
+        return binary_list
@@ -1,92 +1,325 @@
+import argparse
 import asyncio
+import functools
 import json
+import os
+import queue
+import time
+from urllib.parse import parse_qs, urlparse
 
 from websockets.server import serve
 
+from farm import RenderFarm
+from metrics import Metrics
+from protocol import CODEC_LIST, pack_frame
 from render import Context
+from worker import RenderWorker
+
+
+# クライアントが切り替えられる環境マップを格納するディレクトリ
+ENV_MAP_DIR = "assets/hdr"
+# クライアントが指定できる最大の解像度
+RESOLUTION_MAX = (1920, 1080)
+# 計測結果の要約をクライアントに送る間隔 [s]
+METRICS_INTERVAL = 1.0
+
+
+def list_env_maps():
+    return sorted(name for name in os.listdir(ENV_MAP_DIR) if name.endswith(".hdr"))
+
+
+def parse_resolution(resolution):
+    # [幅, 高さ] を検証して返す（不正な場合は None）
+    try:
+        width, height = (int(value) for value in resolution)
+    except (TypeError, ValueError):
+        return None
+    if not (0 < width <= RESOLUTION_MAX[0] and 0 < height <= RESOLUTION_MAX[1]):
+        return None
+    return width, height
+
+
+def parse_quality(quality):
+    # 1 から 100 の整数に丸めて返す（None の場合はコーデックの既定値，不正な場合は False）
+    if quality is None:
+        return None
+    try:
+        quality = int(quality)
+    except (TypeError, ValueError):
+        return False
+    return min(max(quality, 1), 100)
+
+
+def create_context(**kwargs):
+    # 既定では従来と同じ設定でレンダリングし，各機能はコマンドライン引数で個別に有効にする
+    # （RenderWorker と RenderFarm には functools.partial で引数を渡す）
+    # 復号した環境マップと累積分布関数の表は ~/.cache に保存し，再起動後はメモリマップで読み込む
+    kwargs = {
+        "width": 960,
+        "height": 540,
+        "sample_per_frame": 64,
+        "env_map_cache_dir": os.path.join(
+            os.environ.get("XDG_CACHE_HOME", "~/.cache"),
+            "vc2-remote-rendering",
+            "env_map",
+        ),
+        **kwargs,
+    }
+    ctx = Context(**kwargs)
+    ctx.bind_data(
+        env_map_path=os.path.join(ENV_MAP_DIR, "museum_of_ethnography_1k.hdr")
+    )
+    ctx.create_program()
+    return ctx
 
 
 class WebSocket:
-    def __init__(self, context):
-        self.context = context
+    def __init__(self, worker, max_sessions=4, record_path=None):
+        self.worker = worker
+        # 同時に接続できるクライアント数（超えた場合は接続を拒否する）
+        self.max_sessions = max_sessions
+        # record_path を指定した場合，クライアントから届いたメッセージを時刻とともに JSON Lines で書き出す
+        # （loadtest.py --replay で同じ操作を再現できる）
+        self.record_file = None
+        if record_path is not None:
+            self.record_file = open(record_path, "w", encoding="utf-8")
+        self.start_time = time.perf_counter()
+        self.connection_count = 0
+        self.frame_queue_dict = {}
+        # コネクションごとのパラメータの世代番号（メッセージを受け取るたびに増える）
+        self.generation_dict = {}
+        # 全コネクションのフレームの段階ごとの時間
+        self.metrics = Metrics()
+
+    def deliver(self, key, frame):
+        # 古い世代のパラメータでレンダリングされたフレームは送らない
+        frame_queue = self.frame_queue_dict.get(key)
+        if frame_queue is None or frame["generation"] != self.generation_dict[key]:
+            return
+        # 送信待ちのフレームは最新のもののみを残す
+        if frame_queue.full():
+            frame_queue.get_nowait()
+        frame_queue.put_nowait(frame)
 
-    async def task(self, websocket):
-        # キャンセルされるまでサンプリングとレンダリング結果画像の送信を繰り返す
-        i = 0
+    async def dispatch(self):
+        # レンダリングプロセスから届いたフレームを各コネクションに振り分ける
+        loop = asyncio.get_running_loop()
         while True:
-            print(["-", "/", "|", "\\"][i % 4], "\r", end="")
             try:
-                self.context.current_sample = i * self.context.sample_per_frame + 1
-                i += 1
-                next_frame = i * self.context.sample_per_frame
-
-                sample_max = self.context.sample_per_frame
-                if self.context.max_spp:
-                    if next_frame > int(self.context.max_spp):
-                        sample_max = (
-                            int(self.context.max_spp) % self.context.sample_per_frame
-                        )
-                        next_frame = int(self.context.max_spp)
-
-                self.context.render(sample_max)
-
-                await asyncio.gather(
-                    # レンダリング結果画像を送信する（識別子：0000）
-                    websocket.send(b"0000" + self.context.get_binary()),
-                    # 現在の1画素あたりのサンプル数を送信する（識別子：0001）
-                    websocket.send(b"0001" + bytes(next_frame)),
-                )
-
-                if self.context.max_spp:
-                    if next_frame >= int(self.context.max_spp):
-                        break
-            except RuntimeError as e:
-                print("Runtime Error:", e)
-                break
-            except ValueError as e:
-                print("ValueError:", e)
-                break
+                key, frame = await loop.run_in_executor(None, self.worker.receive, 1.0)
+            except queue.Empty:
+                continue
+            self.deliver(key, frame)
+
+    async def task(self, websocket, key):
+        # コネクションが閉じられるまでレンダリング結果画像の送信を繰り返す
+        frame_queue = self.frame_queue_dict[key]
+        while True:
+            frame = await frame_queue.get()
+            if frame["generation"] != self.generation_dict[key]:
+                continue
+            # ヘッダ（世代番号，サンプル数など）と画像を1つのメッセージで送信する
+            start = time.perf_counter()
+            await websocket.send(pack_frame(frame))
+            self.metrics.record(
+                {**frame["timings"], "send": (time.perf_counter() - start) * 1000}
+            )
+
+    async def metrics_task(self, websocket):
+        # 計測結果の要約を METRICS_INTERVAL ごとに送る（{"metrics": true} を送ったクライアントのみ）
+        while True:
+            await websocket.send(json.dumps({"metrics": self.metrics.summary()}))
+            await asyncio.sleep(METRICS_INTERVAL)
+
+    async def serve_metrics(self, reader, writer):
+        # Prometheus 形式の計測結果を返す HTTP エンドポイント（パスによらず同じ内容）
+        try:
+            while (await reader.readline()).strip():
+                pass
+            body = self.metrics.prometheus().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                + f"Content-Length: {len(body)}\r\n".encode()
+                + b"Connection: close\r\n\r\n"
+                + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
 
     async def echo(self, websocket):
-        current_task = None
         print("init")
+
+        if len(self.frame_queue_dict) >= self.max_sessions:
+            # 1013: Try Again Later
+            await websocket.close(code=1013, reason="too many sessions")
+            return
+
+        # 接続ごとにセッションを生成する（?priority=2 のように優先度を指定できる）
+        query = parse_qs(urlparse(websocket.path).query)
+        try:
+            priority = float(query.get("priority", ["1"])[0])
+        except ValueError:
+            priority = 0
+        if not priority > 0:
+            # 1008: Policy Violation
+            await websocket.close(code=1008, reason="invalid priority")
+            return
+
+        key = id(websocket)
+        client = self.connection_count
+        self.connection_count += 1
+        self.frame_queue_dict[key] = asyncio.Queue(maxsize=1)
+        self.generation_dict[key] = 0
+        self.worker.open(key, priority)
+
+        # 切り替えられる環境マップの一覧を知らせる（フレーム以外のメッセージは JSON のテキスト）
+        await websocket.send(json.dumps({"envMaps": list_env_maps()}))
+
+        # 送信タスクはコネクションごとに1つだけ実行し続ける
+        current_task = asyncio.create_task(self.task(websocket, key))
+        print("task assigned")
         print("current_task: ", current_task)
+        metrics_task = None
 
-        # クライアントからの接続要求を待ち受ける
-        while True:
-            message = json.loads(await websocket.recv())
-            if "theta" in message:
-                self.context.theta = message["theta"]
-            if "phi" in message:
-                self.context.phi = message["phi"]
-            if "moveX" in message:
-                self.context.move_x = message["moveX"]
-            if "moveY" in message:
-                self.context.move_y = message["moveY"]
-            if "maxSpp" in message:
-                self.context.max_spp = message["maxSpp"]
-            if "keyValue" in message:
-                self.context.key_value = message["keyValue"]
-
-            for task in asyncio.all_tasks():
-                if task.get_coro().__name__ == "task" and not task.done():
-                    task.cancel()
-
-            # レンダリングタスクを実行する
-            current_task = asyncio.create_task(self.task(websocket))
-
-            print("task assigned")
-            print("current_task: ", current_task)
-
-    async def main(self, host, port):
+        try:
+            # クライアントからの接続要求を待ち受ける
+            while True:
+                message = json.loads(await websocket.recv())
+                if self.record_file is not None:
+                    record = {
+                        "client": client,
+                        "time": time.perf_counter() - self.start_time,
+                        "message": message,
+                    }
+                    self.record_file.write(json.dumps(record) + "\n")
+                    self.record_file.flush()
+                parameters = {}
+                if "theta" in message:
+                    parameters["theta"] = message["theta"]
+                if "phi" in message:
+                    parameters["phi"] = message["phi"]
+                if "moveX" in message:
+                    parameters["move_x"] = message["moveX"]
+                if "moveY" in message:
+                    parameters["move_y"] = message["moveY"]
+                if "maxSpp" in message:
+                    parameters["max_spp"] = message["maxSpp"]
+                if "keyValue" in message:
+                    parameters["key_value"] = message["keyValue"]
+                if "gamma" in message:
+                    parameters["gamma"] = message["gamma"]
+                if "envMap" in message:
+                    # 任意のファイルを読ませないよう，一覧にあるファイル名のみを受け付ける
+                    if message["envMap"] in list_env_maps():
+                        parameters["env_map"] = os.path.join(
+                            ENV_MAP_DIR, message["envMap"]
+                        )
+                if "resolution" in message:
+                    resolution = parse_resolution(message["resolution"])
+                    if resolution is not None:
+                        parameters["resolution"] = resolution
+                if "codec" in message:
+                    # jpeg と webp は quality で品質を指定できる（png は可逆，raw は無圧縮の RGBA）
+                    if message["codec"] in CODEC_LIST:
+                        parameters["codec"] = message["codec"]
+                if "quality" in message:
+                    quality = parse_quality(message["quality"])
+                    if quality is not False:
+                        parameters["quality"] = quality
+                if "preset" in message:
+                    # 画質のプリセットは反射の回数のパラメータに展開する（サンプリングをやり直す）
+                    if message["preset"] in Context.PRESET_DICT:
+                        parameters.update(Context.PRESET_DICT[message["preset"]])
+                if "metrics" in message:
+                    # 計測結果の送信はパラメータではないため，世代番号は進めない
+                    if message["metrics"] and metrics_task is None:
+                        metrics_task = asyncio.create_task(self.metrics_task(websocket))
+                    elif not message["metrics"] and metrics_task is not None:
+                        metrics_task.cancel()
+                        metrics_task = None
+                    if not parameters:
+                        continue
+
+                # パラメータを更新して世代番号を進める（タスクのキャンセルはしない）
+                # カメラが変わった場合，サンプリングはレンダリングプロセスで次のフレームの区切りからやり直される
+                # トーンマッピングなど表示のみが変わった場合は，累積画像を保ったまま送り直される
+                self.generation_dict[key] += 1
+                self.worker.submit(key, self.generation_dict[key], parameters)
+        finally:
+            current_task.cancel()
+            if metrics_task is not None:
+                metrics_task.cancel()
+            self.frame_queue_dict.pop(key, None)
+            self.generation_dict.pop(key, None)
+            self.worker.close(key)
+
+    async def main(self, host, port, metrics_port=None):
+        dispatch_task = asyncio.create_task(self.dispatch())
+        if metrics_port is not None:
+            metrics_server = await asyncio.start_server(
+                self.serve_metrics, host, metrics_port
+            )
+            print("Metrics at: ", f"http://{host}:{metrics_port}/metrics")
         async with serve(self.echo, host, port):
             print("Listening at: ", f"ws://{host}:{port}")
             await asyncio.Future()  # run forever
+        dispatch_task.cancel()
+        if metrics_port is not None:
+            metrics_server.close()
 
 
 if __name__ == "__main__":
-    ctx = Context(width=960, height=540, sample_per_frame=64)
-    ctx.bind_data(env_map_path="assets/hdr/museum_of_ethnography_1k.hdr")
-    ctx.create_program()
-    ws = WebSocket(ctx)
-    asyncio.run(ws.main("127.0.0.1", 8030))
+    parser = argparse.ArgumentParser()
+    # GPU の無いノードでは，複数のプロセスにサンプリングを分配してコアを使い切る
+    parser.add_argument("--farm-workers", type=int, default=0)
+    parser.add_argument("--threads-per-worker", type=int, default=None)
+    # 指定した場合は，段階ごとの時間を Prometheus 形式で返す HTTP エンドポイントを開く
+    parser.add_argument("--metrics-port", type=int, default=None)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8030)
+    parser.add_argument("--max-sessions", type=int, default=4)
+    # 指定した場合は，クライアントから届いたメッセージを時刻とともに書き出す
+    parser.add_argument("--record", default=None)
+    # 以下は Context の機能で，既定ではいずれも無効（個別に有効にして計測や切り戻しができる）
+    # 輝度に対する標準誤差がこの割合以下になった画素は収束済みとし，残りの画素にサンプルを回す（例: 0.02）
+    parser.add_argument("--convergence-threshold", type=float, default=0.0)
+    # f2 の場合は環境マップを半精度で GPU に置き，転送量と VRAM を半分にする
+    parser.add_argument("--env-map-dtype", choices=["f4", "f2"], default="f4")
+    # カメラの操作中と止まってからこの秒数の間は，30 fps に収まる解像度のプレビューを送る（例: 0.3）
+    parser.add_argument("--preview-delay", type=float, default=0.0)
+    # 訪れたカメラの累積画像をこのバイト数までメモリに保持し（例: 536870912），
+    # --accumulation-cache-spill の場合は溢れたものを一時ディレクトリに書き出す
+    parser.add_argument("--accumulation-cache-budget", type=int, default=0)
+    parser.add_argument("--accumulation-cache-spill", action="store_true")
+    # 段階ごとの時間を計測し，メトリクスに含める
+    parser.add_argument("--profile", action="store_true")
+    # 前回送った画像との PSNR がこの値 [dB] 以上のフレームは送らない（例: 45）
+    parser.add_argument("--frame-skip-psnr", type=float, default=0.0)
+    # サンプル数がこの値に達するまでデノイズする（例: 256）
+    parser.add_argument("--denoise-sample-max", type=int, default=0)
+    # パストレーシングを1回の描画がこの秒数に収まるタイルに分け，届いたリクエストをフレームの途中で反映する（例: 0.05）
+    parser.add_argument("--dispatch-time-budget", type=float, default=0.0)
+    args = parser.parse_args()
+
+    context_factory = functools.partial(
+        create_context,
+        convergence_threshold=args.convergence_threshold,
+        env_map_dtype=args.env_map_dtype,
+        preview_delay=args.preview_delay,
+        accumulation_cache_budget=args.accumulation_cache_budget,
+        accumulation_cache_spill=args.accumulation_cache_spill,
+        profile=args.profile,
+        frame_skip_psnr=args.frame_skip_psnr,
+        denoise_sample_max=args.denoise_sample_max,
+        dispatch_time_budget=args.dispatch_time_budget,
+    )
+    farm = None
+    if args.farm_workers > 0:
+        farm = RenderFarm(context_factory, args.farm_workers, args.threads_per_worker)
+        farm.start()
+    worker = RenderWorker(context_factory, farm)
+    worker.start()
+    ws = WebSocket(worker, max_sessions=args.max_sessions, record_path=args.record)
+    asyncio.run(ws.main(args.host, args.port, args.metrics_port))
@@ -0,0 +1,358 @@
+import itertools
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+
+def downsample(buffer, factor=8):
+    # 送信用画像を縦横 1/factor に縮小する（フレームの差を安価に比べるため）
+    height, width = buffer.shape[:2]
+    return cv2.resize(
+        buffer,
+        (max(1, width // factor), max(1, height // factor)),
+        interpolation=cv2.INTER_AREA,
+    )
+
+
+def psnr(image1, image2):
+    # 8 bit 画像どうしの PSNR [dB]（同じ画像の場合は inf）
+    mse = np.mean((image1.astype(np.float32) - image2.astype(np.float32)) ** 2)
+    if mse == 0:
+        return float("inf")
+    return float(10 * np.log10(255**2 / mse))
+
+
+class RenderWorker:
+    # 同時にエンコード中にできるフレーム数（これを超えるとレンダリングを待たせる）
+    ENCODE_QUEUE_MAX = 2
+
+    def __init__(self, context_factory, farm=None):
+        # moderngl は描画や読み出しの間 GIL を解放しないため，スレッドではイベントループが止まってしまう
+        # そこで GL コンテキストを専有する子プロセスでレンダリングし，キューで受け渡しをする
+        # farm（開始済みの RenderFarm）を渡すと，サンプリングを複数のプロセスに分配する
+        mp_context = multiprocessing.get_context("spawn")
+        self.request_queue = mp_context.Queue()
+        self.frame_queue = mp_context.Queue()
+        self.process = mp_context.Process(
+            target=RenderWorker.run,
+            args=(context_factory, self.request_queue, self.frame_queue, farm),
+            daemon=True,
+        )
+
+    def start(self):
+        self.process.start()
+
+    def stop(self, timeout=None):
+        # timeout [s] 以内に終わらない場合（描画中のフレームが長い場合など）は強制終了する
+        self.request_queue.put(None)
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+    def open(self, key, priority=1):
+        # key に対応するセッションを生成する（priority が大きいほど多くのサンプルを割り当てる）
+        self.request_queue.put(("open", key, priority))
+
+    def submit(self, key, generation, parameters):
+        # Context の属性を更新し，次のフレームの区切りでサンプリングをやり直す
+        # key はフレームの送信先の識別子，generation はパラメータの更新ごとに増える世代番号
+        self.request_queue.put(("submit", key, generation, parameters))
+
+    def close(self, key):
+        # key に対応するセッションを破棄し，GPU 資源を解放する
+        self.request_queue.put(("close", key))
+
+    def receive(self, timeout=None):
+        # (key, フレーム) を返す
+        # フレームは世代番号やサンプル数，エンコード済み画像 (payload) などを持つ辞書
+        return self.frame_queue.get(timeout=timeout)
+
+    @staticmethod
+    def run(context_factory, request_queue, frame_queue, farm=None):
+        context = context_factory()
+        executor = ThreadPoolExecutor()
+        encode_queue = deque()
+        scheduler = Scheduler()
+        session_dict = {}
+        spp_dict = {}
+        frame_id_dict = {}
+        generation_dict = {}
+        # カメラなどが最後に変わった時刻（preview_delay の間はプレビューをレンダリングする）
+        moved_dict = {}
+        # 最後に送った画像の縮小版，送った時刻と世代番号（frame_skip_psnr が 0 の場合は使わない）
+        sent_dict = {}
+        redisplay_set = set()
+        seed_counter = itertools.count(1)
+
+        def encode(buffer, codec, quality):
+            start = time.perf_counter()
+            binary = context.encode_buffer(buffer, codec, quality)
+            return binary, time.perf_counter() - start
+
+        def forward(block):
+            # エンコードが完了したフレームを順番通りに送り出す
+            while encode_queue and (block or encode_queue[0][2].done()):
+                key, frame, future = encode_queue.popleft()
+                frame["payload"], encode_time = future.result()
+                frame["encode_time"] = encode_time * 1000
+                if context.profile:
+                    frame["timings"]["encode"] = frame["encode_time"]
+                frame_queue.put((key, frame))
+
+        def similar(key, mip):
+            # 前回送った画像との PSNR が frame_skip_psnr [dB] 以上であれば True を返す
+            # 世代が変わった後の最初のフレームと，keyframe_interval [s] 送っていない場合は送る
+            sent = sent_dict.get(key)
+            return (
+                sent is not None
+                and sent[2] == generation_dict[key]
+                and time.perf_counter() - sent[1] < context.keyframe_interval
+                and sent[0].shape == mip.shape
+                and psnr(sent[0], mip) >= context.frame_skip_psnr
+            )
+
+        def emit(key, start, force=True):
+            # 有効なセッションの送信用画像を読み出し，スレッドプールでエンコードする
+            # エンコードしている間に，次のフレームのレンダリングを進める
+            # force が False の場合，前回送った画像とほとんど変わらなければ送らない
+            # （エンコードと送信を省いた分の時間は，そのまま次のフレームのレンダリングに回る）
+            buffer = context.get_buffer()
+            render_time = time.perf_counter() - start
+            timing_dict = context.collect_timings()
+            if context.frame_skip_psnr > 0:
+                mip = downsample(buffer)
+                if not force and similar(key, mip):
+                    return
+                sent_dict[key] = (mip, time.perf_counter(), generation_dict[key])
+            convergence_map = context.convergence_map
+            if convergence_map is None:
+                convergence_map = np.zeros((0, 0), dtype=np.uint8)
+            frame_id_dict[key] += 1
+            frame = {
+                "codec": context.codec,
+                "frame_id": frame_id_dict[key],
+                "generation": generation_dict[key],
+                "spp": spp_dict[key],
+                "width": context.width,
+                "height": context.height,
+                "render_time": render_time * 1000,
+                "map_width": convergence_map.shape[1],
+                "map_height": convergence_map.shape[0],
+                "converged": float(context.converged_ratio),
+                "convergence_map": convergence_map.tobytes(),
+                # 段階ごとの時間 [ms]（Context の profile が True の場合のみ）
+                "timings": timing_dict,
+            }
+            if context.profile:
+                frame["timings"]["render"] = frame["render_time"]
+            # エンコードの間に別のセッションに切り替わるため，コーデックと品質はここで渡す
+            encode_queue.append(
+                (
+                    key,
+                    frame,
+                    executor.submit(encode, buffer, context.codec, context.quality),
+                )
+            )
+            forward(len(encode_queue) >= RenderWorker.ENCODE_QUEUE_MAX)
+
+        def is_finished(key):
+            # 最大サンプル数に達したか，適応サンプリングで全画素が収束したか
+            if context.max_spp and spp_dict[key] >= int(context.max_spp):
+                return True
+            return context.converged_ratio >= 1
+
+        def discard(key):
+            # エンコード中のフレームは古いパラメータのものなので破棄する
+            for entry in [entry for entry in encode_queue if entry[0] == key]:
+                encode_queue.remove(entry)
+
+        def open_session(key, priority):
+            if key in session_dict:
+                return
+            session_dict[key] = context.create_session(seed=next(seed_counter))
+            spp_dict[key] = 0
+            frame_id_dict[key] = 0
+            generation_dict[key] = 0
+            moved_dict[key] = -float("inf")
+            scheduler.add(key, priority)
+
+        def update_session(key, generation, parameters):
+            open_session(key, 1)
+            context.use_session(session_dict[key])
+            session = context.session
+            accumulation_changed = any(
+                name in session.ACCUMULATION_PARAMETERS for name in parameters
+            )
+            if accumulation_changed:
+                # 変わる前のカメラなどでの累積画像をキャッシュに退避する
+                context.save_accumulation(spp_dict[key])
+            for name, value in parameters.items():
+                setattr(context, name, value)
+            generation_dict[key] = generation
+            discard(key)
+
+            if accumulation_changed:
+                # 以前に訪れたカメラなどであれば，キャッシュした累積画像からすぐに再開する
+                # そうでなければ，次のフレームの区切りでサンプリングをやり直す
+                spp_dict[key] = context.restore_accumulation()
+                if spp_dict[key] > 0:
+                    redisplay_set.add(key)
+                else:
+                    moved_dict[key] = time.perf_counter()
+                    redisplay_set.discard(key)
+            elif any(name in session.DISPLAY_PARAMETERS for name in parameters):
+                # 表示のみが変わった場合は，累積画像はそのままに post_process のみやり直す
+                if spp_dict[key] > 0:
+                    redisplay_set.add(key)
+            scheduler.wake(key)
+
+        while True:
+            # 届いているリクエストをすべて処理する（実行可能なセッションが無ければ届くまで待つ）
+            # 連続して届いたパラメータの更新はまとめて反映され，サンプリングのやり直しは1回で済む
+            request_list = []
+            if not scheduler.runnable():
+                forward(True)
+                request_list.append(request_queue.get())
+            while not request_queue.empty():
+                request_list.append(request_queue.get())
+            if None in request_list:
+                break
+
+            for request in request_list:
+                if request[0] == "open":
+                    _, key, priority = request
+                    open_session(key, priority)
+                elif request[0] == "submit":
+                    _, key, generation, parameters = request
+                    update_session(key, generation, parameters)
+                elif request[0] == "close":
+                    _, key = request
+                    if key in session_dict:
+                        discard(key)
+                        context.release_session(session_dict.pop(key))
+                        if farm is not None:
+                            farm.close(key)
+                        spp_dict.pop(key)
+                        frame_id_dict.pop(key)
+                        generation_dict.pop(key)
+                        moved_dict.pop(key)
+                        sent_dict.pop(key, None)
+                        redisplay_set.discard(key)
+                        scheduler.remove(key)
+
+            # 表示のみが変わったセッションは，サンプリングを待たずにすぐ送り直す
+            for key in redisplay_set:
+                context.use_session(session_dict[key])
+                start = time.perf_counter()
+                context.redisplay()
+                emit(key, start)
+            redisplay_set.clear()
+
+            key = scheduler.select()
+            if key is None:
+                continue
+
+            # 選ばれたセッションについて，1フレーム分のサンプリングを行う
+            context.use_session(session_dict[key])
+            finished = False
+            try:
+                if time.perf_counter() - moved_dict[key] < context.preview_delay:
+                    # カメラの操作中は，低解像度かつ少ないサンプル数で1フレームの時間を抑える
+                    # カメラが preview_delay の間止まっていれば，元の解像度とサンプル数でやり直す
+                    start = time.perf_counter()
+                    context.render_preview(context.preview_sample_max)
+                    scheduler.charge(
+                        key, context.preview_sample_max * context.preview_scale**2
+                    )
+                    emit(key, start)
+                    context.adjust_preview_scale(time.perf_counter() - start)
+                    continue
+
+                sample_max = context.sample_per_frame
+                if context.max_spp:
+                    sample_max = min(sample_max, int(context.max_spp) - spp_dict[key])
+
+                if sample_max > 0:
+                    context.current_sample = spp_dict[key] + 1
+                    start = time.perf_counter()
+                    if farm is None:
+                        # タイルに分けて描画する場合（Context の dispatch_time_budget），リクエストが届いたら
+                        # 残りのスライスを打ち切り，パラメータの更新を次のフレームを待たずに反映する
+                        sample_max = context.render(
+                            sample_max, interrupt=lambda: not request_queue.empty()
+                        )
+                    else:
+                        farm.render(context, sample_max, key)
+                    spp_dict[key] += sample_max
+                    scheduler.charge(key, sample_max)
+                    # 最後のフレームは，前回送った画像との差によらず必ず送る
+                    emit(key, start, force=is_finished(key))
+
+                # 適応サンプリングで全画素が収束した場合も，それ以上サンプリングしない
+                finished = is_finished(key)
+            except RuntimeError as e:
+                print("Runtime Error:", e)
+                finished = True
+            except ValueError as e:
+                print("ValueError:", e)
+                finished = True
+
+            # 最大サンプル数に達したセッションは，次のリクエストが届くまで休止する
+            if finished:
+                forward(True)
+                scheduler.sleep(key)
+
+        forward(True)
+        executor.shutdown()
+
+
+class Scheduler:
+    # 優先度で重み付けしたラウンドロビン（ストライドスケジューリング）でセッションを選ぶ
+    # 各セッションはサンプル数 / 優先度 だけ仮想時間を消費し，仮想時間が最も小さいものが選ばれる
+    def __init__(self):
+        self.priority_dict = {}
+        self.pass_dict = {}
+        self.runnable_set = set()
+        self.virtual_time = 0.0
+
+    def add(self, key, priority=1):
+        if priority <= 0:
+            raise ValueError("priority must be positive")
+        self.priority_dict[key] = priority
+        self.pass_dict[key] = self.virtual_time
+
+    def remove(self, key):
+        self.priority_dict.pop(key, None)
+        self.pass_dict.pop(key, None)
+        self.runnable_set.discard(key)
+
+    def wake(self, key):
+        # 休止していた間の分を取り戻して他のセッションを待たせないよう，仮想時間を揃える
+        if key not in self.runnable_set:
+            self.pass_dict[key] = max(self.pass_dict[key], self.virtual_time)
+            self.runnable_set.add(key)
+
+    def sleep(self, key):
+        self.runnable_set.discard(key)
+
+    def runnable(self):
+        return bool(self.runnable_set)
+
+    def select(self):
+        if not self.runnable_set:
+            return None
+        # 仮想時間が等しい場合は先に追加されたセッションを優先する
+        key = min(
+            (key for key in self.priority_dict if key in self.runnable_set),
+            key=lambda key: self.pass_dict[key],
+        )
+        self.virtual_time = self.pass_dict[key]
+        return key
+
+    def charge(self, key, samples):
+        self.pass_dict[key] += samples / self.priority_dict[key]
@@ -0,0 +1,88 @@
+#version 330 core
+
+#define VARIANCE_SAMPLE_MIN (8.0f)
+
+out vec4 output_color;
+
+uniform sampler2D source_image;
+uniform sampler2D raw_image;
+uniform sampler2D albedo_image;
+uniform sampler2D normal_image;
+uniform sampler2D moment_image;
+// 何回目のパスか（タップの間隔は 2^iteration 画素）
+uniform int iteration;
+uniform bool is_last_pass;
+// 累積画像のサンプル数（モーメント画像に画素ごとのサンプル数が無い場合に用いる）
+uniform float sample_count;
+// このサンプル数に達した画素は元の累積画像をそのまま用いる
+uniform float sample_max;
+// 輝度（標準誤差に対する倍率），法線（cos の指数），アルベドに対する重みの鋭さ
+uniform float sigma_color;
+uniform float sigma_normal;
+uniform float sigma_albedo;
+
+float luminance(const in vec3 color) {
+  return 0.27 * color.r + 0.67 * color.g + 0.06 * color.b;
+}
+
+// à-trous ウェーブレット（B3 スプライン）による 5x5 のフィルタ
+// 輝度の差が標準誤差に比べて大きい所，法線やアルベドが変わる所はぼかさない
+void main() {
+  const float kernel[3] = float[](3.0f / 8.0f, 1.0f / 4.0f, 1.0f / 16.0f);
+  ivec2 size = textureSize(source_image, 0);
+  ivec2 p = ivec2(gl_FragCoord.xy);
+
+  vec4 color_p = texelFetch(source_image, p, 0);
+  vec3 albedo_p = texelFetch(albedo_image, p, 0).rgb;
+  vec3 normal_p = texelFetch(normal_image, p, 0).xyz;
+  vec4 moment = texelFetch(moment_image, p, 0);
+  vec4 raw = texelFetch(raw_image, p, 0);
+
+  // 累積画像（平均値）の輝度の標準誤差
+  // サンプル数が少なく分散を推定できない間は，1サンプルの標準偏差を周囲 3x3
+  // 画素の輝度の平均と同程度とみなす（輝度が 0 の画素も平滑化されるように）
+  float n = moment.g > 0.0f ? moment.g : sample_count;
+  float mean = luminance(raw.rgb);
+  float variance = max(moment.r - mean * mean, 0.0f);
+  if (moment.g < VARIANCE_SAMPLE_MIN) {
+    float local_mean = 0.0f;
+    for (int y = -1; y <= 1; y++) {
+      for (int x = -1; x <= 1; x++) {
+        ivec2 q = clamp(p + ivec2(x, y), ivec2(0), size - 1);
+        local_mean += luminance(texelFetch(raw_image, q, 0).rgb) / 9.0f;
+      }
+    }
+    variance = max(variance, local_mean * local_mean);
+  }
+  float deviation = sqrt(variance / max(n, 1.0f));
+  float luminance_p = luminance(color_p.rgb);
+
+  vec4 sum = vec4(0.0f);
+  float weight_sum = 0.0f;
+  int step_width = 1 << iteration;
+  for (int y = -2; y <= 2; y++) {
+    for (int x = -2; x <= 2; x++) {
+      ivec2 q = clamp(p + ivec2(x, y) * step_width, ivec2(0), size - 1);
+      vec4 color_q = texelFetch(source_image, q, 0);
+      vec3 albedo_q = texelFetch(albedo_image, q, 0).rgb;
+      vec3 normal_q = texelFetch(normal_image, q, 0).xyz;
+
+      float weight_color = exp(-abs(luminance_p - luminance(color_q.rgb)) /
+                               (sigma_color * deviation + 1e-4f));
+      float weight_normal =
+          pow(max(dot(normal_p, normal_q), 0.0f), sigma_normal);
+      float weight_albedo = exp(-length(albedo_p - albedo_q) / sigma_albedo);
+      float weight = kernel[abs(x)] * kernel[abs(y)] * weight_color *
+                     weight_normal * weight_albedo;
+      sum += color_q * weight;
+      weight_sum += weight;
+    }
+  }
+  // 法線が書き出されていない画素（重みがすべて 0）は平滑化しない
+  output_color = (weight_sum > 0.0f) ? sum / weight_sum : color_p;
+
+  // サンプル数が sample_max に近づくほど元の累積画像に近づける
+  if (is_last_pass) {
+    output_color = mix(output_color, raw, clamp(n / sample_max, 0.0f, 1.0f));
+  }
+}
@@ -2,7 +2,6 @@
 
 #define POW2(X) ((X) * (X))
 #define POW5(X) ((X) * (X) * (X) * (X) * (X))
-#define DEPTH_MAX (16)
 #define DELTA (0.01)
 #define PI (3.14159265359)
 
@@ -11,12 +10,24 @@
 #define MIRROR (2)
 #define GLASS (3)
 
+#define SCENE_TEXTURE_WIDTH ($scene_texture_width)
+#define SPHERE_TEXEL_COUNT (3)
+#define BVH_NODE_TEXEL_COUNT (2)
+
 out vec4 input_color;
 out uvec4 seed_value;
+out vec4 moment_value;
+out vec4 albedo_value;
+out vec4 normal_value;
 
 uniform sampler2D input_image;
 uniform usampler2D seed_image;
 uniform sampler2D background_image;
+uniform sampler2D moment_image;
+uniform sampler2D scene_image;
+uniform sampler2D bvh_image;
+uniform sampler2D env_conditional_image;
+uniform sampler2D env_marginal_image;
 
 uniform int sample_max;
 uniform int current_sample;
@@ -24,8 +35,17 @@ uniform float theta;
 uniform float phi;
 uniform float move_x;
 uniform float move_y;
+uniform int bvh_node_count;
+uniform bool light_sampling;
+uniform float convergence_threshold;
+uniform int convergence_sample_min;
+uniform ivec2 group_num;
+// 反射の最大回数と，ロシアンルーレットで経路を打ち切り始める反射の回数
+uniform int depth_max;
+uniform int roulette_depth;
+// デノイズに用いる最初の衝突面のアルベドと法線を書き出すか否か
+uniform bool write_feature;
 
-ivec2 group_num = ivec2($width, $height);
 ivec2 group_idx = ivec2(gl_FragCoord.x, gl_FragCoord.y);
 
 struct Ray {
@@ -33,6 +53,7 @@ struct Ray {
   vec3 direction; // 光線の方向ベクトル
   vec3 scatter;   // 散乱成分
   int depth;      // 反射した回数
+  float pdf; // 直前の拡散反射で方向を選んだ確率密度（鏡面反射や屈折の後は 0）
 };
 
 struct Hit {
@@ -64,6 +85,44 @@ float rand() {
   return xors[3] / 4294967295.0f;
 }
 
+float luminance(const in vec3 color) {
+  return 0.27 * color.r + 0.67 * color.g + 0.06 * color.b;
+}
+
+// シーンを格納した画像の index 番目の texel を読み出す
+vec4 fetchTexel(const in sampler2D image, const in int index) {
+  return texelFetch(
+      image, ivec2(index % SCENE_TEXTURE_WIDTH, index / SCENE_TEXTURE_WIDTH),
+      0);
+}
+
+// 球は (中心, 半径), (散乱成分, 材質), (放出成分, 0) の 3 texel で表す
+// 交差判定には最初の texel のみを用い，材質は最も近い交点についてのみ読み出す
+Sphere fetchSphereShape(const in int index) {
+  vec4 a = fetchTexel(scene_image, index * SPHERE_TEXEL_COUNT);
+  return Sphere(a.xyz, a.w, vec3(0.0f), vec3(0.0f), BACKGROUND);
+}
+
+void fetchSphereMaterial(const in int index, inout Hit hit) {
+  vec4 b = fetchTexel(scene_image, index * SPHERE_TEXEL_COUNT + 1);
+  vec4 c = fetchTexel(scene_image, index * SPHERE_TEXEL_COUNT + 2);
+  hit.scatter = b.rgb;
+  hit.emission = c.rgb;
+  hit.material = int(b.w);
+}
+
+// 軸平行境界ボックスと光線が hit.t より手前で交わるか否か
+bool hitBox(const in vec3 lower, const in vec3 upper, const in Ray ray,
+            const in vec3 direction_inverse, const in Hit hit) {
+  vec3 t1 = (lower - ray.origin) * direction_inverse;
+  vec3 t2 = (upper - ray.origin) * direction_inverse;
+  vec3 t_min = min(t1, t2);
+  vec3 t_max = max(t1, t2);
+  float t_near = max(max(t_min.x, t_min.y), t_min.z);
+  float t_far = min(min(t_max.x, t_max.y), t_max.z);
+  return t_near <= t_far && 0 < t_far && t_near < hit.t;
+}
+
 // 球と光線の交点
 bool hitSphere(const in Sphere sphere, const in Ray ray, inout Hit hit) {
   // float a = dot(ray.direction, ray.direction);
@@ -105,14 +164,48 @@ bool hitSphere(const in Sphere sphere, const in Ray ray, inout Hit hit) {
   return false;
 }
 
+// BVH をたどってシーン中の球と光線の最も近い交点を求める
+// 節点は深さ優先順に並び，(最小座標, スキップ先または最初の球),
+// (最大座標, 球の数) の 2 texel で表す
+// 球の数が 0 の節点は内部節点であり，境界ボックスと交わる場合は直後の左の子へ，
+// 交わらない場合は部分木を飛ばしてスキップ先へ進む（スタックを用いない）
+void hitScene(const in Ray ray, inout Hit hit) {
+  vec3 direction_inverse = 1.0f / ray.direction;
+  int hit_index = -1;
+  int node = 0;
+
+  while (node < bvh_node_count) {
+    vec4 a = fetchTexel(bvh_image, node * BVH_NODE_TEXEL_COUNT);
+    vec4 b = fetchTexel(bvh_image, node * BVH_NODE_TEXEL_COUNT + 1);
+    bool is_hit = hitBox(a.xyz, b.xyz, ray, direction_inverse, hit);
+
+    int count = int(b.w);
+    if (count > 0) {
+      for (int i = int(a.w); is_hit && i < int(a.w) + count; i++) {
+        if (hitSphere(fetchSphereShape(i), ray, hit)) {
+          hit_index = i;
+        }
+      }
+      node++;
+    } else {
+      node = is_hit ? node + 1 : int(a.w);
+    }
+  }
+
+  if (hit_index >= 0) {
+    fetchSphereMaterial(hit_index, hit);
+  }
+}
+
 // 鏡面
 void mirror(inout Ray ray, const in Hit hit) {
   float dottheta;
   if (dot(-ray.direction, hit.normal) < 0) {
-    ray.depth = DEPTH_MAX;
+    ray.depth = depth_max;
     return;
   }
   ray.depth++;
+  ray.pdf = 0.0f;
   ray.origin = hit.position + hit.normal * DELTA;
   // 課題1：鏡面の作成
   dottheta = dot(-(ray.direction), hit.normal);
@@ -128,6 +221,7 @@ float fresnel(const in float n, const in float u) {
 // ガラス面
 void glass(inout Ray ray, const in Hit hit) {
   ray.depth++;
+  ray.pdf = 0.0f;
   float n = 1.5;
   vec3 N;
   float t = dot(-ray.direction, hit.normal);
@@ -150,14 +244,97 @@ void glass(inout Ray ray, const in Hit hit) {
   }
 }
 
+vec2 directionToUv(const in vec3 direction) {
+  return vec2(-atan(direction.x, direction.z) / (2 * PI),
+              acos(clamp(direction.y, -1.0f, 1.0f)) / PI);
+}
+
+// 単調増加する累積分布関数 cdf の row 行目から，xi を超える最初の index
+// を二分探索で求める
+int searchCdf(const in sampler2D cdf, const in int row, const in int count,
+              const in float xi) {
+  int lower = 0;
+  int upper = count - 1;
+  while (lower < upper) {
+    int middle = (lower + upper) / 2;
+    if (texelFetch(cdf, ivec2(middle, row), 0).r > xi) {
+      upper = middle;
+    } else {
+      lower = middle + 1;
+    }
+  }
+  return lower;
+}
+
+// 環境マップの重点的サンプリングで direction を選ぶ確率密度（立体角あたり）
+// env_conditional_image の g には (u, v) 平面での画素ごとの確率密度を格納する
+float environmentPdf(const in vec3 direction) {
+  ivec2 size = textureSize(env_conditional_image, 0);
+  vec2 uv = directionToUv(direction);
+  ivec2 texel = min(ivec2(fract(uv.x) * size.x, uv.y * size.y), size - 1);
+  float sin_theta = sqrt(max(1.0f - POW2(direction.y), 0.0f));
+  if (sin_theta <= 0.0f) {
+    return 0.0f;
+  }
+  return texelFetch(env_conditional_image, texel, 0).g /
+         (2.0f * PI * PI * sin_theta);
+}
+
+// 環境マップの輝度 x sin(theta) に比例する確率で方向を選ぶ
+// 周辺分布で行を，条件付き分布で列を選び，画素内では一様に選ぶ
+vec3 sampleEnvironment(out float pdf) {
+  ivec2 size = textureSize(env_conditional_image, 0);
+  int y = searchCdf(env_marginal_image, 0, size.y, rand());
+  int x = searchCdf(env_conditional_image, y, size.x, rand());
+  float theta = (y + rand()) / size.y * PI;
+  float phi = (x + rand()) / size.x * 2.0f * PI;
+  float sin_theta = sin(theta);
+  pdf = (sin_theta > 0.0f)
+            ? texelFetch(env_conditional_image, ivec2(x, y), 0).g /
+                  (2.0f * PI * PI * sin_theta)
+            : 0.0f;
+  return vec3(-sin_theta * sin(phi), cos(theta), sin_theta * cos(phi));
+}
+
 // Image Based Lighting
 void background(inout Ray ray, inout Hit hit) {
-  ray.depth = DEPTH_MAX;
+  ray.depth = depth_max;
   hit.emission =
       texture(background_image,
               vec2(-atan(ray.direction.x, ray.direction.z) / (2 * PI),
                    acos(ray.direction.y) / PI))
           .rgb;
+  // 拡散反射で選んだ方向が環境マップに届いた場合は，光源のサンプリングとの MIS
+  // (power heuristic) で重み付けする
+  if (light_sampling && ray.pdf > 0.0f) {
+    float light_pdf = environmentPdf(ray.direction);
+    hit.emission *= POW2(ray.pdf) / (POW2(ray.pdf) + POW2(light_pdf));
+  }
+}
+
+// 環境マップを光源として直接サンプリングする (next event estimation)
+// 遮蔽されていなければ，MIS で重み付けした寄与を放出成分に加える
+void sampleLight(inout Hit hit) {
+  float light_pdf;
+  vec3 direction = sampleEnvironment(light_pdf);
+  float cos_theta = dot(direction, hit.normal);
+  if (cos_theta <= 0.0f || light_pdf <= 0.0f) {
+    return;
+  }
+
+  Ray shadow =
+      Ray(hit.position + hit.normal * DELTA, direction, vec3(1.0f), 0, 0.0f);
+  Hit shadow_hit =
+      Hit(10000.0f, vec3(0.0f), vec3(0.0f), vec3(0.0f), vec3(0.0f), BACKGROUND);
+  hitScene(shadow, shadow_hit);
+  if (shadow_hit.material != BACKGROUND) {
+    return;
+  }
+
+  float bsdf_pdf = cos_theta / PI;
+  float weight = POW2(light_pdf) / (POW2(light_pdf) + POW2(bsdf_pdf));
+  vec3 radiance = texture(background_image, directionToUv(direction)).rgb;
+  hit.emission += radiance * cos_theta / PI * weight / light_pdf;
 }
 
 vec3 random_direction() {
@@ -172,9 +349,9 @@ vec3 random_direction() {
 }
 
 // 完全拡散反射面
-void diffuse(inout Ray ray, const in Hit hit) {
+void diffuse(inout Ray ray, inout Hit hit) {
   if (dot(-ray.direction, hit.normal) < 0) {
-    ray.depth = DEPTH_MAX;
+    ray.depth = depth_max;
     ray.scatter = vec3(0.0f);
     return;
   }
@@ -194,6 +371,44 @@ void diffuse(inout Ray ray, const in Hit hit) {
 
   ray.origin = hit.position + hit.normal * DELTA;
   ray.scatter *= hit.scatter;
+  ray.pdf = z / PI;
+
+  if (light_sampling) {
+    sampleLight(hit);
+  }
+}
+
+// 画素の中心を通る光線が最初に当たった拡散反射面（または背景）のアルベドと法線
+// 鏡面とガラス面では反射または屈折した先をたどる
+// ガラス面での反射か屈折かの選択はフレームごとに変わらないよう，乱数を Xorshift
+// の既定の状態から生成する（元の状態に戻し，パストレーシングのサンプルには影響させない）
+#define FEATURE_DEPTH_MAX (4)
+void traceFeature(inout Ray ray, out vec3 albedo, out vec3 normal) {
+  uvec4 xors_saved = xors;
+  xors = uvec4(123456789u, 362436069u, 521288629u, 88675123u);
+  albedo = vec3(0.0f);
+  normal = vec3(0.0f);
+  for (int i = 0; i < FEATURE_DEPTH_MAX; i++) {
+    Hit hit = Hit(10000.0f, vec3(0.0f), vec3(0.0f), vec3(0.0f), vec3(0.0f),
+                  BACKGROUND);
+    hitScene(ray, hit);
+    if (hit.material == BACKGROUND) {
+      albedo = ray.scatter;
+      normal = -ray.direction;
+      break;
+    }
+    if (hit.material == DIFFUSE) {
+      albedo = ray.scatter * hit.scatter;
+      normal = hit.normal;
+      break;
+    }
+    if (hit.material == MIRROR) {
+      mirror(ray, hit);
+    } else {
+      glass(ray, hit);
+    }
+  }
+  xors = xors_saved;
 }
 
 void main() {
@@ -204,36 +419,56 @@ void main() {
           ? vec4(0.0f)
           : texture(input_image, gl_FragCoord.xy / group_num.xy);
 
-  const vec3 eye = vec3(0.0f, 0.0f, 18.0f);
+  // 輝度の2次モーメント，サンプル数，収束済みか否か
+  vec4 moment_present =
+      (current_sample == 1)
+          ? vec4(0.0f)
+          : texture(moment_image, gl_FragCoord.xy / group_num.xy);
+  float sample_count = moment_present.g;
+  bool converged = moment_present.b > 0.5f;
 
-  const int n_sphere = 2;
-  const Sphere spheres[n_sphere] =
-      Sphere[n_sphere](Sphere(vec3(0.0f), 4.0f, vec3(0.75f), vec3(0), GLASS),
-                       Sphere(vec3(0.0f, -10000.05f, 0.0f), 9996.0f,
-                              vec3(0.75f), vec3(0), DIFFUSE));
+  const vec3 eye = vec3(0.0f, 0.0f, 18.0f);
 
   mat3 M1 =
       mat3(cos(theta), 0, sin(theta), 0, 1, 0, -sin(theta), 0, cos(theta));
 
   mat3 M2 = mat3(1, 0, 0, 0, cos(phi), -sin(phi), 0, sin(phi), cos(phi));
 
-  for (int i = 0; i < sample_max; i++) {
+  if (write_feature) {
+    vec3 position_center =
+        vec3((group_idx.x + 0.5f) / group_num.x * 16.0f - 8.0f,
+             (group_idx.y + 0.5f) / group_num.y * 9.0f - 4.5f, eye.z - 9.0f);
+    Ray ray =
+        Ray(M1 * M2 * (eye + vec3(move_x, move_y, 0)),
+            M1 * M2 * (normalize(position_center - eye)), vec3(1.0f), 0, 0.0f);
+    vec3 albedo, normal;
+    traceFeature(ray, albedo, normal);
+    albedo_value = vec4(albedo, 1.0f);
+    normal_value = vec4(normal, 0.0f);
+  } else {
+    albedo_value = vec4(0.0f);
+    normal_value = vec4(0.0f);
+  }
+
+  // 収束済みの画素はサンプリングしない
+  int sample_num = converged ? 0 : sample_max;
+
+  for (int i = 0; i < sample_num; i++) {
     vec4 color_next = vec4(0.0f);
 
     vec3 position_screen = vec3(
         float(group_idx.x + rand()) / group_num.x * 16.0f - 8.0f,
         float(group_idx.y + rand()) / group_num.y * 9.0f - 4.5f, eye.z - 9.0f);
 
-    Ray ray = Ray(M1 * M2 * (eye + vec3(move_x, move_y, 0)),
-                  M1 * M2 * (normalize(position_screen - eye)), vec3(1.0f), 0);
+    Ray ray =
+        Ray(M1 * M2 * (eye + vec3(move_x, move_y, 0)),
+            M1 * M2 * (normalize(position_screen - eye)), vec3(1.0f), 0, 0.0f);
 
     Hit hit = Hit(1000.0f, vec3(0.0f), vec3(0.0f), vec3(0.0f), vec3(0.0f),
                   BACKGROUND);
 
-    while (ray.depth < DEPTH_MAX) {
-      for (int i = 0; i < n_sphere; i++) {
-        hitSphere(spheres[i], ray, hit);
-      }
+    while (ray.depth < depth_max) {
+      hitScene(ray, hit);
 
       switch (hit.material) {
       case BACKGROUND:
@@ -252,14 +487,39 @@ void main() {
 
       color_next.rgb += hit.emission * ray.scatter;
 
+      // ロシアンルーレット：散乱成分が小さくなった経路ほど高い確率で打ち切り，
+      // 生き残った経路を生存確率で割って期待値を保つ
+      if (ray.depth >= roulette_depth && ray.depth < depth_max) {
+        float survival = clamp(
+            max(ray.scatter.r, max(ray.scatter.g, ray.scatter.b)), 0.05f, 1.0f);
+        if (rand() >= survival) {
+          ray.depth = depth_max;
+        } else {
+          ray.scatter /= survival;
+        }
+      }
+
       hit.t = 10000.0f;
       hit.material = BACKGROUND;
     }
 
     // 平均値の逐次計算
-    color_present += (color_next - color_present) / (current_sample + i);
+    sample_count += 1.0f;
+    color_present += (color_next - color_present) / sample_count;
+    moment_present.r +=
+        (POW2(luminance(color_next.rgb)) - moment_present.r) / sample_count;
+  }
+
+  // 平均値の標準誤差が輝度に対して十分小さくなった画素を収束済みとする
+  if (convergence_threshold > 0.0f && sample_count >= convergence_sample_min) {
+    float mean = luminance(color_present.rgb);
+    float variance = max(moment_present.r - POW2(mean), 0.0f);
+    converged =
+        sqrt(variance / sample_count) <= convergence_threshold * (mean + DELTA);
   }
 
   input_color = color_present;
   seed_value = xors;
+  moment_value =
+      vec4(moment_present.r, sample_count, converged ? 1.0f : 0.0f, 0.0f);
 }
@@ -8,8 +8,10 @@ uniform sampler2D input_image;
 uniform float luminance_average;
 uniform float luminance_max;
 uniform float key_value;
-
-ivec2 group_num = ivec2($width, $height);
+uniform float gamma;
+uniform ivec2 group_num;
+// true の場合は OpenCV でエンコードするため BGR の順に書き出す
+uniform bool swap_red_blue;
 
 // Tone Mapping
 vec4 toneMap(const in vec4 color) {
@@ -33,7 +35,10 @@ vec4 gammaCorrect(const in vec4 color, const in float gamma) {
 }
 
 void main() {
-  vec4 color = texture(input_image, gl_FragCoord.xy / group_num.xy);
+  // 送信用画像は上下を反転して書き出し，読み出した順（上の行から）でそのままエンコードできるようにする
+  vec2 coord = vec2(gl_FragCoord.x, group_num.y - gl_FragCoord.y);
+  vec4 color = texture(input_image, coord / group_num.xy);
   color = toneMap(color);
-  output_color = gammaCorrect(color, 2.2);
+  color = gammaCorrect(color, gamma);
+  output_color = swap_red_blue ? color.bgra : color;
 }
@@ -0,0 +1,47 @@
+#version 330 core
+
+#define BLOCK_SIZE ($block_size)
+#define FLT_MIN (1.175494351e-38)
+
+out vec4 output_value;
+
+uniform sampler2D source_image;
+uniform sampler2D moment_image;
+uniform ivec2 source_size;
+uniform bool is_first_pass;
+
+// 輝度の総和と最大値，収束済みの画素数の並列リダクション
+// 初回のパスでは raw 画像から (log 輝度, 最大値, 収束済み, 1) を計算し，
+// 以降のパスでは BLOCK_SIZE x BLOCK_SIZE 画素ごとに総和と最大値をとる
+void main() {
+  ivec2 origin = ivec2(gl_FragCoord.xy) * BLOCK_SIZE;
+  float log_luminance_sum = 0.0f;
+  float value_max = 0.0f;
+  float converged_count = 0.0f;
+  float pixel_count = 0.0f;
+
+  for (int y = 0; y < BLOCK_SIZE; y++) {
+    for (int x = 0; x < BLOCK_SIZE; x++) {
+      ivec2 position = origin + ivec2(x, y);
+      if (any(greaterThanEqual(position, source_size))) {
+        continue;
+      }
+      vec4 value = texelFetch(source_image, position, 0);
+      if (is_first_pass) {
+        float luminance = 0.27 * value.r + 0.67 * value.g + 0.06 * value.b;
+        log_luminance_sum += log(FLT_MIN + luminance);
+        value_max = max(value_max, max(max(value.r, value.g), value.b));
+        converged_count += texelFetch(moment_image, position, 0).b;
+        pixel_count += 1.0f;
+      } else {
+        log_luminance_sum += value.r;
+        value_max = max(value_max, value.g);
+        converged_count += value.b;
+        pixel_count += value.a;
+      }
+    }
+  }
+
+  output_value =
+      vec4(log_luminance_sum, value_max, converged_count, pixel_count);
+}
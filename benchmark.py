@@ -0,0 +1,648 @@
+import argparse
+import functools
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from app.farm import RenderFarm
+from app.metrics import Metrics
+from app.render import AccumulationCache, Context, EnvMapStore, TileScheduler
+from app.worker import downsample, psnr
+
+
+def bench_readback(args):
+    # 同期読み出し（get_binary）と非同期読み出し（get_binary_async）のフレームレートを比較する
+    for readback_buffer_count in [0, 2, 3]:
+        ctx = Context(
+            width=args.width,
+            height=args.height,
+            readback_buffer_count=readback_buffer_count,
+        )
+        ctx.bind_data(env_map_path=args.env_map)
+        ctx.create_program()
+
+        frame_count = 0
+        start = time.perf_counter()
+        for _ in range(args.frames):
+            ctx.render(args.sample_max)
+            if readback_buffer_count:
+                binary = ctx.get_binary_async()
+                frame_count += binary is not None
+            else:
+                ctx.get_binary()
+                frame_count += 1
+        if readback_buffer_count:
+            frame_count += len(ctx.flush_binary_async())
+        elapsed = time.perf_counter() - start
+
+        mode = f"async x{readback_buffer_count}" if readback_buffer_count else "sync"
+        print(f"{mode:>10}: {frame_count / elapsed:7.2f} fps ({frame_count} frames)")
+
+
+def create_random_scene(sphere_count, seed=0):
+    # 床の上に大きさと材質が無作為な球を sphere_count - 1 個並べたシーン
+    # 球の数によらず球が占める体積が同程度になるよう，半径を調整する
+    rng = np.random.default_rng(seed)
+    radius_scale = (16 / max(sphere_count, 16)) ** (1 / 3)
+    sphere_list = [
+        {
+            "center": [0.0, -10000.05, 0.0],
+            "radius": 9996.0,
+            "scatter": [0.75, 0.75, 0.75],
+            "emission": [0.0, 0.0, 0.0],
+            "material": "diffuse",
+        }
+    ]
+    for _ in range(sphere_count - 1):
+        sphere_list.append(
+            {
+                "center": rng.uniform([-8, -3.5, -8], [8, 4, 4]).tolist(),
+                "radius": rng.uniform(0.1, 0.5) * radius_scale,
+                "scatter": rng.uniform(0.2, 0.9, 3).tolist(),
+                "emission": [0.0, 0.0, 0.0],
+                "material": rng.choice(["diffuse", "mirror", "glass"]),
+            }
+        )
+    return {"spheres": sphere_list}
+
+
+def bench_scene(args):
+    # プリミティブ数に対する1秒あたりのサンプル数を，BVH を用いる場合と総当たりの場合で比較する
+    for sphere_count in args.sphere_counts:
+        scene = create_random_scene(sphere_count)
+        result = []
+        # 葉の大きさをプリミティブ数以上にすると，BVH は1つの葉のみとなり総当たりと同じになる
+        for bvh_leaf_size in [4, sphere_count]:
+            ctx = Context(
+                width=args.width, height=args.height, bvh_leaf_size=bvh_leaf_size
+            )
+            ctx.bind_data(env_map_path=args.env_map)
+            ctx.bind_scene(scene)
+            ctx.create_program()
+
+            ctx.render(args.sample_max)
+            ctx.get_buffer()
+            start = time.perf_counter()
+            for _ in range(args.frames):
+                ctx.render(args.sample_max)
+            ctx.get_buffer()
+            elapsed = time.perf_counter() - start
+            samples = args.width * args.height * args.sample_max * args.frames
+            result.append(samples / elapsed / 1e6)
+
+        print(
+            f"{sphere_count:>6} spheres: "
+            f"bvh {result[0]:7.2f} Msamples/s, linear {result[1]:7.2f} Msamples/s"
+        )
+
+
+def bench_env_map(args):
+    # 環境マップの読み込み時間を，キャッシュが無い場合，ディスクにある場合，GPU にある場合で比較する
+    ctx = Context(width=args.width, height=args.height)
+    for dtype in ["f4", "f2"]:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            result = []
+            for reuse_store in [False, False, True]:
+                if not reuse_store:
+                    store = EnvMapStore(ctx.context, cache_dir, 256 * 1024**2, dtype)
+                start = time.perf_counter()
+                store.get(args.env_map)
+                ctx.context.finish()
+                result.append((time.perf_counter() - start) * 1000)
+            print(
+                f"{dtype}: cold {result[0]:8.2f} ms, warm disk {result[1]:8.2f} ms, "
+                f"warm gpu {result[2]:8.2f} ms ({store.size() / 1024**2:.1f} MiB)"
+            )
+            store.release()
+
+
+def bench_resize(args):
+    # 解像度を変えてから描画できるようになるまでの時間を，コンテキストを作り直す場合と
+    # Context.resize の場合で比較する（描画そのものの時間は含まない）
+    resolution_list = [(480, 270), (960, 540), (1920, 1080)]
+    start = time.perf_counter()
+    for width, height in resolution_list:
+        ctx = Context(width=width, height=height)
+        ctx.bind_data(env_map_path=args.env_map)
+        ctx.create_program()
+        ctx.context.finish()
+    recreate_time = (time.perf_counter() - start) / len(resolution_list)
+
+    start = time.perf_counter()
+    for width, height in resolution_list:
+        ctx.resize(width, height)
+        ctx.context.finish()
+    resize_time = (time.perf_counter() - start) / len(resolution_list)
+    print(
+        f"recreate: {recreate_time * 1000:8.2f} ms, resize: {resize_time * 1000:8.2f} ms"
+    )
+
+
+def bench_preview(args):
+    # カメラが動いた直後の1フレームにかかる時間を，元の解像度の場合とプレビューの場合で比較する
+    ctx = Context(width=args.width, height=args.height)
+    ctx.bind_data(env_map_path=args.env_map)
+    ctx.create_program()
+    for preview_scale in [1, 1 / 2, 1 / 4, 1 / 8]:
+        ctx.preview_scale = preview_scale
+        ctx.render_preview(1)
+        ctx.get_buffer()
+        start = time.perf_counter()
+        for frame in range(args.frames):
+            ctx.theta = frame / args.frames
+            if preview_scale == 1:
+                ctx.current_sample = 1
+                ctx.render(args.sample_max)
+            else:
+                ctx.render_preview(1)
+            ctx.get_buffer()
+        elapsed = (time.perf_counter() - start) / args.frames
+        mode = "full" if preview_scale == 1 else f"preview 1/{round(1 / preview_scale)}"
+        print(f"{mode:>12}: {elapsed * 1000:8.2f} ms/frame")
+
+
+def bench_accumulation(args):
+    # 以前のカメラに戻ってから表示するまでの時間を，サンプリングし直す場合と
+    # キャッシュ（メモリおよびディスク）から復元する場合で比較する
+    ctx = Context(width=args.width, height=args.height)
+    ctx.bind_data(env_map_path=args.env_map)
+    ctx.create_program()
+    sample_count = args.sample_max * args.frames
+
+    start = time.perf_counter()
+    for frame in range(args.frames):
+        ctx.current_sample = frame * args.sample_max + 1
+        ctx.render(args.sample_max)
+    ctx.get_buffer()
+    result = [time.perf_counter() - start]
+
+    with tempfile.TemporaryDirectory() as spill_dir:
+        for memory_budget in [1024**3, 1]:
+            ctx.accumulation_cache = AccumulationCache(memory_budget, spill_dir)
+            ctx.theta = 0
+            ctx.save_accumulation(sample_count)
+            ctx.theta = 1
+            start = time.perf_counter()
+            ctx.theta = 0
+            ctx.restore_accumulation()
+            ctx.redisplay()
+            ctx.get_buffer()
+            result.append(time.perf_counter() - start)
+            ctx.accumulation_cache.clear()
+
+    print(
+        f"{sample_count} spp: render {result[0] * 1000:8.2f} ms, "
+        f"memory {result[1] * 1000:8.2f} ms, disk {result[2] * 1000:8.2f} ms"
+    )
+
+
+def create_farm_context(width, height, env_map):
+    ctx = Context(width=width, height=height)
+    ctx.bind_data(env_map_path=env_map)
+    ctx.create_program()
+    return ctx
+
+
+def bench_farm(args):
+    # 1秒あたりのサンプル数を，サンプリングを分配するプロセス数ごとに比較する
+    # 合成とトーンマッピングはこのプロセスのコンテキストで行う
+    ctx = create_farm_context(args.width, args.height, args.env_map)
+    factory = functools.partial(
+        create_farm_context, args.width, args.height, args.env_map
+    )
+    for worker_count in args.worker_counts:
+        farm = RenderFarm(factory, worker_count, args.threads_per_worker)
+        farm.start()
+        ctx.current_sample = 1
+        farm.render(ctx, args.sample_max)
+        ctx.get_buffer()
+        start = time.perf_counter()
+        for _ in range(args.frames):
+            farm.render(ctx, args.sample_max)
+        ctx.get_buffer()
+        elapsed = time.perf_counter() - start
+        farm.stop()
+        samples = args.width * args.height * args.sample_max * args.frames
+        print(f"{worker_count:>3} workers: {samples / elapsed / 1e6:7.2f} Msamples/s")
+
+
+def bench_profile(args):
+    # 段階ごとの時間の計測による1フレームあたりの増分と，計測した段階ごとのパーセンタイル
+    ctx = Context(width=args.width, height=args.height)
+    ctx.bind_data(env_map_path=args.env_map)
+    ctx.create_program()
+    metrics = Metrics()
+    for profile in [False, True]:
+        ctx.profile = profile
+        ctx.current_sample = 1
+        ctx.render(args.sample_max)
+        ctx.get_buffer()
+        ctx.collect_timings()
+        start = time.perf_counter()
+        for frame in range(args.frames):
+            ctx.current_sample = frame + 2
+            ctx.render(args.sample_max)
+            ctx.get_buffer()
+            metrics.record(ctx.collect_timings())
+        elapsed = (time.perf_counter() - start) / args.frames
+        print(f"profile {str(profile):>5}: {elapsed * 1000:8.2f} ms/frame")
+    for stage, summary in metrics.summary().items():
+        print(
+            f"{stage:>16}: p50 {summary['p50']:8.2f} ms, p90 {summary['p90']:8.2f} ms, "
+            f"p99 {summary['p99']:8.2f} ms"
+        )
+
+
+def bench_codec(args):
+    # コーデックと品質ごとのエンコード時間と1フレームあたりのバイト数
+    ctx = Context(width=args.width, height=args.height)
+    ctx.bind_data(env_map_path=args.env_map)
+    ctx.create_program()
+    ctx.render(args.sample_max)
+    for codec, quality in [
+        ("jpeg", None),
+        ("jpeg", 50),
+        ("jpeg", 90),
+        ("webp", None),
+        ("webp", 50),
+        ("webp", 90),
+        ("png", None),
+        ("raw", None),
+    ]:
+        ctx.codec = codec
+        ctx.quality = quality
+        ctx.redisplay()
+        start = time.perf_counter()
+        for _ in range(args.frames):
+            buffer = ctx.get_buffer()
+        readback_time = (time.perf_counter() - start) / args.frames
+        start = time.perf_counter()
+        for _ in range(args.frames):
+            binary = ctx.encode_buffer(buffer)
+        encode_time = (time.perf_counter() - start) / args.frames
+        mode = codec if quality is None else f"{codec} q{quality}"
+        print(
+            f"{mode:>10}: readback {readback_time * 1000:8.2f} ms, "
+            f"encode {encode_time * 1000:8.2f} ms, {len(binary) / 1024:9.1f} KiB/frame"
+        )
+
+
+def bench_frame_skip(args):
+    # 長時間のサンプリングで送るフレーム数とバイト数を，frame_skip_psnr の閾値ごとに比較する
+    # 送らなかったフレームとの差は，送った画像と最終的な画像の PSNR（全解像度）で確かめる
+    ctx = Context(width=args.width, height=args.height)
+    ctx.bind_data(env_map_path=args.env_map)
+    ctx.create_program()
+    buffer_list = []
+    for frame in range(args.frames):
+        ctx.current_sample = frame * args.sample_max + 1
+        ctx.render(args.sample_max)
+        buffer_list.append(ctx.get_buffer().copy())
+    binary_size_list = [len(ctx.encode_buffer(buffer)) for buffer in buffer_list]
+    mip_list = [downsample(buffer) for buffer in buffer_list]
+
+    for threshold in args.thresholds:
+        sent_list = [0]
+        for index in range(1, len(buffer_list)):
+            last = index == len(buffer_list) - 1
+            # 閾値が 0 の場合は（RenderWorker と同じく）毎フレーム送る
+            if (
+                last
+                or threshold <= 0
+                or psnr(mip_list[sent_list[-1]], mip_list[index]) < threshold
+            ):
+                sent_list.append(index)
+        # 送らなかったフレームを表示している間の，実際のフレームとの差の最小値
+        psnr_min = min(
+            psnr(buffer_list[max(i for i in sent_list if i <= index)], buffer)
+            for index, buffer in enumerate(buffer_list)
+        )
+        print(
+            f"{threshold:5.1f} dB: {len(sent_list):>4}/{len(buffer_list)} frames, "
+            f"{sum(binary_size_list[i] for i in sent_list) / 1024:9.1f} KiB, "
+            f"PSNR min {psnr_min:6.2f} dB"
+        )
+
+
+def bench_preset(args):
+    # 画質のプリセットごとの1秒あたりのサンプル数と，参照画像に対する相対 RMSE
+    # 参照画像はロシアンルーレットを使わず，深く反射させて reference_spp サンプルで求める
+    ctx = Context(width=args.width, height=args.height)
+    ctx.bind_data(env_map_path=args.env_map)
+    ctx.create_program()
+
+    def render(sample_count):
+        start = time.perf_counter()
+        for sample in range(0, sample_count, args.sample_max):
+            ctx.current_sample = sample + 1
+            ctx.render(args.sample_max)
+        ctx.get_buffer()
+        elapsed = time.perf_counter() - start
+        return ctx.read_accumulation()[0][:, :, :3].astype("f8"), elapsed
+
+    ctx.depth_max = args.reference_depth
+    ctx.roulette_depth = args.reference_depth
+    reference, _ = render(args.reference_spp)
+    sample_count = args.sample_max * args.frames
+    # 比較のため，ロシアンルーレットを使わない場合（反射は最大 16 回）も計測する
+    for name in ["no roulette", *Context.PRESET_DICT]:
+        if name == "no roulette":
+            ctx.depth_max = ctx.roulette_depth = 16
+        else:
+            ctx.use_preset(name)
+        render(args.sample_max)
+        image, elapsed = render(sample_count)
+        rmse = np.sqrt(np.mean((image - reference) ** 2)) / np.mean(reference)
+        samples = args.width * args.height * sample_count
+        print(
+            f"{name:>12}: {samples / elapsed / 1e6:7.2f} Msamples/s, "
+            f"relative RMSE {rmse:.4f} ({sample_count} spp), "
+            f"efficiency {1 / (rmse**2 * elapsed):9.1f}"
+        )
+
+
+def bench_denoise(args):
+    # サンプル数ごとのトーンマッピング前の画像の参照画像に対する相対 RMSE を，デノイズの有無で比較する
+    # 参照画像は reference_spp サンプルで求め，デノイズの時間は GPU の完了までを含めて計測する
+    ctx = Context(
+        width=args.width,
+        height=args.height,
+        denoise_sample_max=args.denoise_sample_max,
+    )
+    ctx.bind_data(env_map_path=args.env_map)
+    ctx.create_program()
+
+    for sample in range(0, args.reference_spp, args.sample_max):
+        ctx.current_sample = sample + 1
+        ctx.render(args.sample_max)
+    reference = ctx.read_accumulation()[0][:, :, :3].astype("f8")
+    spp = 1
+    while spp <= args.denoise_sample_max:
+        ctx.current_sample = 1
+        ctx.render(spp)
+        elapsed = measure(ctx, ctx.denoise, 5)
+        raw = ctx.read_accumulation()[0][:, :, :3].astype("f8")
+        # denoise_sample_max に達するとデノイズせず，元の画像をそのまま送る
+        denoised = raw
+        if ctx.denoised_image is not None:
+            denoised = np.frombuffer(ctx.denoised_image.read(), dtype="f4").reshape(
+                args.height, args.width, 4
+            )[:, :, :3]
+        rmse_list = [
+            np.sqrt(np.mean((image - reference) ** 2)) / np.mean(reference)
+            for image in [raw, denoised]
+        ]
+        print(
+            f"{spp:>5} spp: relative RMSE {rmse_list[0]:.4f} -> {rmse_list[1]:.4f}, "
+            f"denoise {elapsed * 1000:6.2f} ms"
+        )
+        spp *= 2
+
+
+def bench_tiles(args):
+    # 1回の描画の最長時間，1秒あたりのサンプル数，およびフレームの途中で届いたリクエストを反映できるまでの時間を，
+    # dispatch_time_budget ごとに比較する（0 は全画面を1回で描画する場合）
+    # リクエストは各フレームの開始から，1回で描画する場合のフレーム時間の半分の時点で届くとする
+    frame_time = None
+    for budget in args.budgets:
+        ctx = Context(
+            width=args.width,
+            height=args.height,
+            dispatch_time_budget=budget,
+            tile_size=args.tile_size,
+            tile_order=args.tile_order,
+        )
+        ctx.bind_data(env_map_path=args.env_map)
+        ctx.create_program()
+        dispatch_list = []
+        if ctx.tile_scheduler is not None:
+            update = ctx.tile_scheduler.update
+
+            def record(pixel_count, sample_count, elapsed, update=update):
+                dispatch_list.append(elapsed)
+                update(pixel_count, sample_count, elapsed)
+
+            ctx.tile_scheduler.update = record
+        ctx.render(args.sample_max)
+        ctx.get_buffer()
+        dispatch_list.clear()
+
+        elapsed_list, latency_list = [], []
+        for frame in range(args.frames):
+            ctx.current_sample = frame * args.sample_max + 2
+            start = time.perf_counter()
+            ctx.render(args.sample_max)
+            ctx.get_buffer()
+            elapsed_list.append(time.perf_counter() - start)
+            if ctx.tile_scheduler is None:
+                dispatch_list.append(elapsed_list[-1])
+        if frame_time is None:
+            frame_time = float(np.mean(elapsed_list))
+        for frame in range(args.frames):
+            arrival = time.perf_counter() + frame_time / 2
+            ctx.current_sample = frame * args.sample_max + 2
+            ctx.render(
+                args.sample_max, interrupt=lambda: time.perf_counter() >= arrival
+            )
+            ctx.get_buffer()
+            latency_list.append(max(time.perf_counter() - arrival, 0))
+
+        samples = args.width * args.height * args.sample_max * args.frames
+        print(
+            f"budget {budget * 1000:6.1f} ms: "
+            f"longest dispatch {max(dispatch_list) * 1000:8.2f} ms, "
+            f"{samples / sum(elapsed_list) / 1e6:7.2f} Msamples/s, "
+            f"latency p50 {np.percentile(latency_list, 50) * 1000:8.2f} ms"
+        )
+
+
+def measure(ctx, func, repeat):
+    # func を repeat 回実行し，GPU の完了までを含めた時間の最小値 [s] を返す
+    # （他のプロセスによる揺らぎは遅くなる方向にのみ働くため，中央値より安定する）
+    elapsed_list = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        ctx.context.finish()
+        elapsed_list.append(time.perf_counter() - start)
+    return min(elapsed_list)
+
+
+def bench_suite_stages(ctx, sample_max, repeat):
+    # render の各段階と，読み出しおよびエンコードの時間を個別に計測する
+    def path_trace():
+        ctx.path_trace(sample_max, ctx.program_path_trace)
+        # path_trace で入れ替えた画像を元に戻し，毎回同じ累積画像から始める
+        ctx.switch = ~ctx.switch & 1
+
+    def post_process():
+        ctx.post_process(
+            ctx.luminance_average, ctx.luminance_max, ctx.program_post_process
+        )
+        ctx.switch = ~ctx.switch & 1
+
+    ctx.current_sample = 1
+    ctx.render(sample_max)
+    stage_list = [
+        ("path_trace", path_trace),
+        (
+            "reduce_luminance_gpu",
+            lambda: ctx.reduce_luminance_gpu(ctx.program_reduce_luminance),
+        ),
+        ("reduce_luminance_numpy", ctx.reduce_luminance_numpy),
+        ("post_process", post_process),
+        ("read_output", ctx.read_output),
+        ("get_buffer", ctx.get_buffer),
+        ("get_binary", ctx.get_binary),
+        ("frame", lambda: (ctx.render(sample_max), ctx.get_binary())),
+    ]
+    return [(name, measure(ctx, func, repeat)) for name, func in stage_list]
+
+
+def compare_baseline(result, baseline, threshold, min_difference):
+    # 基準より threshold の割合以上，かつ min_difference [s] 以上遅くなった段階を返す
+    # （1 ms に満たない段階は揺らぎが大きいため，割合のみでは判定しない）
+    baseline_dict = {
+        (entry["width"], entry["height"], entry["sample_max"], entry["stage"]): entry
+        for entry in baseline["results"]
+    }
+    regression_list = []
+    for entry in result["results"]:
+        key = (entry["width"], entry["height"], entry["sample_max"], entry["stage"])
+        if key not in baseline_dict:
+            continue
+        seconds = baseline_dict[key]["seconds"]
+        ratio = entry["seconds"] / seconds
+        if ratio > 1 + threshold and entry["seconds"] - seconds > min_difference:
+            regression_list.append((key, ratio))
+    return regression_list
+
+
+def bench_suite(args):
+    # 解像度と sample_max を変えながら各段階の時間を計測し，JSON に書き出す
+    # --baseline を指定すると基準と比較し，遅くなった段階があれば終了コード 1 で終了する
+    ctx = Context()
+    ctx.bind_data(env_map_path=args.env_map)
+    ctx.create_program()
+    result = {
+        "environment": {
+            "renderer": ctx.context.info["GL_RENDERER"],
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+        },
+        "results": [],
+    }
+    for resolution in args.resolutions:
+        width, height = (int(value) for value in resolution.split("x"))
+        ctx.resize(width, height)
+        for sample_max in args.sample_maxes:
+            for stage, seconds in bench_suite_stages(ctx, sample_max, args.repeat):
+                entry = {
+                    "width": width,
+                    "height": height,
+                    "sample_max": sample_max,
+                    "stage": stage,
+                    "seconds": seconds,
+                    "frames_per_second": 1 / seconds,
+                }
+                if stage in ["path_trace", "frame"]:
+                    entry["samples_per_second"] = width * height * sample_max / seconds
+                result["results"].append(entry)
+                print(
+                    f"{width:>5}x{height:<5} spp {sample_max:>3} {stage:>22}: "
+                    f"{seconds * 1000:9.2f} ms {1 / seconds:8.2f} fps"
+                    + (
+                        f" {entry['samples_per_second'] / 1e6:7.2f} Msamples/s"
+                        if "samples_per_second" in entry
+                        else ""
+                    )
+                )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regression_list = compare_baseline(
+            result, baseline, args.threshold, args.min_difference
+        )
+        for (width, height, sample_max, stage), ratio in regression_list:
+            print(
+                f"regression: {width}x{height} spp {sample_max} {stage} "
+                f"is {ratio:.2f}x slower than the baseline"
+            )
+        if regression_list:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--width", type=int, default=960)
+    parser.add_argument("--height", type=int, default=540)
+    parser.add_argument("--sample-max", type=int, default=1)
+    parser.add_argument("--frames", type=int, default=30)
+    parser.add_argument("--env-map", default="tests/data/test_env_map.hdr")
+    subparsers = parser.add_subparsers(required=True)
+    subparsers.add_parser("readback").set_defaults(func=bench_readback)
+    scene_parser = subparsers.add_parser("scene")
+    scene_parser.add_argument(
+        "--sphere-counts", type=int, nargs="+", default=[2, 16, 128, 1024, 4096]
+    )
+    scene_parser.set_defaults(func=bench_scene)
+    subparsers.add_parser("env-map").set_defaults(func=bench_env_map)
+    subparsers.add_parser("resize").set_defaults(func=bench_resize)
+    subparsers.add_parser("preview").set_defaults(func=bench_preview)
+    subparsers.add_parser("accumulation").set_defaults(func=bench_accumulation)
+    farm_parser = subparsers.add_parser("farm")
+    farm_parser.add_argument(
+        "--worker-counts",
+        type=int,
+        nargs="+",
+        default=sorted({1, 2, 4, os.cpu_count()}),
+    )
+    farm_parser.add_argument("--threads-per-worker", type=int, default=None)
+    farm_parser.set_defaults(func=bench_farm)
+    subparsers.add_parser("profile").set_defaults(func=bench_profile)
+    subparsers.add_parser("codec").set_defaults(func=bench_codec)
+    preset_parser = subparsers.add_parser("preset")
+    preset_parser.add_argument("--reference-spp", type=int, default=1024)
+    preset_parser.add_argument("--reference-depth", type=int, default=64)
+    preset_parser.set_defaults(func=bench_preset)
+    denoise_parser = subparsers.add_parser("denoise")
+    denoise_parser.add_argument("--reference-spp", type=int, default=1024)
+    denoise_parser.add_argument("--denoise-sample-max", type=int, default=64)
+    denoise_parser.set_defaults(func=bench_denoise)
+    tiles_parser = subparsers.add_parser("tiles")
+    tiles_parser.add_argument(
+        "--budgets", type=float, nargs="+", default=[0, 0.1, 0.03]
+    )
+    tiles_parser.add_argument("--tile-size", type=int, default=256)
+    tiles_parser.add_argument(
+        "--tile-order", choices=TileScheduler.ORDER_LIST, default="centre"
+    )
+    tiles_parser.set_defaults(func=bench_tiles)
+    frame_skip_parser = subparsers.add_parser("frame-skip")
+    frame_skip_parser.add_argument(
+        "--thresholds", type=float, nargs="+", default=[0, 35, 40, 45, 50]
+    )
+    frame_skip_parser.set_defaults(func=bench_frame_skip)
+    suite_parser = subparsers.add_parser("suite")
+    suite_parser.add_argument(
+        "--resolutions", nargs="+", default=["240x135", "480x270", "960x540"]
+    )
+    suite_parser.add_argument("--sample-maxes", type=int, nargs="+", default=[1, 4])
+    suite_parser.add_argument("--repeat", type=int, default=5)
+    suite_parser.add_argument("--output", default=None)
+    suite_parser.add_argument("--baseline", default=None)
+    # 基準に対して許容する遅れの割合
+    suite_parser.add_argument("--threshold", type=float, default=0.2)
+    suite_parser.add_argument("--min-difference", type=float, default=0.001)
+    suite_parser.set_defaults(func=bench_suite)
+    args = parser.parse_args()
+    args.func(args)
@@ -41,6 +41,7 @@ fragments[
 ] = """
 !mkdir -p app
 !mkdir -p assets/glsl
+!mkdir -p assets/scene
 !mkdir -p colab
 """
 
@@ -59,10 +60,41 @@ fragments["write_fragment_shader_post_process.glsl"] = (
     + open("assets/glsl/fragment_shader_post_process.glsl", encoding="utf-8").read()
 )
 
+fragments["write_fragment_shader_reduce_luminance.glsl"] = (
+    "%%file assets/glsl/fragment_shader_reduce_luminance.glsl\n"
+    + open("assets/glsl/fragment_shader_reduce_luminance.glsl", encoding="utf-8").read()
+)
+
+fragments["write_fragment_shader_denoise.glsl"] = (
+    "%%file assets/glsl/fragment_shader_denoise.glsl\n"
+    + open("assets/glsl/fragment_shader_denoise.glsl", encoding="utf-8").read()
+)
+
+fragments["write_default.json"] = (
+    "%%file assets/scene/default.json\n"
+    + open("assets/scene/default.json", encoding="utf-8").read()
+)
+
 fragments["write_server.py"] = (
     "%%file app/server.py\n" + open("app/server.py", encoding="utf-8").read()
 )
 
+fragments["write_worker.py"] = (
+    "%%file app/worker.py\n" + open("app/worker.py", encoding="utf-8").read()
+)
+
+fragments["write_farm.py"] = (
+    "%%file app/farm.py\n" + open("app/farm.py", encoding="utf-8").read()
+)
+
+fragments["write_metrics.py"] = (
+    "%%file app/metrics.py\n" + open("app/metrics.py", encoding="utf-8").read()
+)
+
+fragments["write_protocol.py"] = (
+    "%%file app/protocol.py\n" + open("app/protocol.py", encoding="utf-8").read()
+)
+
 fragments["write_render.py"] = (
     "%%file app/render.py\n" + open("app/render.py", encoding="utf-8").read()
 )
@@ -130,7 +162,14 @@ notebook["cells"] = [
     new_code_cell("write_vertex_shader.glsl"),
     new_code_cell("write_fragment_shader_path_trace.glsl"),
     new_code_cell("write_fragment_shader_post_process.glsl"),
+    new_code_cell("write_fragment_shader_reduce_luminance.glsl"),
+    new_code_cell("write_fragment_shader_denoise.glsl"),
+    new_code_cell("write_default.json"),
     new_code_cell("write_server.py"),
+    new_code_cell("write_worker.py"),
+    new_code_cell("write_farm.py"),
+    new_code_cell("write_metrics.py"),
+    new_code_cell("write_protocol.py"),
     new_code_cell("write_render.py"),
     new_code_cell("download_environment_map"),
     new_code_cell("describe_instance_information"),
@@ -90,6 +90,88 @@ class SessionManager {
         );
       }
     });
+
+    this.gamma = document.getElementById("gamma");
+    this.gammaSlider = document.getElementById("gamma-slider");
+    this.gammaSlider.addEventListener("input", function (e) {
+      self.gamma.value = e.target.value;
+      if (self.websocket?.readyState !== 1) return;
+      if (self.websocket) {
+        self.websocket.send(
+          JSON.stringify({
+            gamma: Number(self.gamma.value),
+          })
+        );
+      }
+    });
+
+    this.envMap = document.getElementById("env-map");
+    this.envMap.addEventListener("change", function (e) {
+      if (self.websocket?.readyState !== 1) return;
+      if (self.websocket) {
+        self.websocket.send(
+          JSON.stringify({
+            envMap: e.target.value,
+          })
+        );
+      }
+    });
+
+    // 解像度（表示領域や回線の帯域に合わせて選ぶ）
+    this.resolution = document.getElementById("resolution");
+    this.resolution.addEventListener("change", function (e) {
+      if (self.websocket?.readyState !== 1) return;
+      if (self.websocket) {
+        self.websocket.send(
+          JSON.stringify({
+            resolution: e.target.value.split("x").map(Number),
+          })
+        );
+      }
+    });
+
+    // 画質のプリセット（反射の回数とロシアンルーレット，変えるとサンプリングをやり直す）
+    this.preset = document.getElementById("preset");
+    this.preset.addEventListener("change", function (e) {
+      if (self.websocket?.readyState !== 1) return;
+      if (self.websocket) {
+        self.websocket.send(
+          JSON.stringify({
+            preset: e.target.value,
+          })
+        );
+      }
+    });
+
+    // 送信用画像のコーデックと品質（保存には png，ローカル接続には raw が向く）
+    this.codec = document.getElementById("codec");
+    this.quality = document.getElementById("quality");
+    [this.codec, this.quality].forEach((element) => {
+      element.addEventListener("change", function () {
+        if (self.websocket?.readyState !== 1) return;
+        if (self.websocket) {
+          self.websocket.send(
+            JSON.stringify({
+              codec: self.codec.value,
+              quality: self.quality.value ? Number(self.quality.value) : null,
+            })
+          );
+        }
+      });
+    });
+
+    // 段階ごとの時間の要約を1秒ごとに受け取る
+    this.metrics = document.getElementById("metrics");
+    this.metrics.addEventListener("change", function (e) {
+      if (self.websocket?.readyState !== 1) return;
+      if (self.websocket) {
+        self.websocket.send(
+          JSON.stringify({
+            metrics: e.target.checked,
+          })
+        );
+      }
+    });
   }
 
   init_websocket(url) {
@@ -103,38 +185,116 @@ class SessionManager {
       websocket.onclose = () => {
         console.log("close");
       };
+      // フレームはヘッダ（app/protocol.py を参照）と画像からなるバイナリメッセージ
+      websocket.binaryType = "arraybuffer";
       websocket.onmessage = (message) => {
-        message.data
-          .slice(0, 4)
-          .text()
-          .then((header) => {
-            switch (header) {
-              // レンダリング結果画像を canvas に表示
-              case "0000": {
-                createImageBitmap(message.data.slice(4)).then((bitmap) => {
-                  this.canvas.width = bitmap.width;
-                  this.canvas.height = bitmap.height;
-                  this.canvas.getContext("2d").drawImage(bitmap, 0, 0);
-                });
-                break;
-              }
-              // 現在の1画素あたりのサンプル数をフォームに表示
-              case "0001": {
-                message.data
-                  .slice(4)
-                  .arrayBuffer()
-                  .then((sample) => {
-                    document.getElementById("current-spp").value =
-                      sample.byteLength;
-                  });
-                break;
-              }
-            }
-          });
+        // テキストメッセージは JSON（切り替えられる環境マップの一覧，または計測結果の要約）
+        if (typeof message.data === "string") {
+          const data = JSON.parse(message.data);
+          this.updateEnvMaps(data.envMaps);
+          this.updateMetrics(data.metrics);
+          return;
+        }
+        const frame = this.decodeFrame(message.data);
+        if (frame === null) return;
+        // レンダリング結果画像を canvas に表示
+        createImageBitmap(frame.image).then((bitmap) => {
+          this.canvas.width = bitmap.width;
+          this.canvas.height = bitmap.height;
+          this.canvas.getContext("2d").drawImage(bitmap, 0, 0);
+        });
+        // 現在の1画素あたりのサンプル数をフォームに表示
+        document.getElementById("current-spp").value = frame.spp;
+        // 収束済みの画素の割合と収束マップを表示
+        document.getElementById("converged").value = (
+          frame.converged * 100
+        ).toFixed(1);
+        this.drawConvergenceMap(frame);
       };
     });
   }
 
+  decodeFrame(buffer) {
+    const view = new DataView(buffer);
+    const magic = String.fromCharCode(
+      view.getUint8(0),
+      view.getUint8(1),
+      view.getUint8(2),
+      view.getUint8(3)
+    );
+    if (magic !== "VC2F" || view.getUint8(4) !== 2) {
+      console.log("unsupported frame");
+      return null;
+    }
+    const codec = ["image/jpeg", "image/webp", "image/png", "raw"][
+      view.getUint8(5)
+    ];
+    const headerSize = view.getUint16(6, true);
+    const mapWidth = view.getUint16(32, true);
+    const mapHeight = view.getUint16(34, true);
+    const payloadOffset = headerSize + mapWidth * mapHeight;
+    const width = view.getUint16(20, true);
+    const height = view.getUint16(22, true);
+    // raw は RGBA をそのまま ImageData として，それ以外は画像ファイルとして復号する
+    const image =
+      codec === "raw"
+        ? new ImageData(
+            new Uint8ClampedArray(buffer, payloadOffset, width * height * 4),
+            width,
+            height
+          )
+        : new Blob([new Uint8Array(buffer, payloadOffset)], { type: codec });
+    return {
+      frameId: view.getUint32(8, true),
+      generation: view.getUint32(12, true),
+      spp: view.getUint32(16, true),
+      width: width,
+      height: height,
+      renderTime: view.getFloat32(24, true),
+      encodeTime: view.getFloat32(28, true),
+      mapWidth: mapWidth,
+      mapHeight: mapHeight,
+      converged: view.getFloat32(36, true),
+      convergenceMap: new Uint8Array(buffer, headerSize, mapWidth * mapHeight),
+      image: image,
+    };
+  }
+
+  updateEnvMaps(envMaps) {
+    if (!envMaps) return;
+    const selected = this.envMap.value;
+    this.envMap.replaceChildren(
+      ...envMaps.map((name) => new Option(name, name, false, name === selected))
+    );
+  }
+
+  updateMetrics(metrics) {
+    if (!metrics) return;
+    // 段階ごとに p50 / p90 / p99 [ms] を表示する
+    document.getElementById("metrics-summary").textContent = Object.entries(
+      metrics
+    )
+      .map(
+        ([stage, value]) =>
+          `${stage.padEnd(16)} ${value.p50.toFixed(2)} / ` +
+          `${value.p90.toFixed(2)} / ${value.p99.toFixed(2)}`
+      )
+      .join("\n");
+  }
+
+  drawConvergenceMap(frame) {
+    // ブロックごとの収束済みの割合をグレースケールで描画する（白いほど収束している）
+    const canvas = document.getElementById("convergence-map");
+    if (frame.mapWidth === 0 || frame.mapHeight === 0) return;
+    canvas.width = frame.mapWidth;
+    canvas.height = frame.mapHeight;
+    const image = new ImageData(frame.mapWidth, frame.mapHeight);
+    frame.convergenceMap.forEach((value, i) => {
+      image.data.set([value, value, value, 255], i * 4);
+    });
+    canvas.getContext("2d").putImageData(image, 0, 0);
+  }
+
   start() {
     console.log("start");
     const url = document.getElementById("endpoint").value;
@@ -151,6 +311,13 @@ class SessionManager {
           moveY: this.moveY,
           maxSpp: this.maxSpp.value,
           keyValue: Number(this.keyValue.value),
+          gamma: Number(this.gamma.value),
+          envMap: this.envMap.value || undefined,
+          resolution: this.resolution.value.split("x").map(Number),
+          preset: this.preset.value,
+          codec: this.codec.value,
+          quality: this.quality.value ? Number(this.quality.value) : null,
+          metrics: this.metrics.checked,
         })
       );
     } else {
@@ -165,6 +332,13 @@ class SessionManager {
             moveY: this.moveY,
             maxSpp: this.maxSpp.value,
             keyValue: Number(this.keyValue.value),
+            gamma: Number(this.gamma.value),
+            envMap: this.envMap.value || undefined,
+            resolution: this.resolution.value.split("x").map(Number),
+            preset: this.preset.value,
+            codec: this.codec.value,
+            quality: this.quality.value ? Number(this.quality.value) : null,
+            metrics: this.metrics.checked,
           })
         );
       });
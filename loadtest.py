@@ -0,0 +1,343 @@
+import argparse
+import asyncio
+import json
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import cv2
+import numpy as np
+from websockets.client import connect
+from websockets.exceptions import ConnectionClosed
+
+from app.protocol import unpack_frame
+
+# 世代番号を進めないメッセージのキー（app/server.py を参照）
+NON_PARAMETER_KEYS = {"metrics"}
+
+
+def synthetic_trace(
+    client, duration, rate=60, seed=0, resolution=(240, 135), codec="jpeg"
+):
+    # docs/session-manager.js と同じメッセージの列を (client, time, message) のリストとして生成する
+    # 接続直後に全パラメータを送り，マウスのドラッグ（rate [Hz] で theta, phi）とトーンマッピングの
+    # スライダー操作（keyValue）を，手を止めてサンプリングを待つ時間を挟みながら繰り返す
+    # 乱数は (seed, client) から生成するため，同じ引数からは同じ列が得られる
+    rng = np.random.default_rng([seed, client])
+    theta, phi, key_value = 0.0, 0.0, 0.18
+    event_list = [
+        {
+            "client": client,
+            "time": 0.0,
+            "message": {
+                "theta": theta,
+                "phi": phi,
+                "moveX": 0,
+                "moveY": 0,
+                "maxSpp": "",
+                "keyValue": key_value,
+                "gamma": 2.2,
+                "resolution": list(resolution),
+                "preset": "interactive",
+                "codec": codec,
+                "quality": None,
+                "metrics": False,
+            },
+        }
+    ]
+    t = rng.uniform(0.2, 0.5)
+    while t < duration:
+        if rng.random() < 0.8:
+            # 1秒あたり theta, phi を speed [rad] ずつ回すドラッグ
+            speed = rng.normal(0, 1, 2)
+            for _ in range(int(rng.uniform(0.3, 1.5) * rate)):
+                theta += speed[0] / rate
+                phi += speed[1] / rate
+                event_list.append(
+                    {
+                        "client": client,
+                        "time": t,
+                        "message": {"theta": theta, "phi": phi},
+                    }
+                )
+                t += 1 / rate
+        else:
+            target = rng.uniform(0.05, 0.5)
+            for value in np.linspace(key_value, target, 10):
+                event_list.append(
+                    {"client": client, "time": t, "message": {"keyValue": float(value)}}
+                )
+                t += 1 / 30
+            key_value = target
+        t += rng.uniform(0.5, 2.0)
+    return [event for event in event_list if event["time"] < duration]
+
+
+def save_trace(path, event_list):
+    with open(path, "w", encoding="utf-8") as f:
+        for event in event_list:
+            f.write(json.dumps(event) + "\n")
+
+
+def load_trace(path):
+    # app/server.py --record で記録したメッセージの列を読み込み，クライアントごとに分ける
+    # 時刻は最初のメッセージを 0 とする（記録した間隔のまま再生する）
+    with open(path, encoding="utf-8") as f:
+        event_list = [json.loads(line) for line in f if line.strip()]
+    if not event_list:
+        raise ValueError(f"empty trace: {path}")
+    start = min(event["time"] for event in event_list)
+    trace_dict = {}
+    for event in sorted(event_list, key=lambda event: event["time"]):
+        trace_dict.setdefault(event["client"], []).append(
+            {**event, "time": event["time"] - start}
+        )
+    return list(trace_dict.values())
+
+
+def advances_generation(message):
+    return any(key not in NON_PARAMETER_KEYS for key in message)
+
+
+def decode(frame):
+    # 受け取った画像を復号する（クライアントと同じく，復号できないフレームは数える）
+    if frame["codec"] == "raw":
+        return np.frombuffer(frame["payload"], dtype=np.uint8).reshape(
+            frame["height"], frame["width"], 4
+        )
+    image = cv2.imdecode(np.frombuffer(frame["payload"], dtype=np.uint8), 1)
+    if image is None:
+        raise ValueError(f"failed to decode {frame['codec']} frame")
+    return image
+
+
+async def run_client(url, event_list, drain):
+    # event_list のメッセージを記録された時刻に送り，届いたフレームを時刻とともに記録する
+    # 接続を拒否された場合は rejected とする
+    result = {"send_time": {}, "frame_list": [], "decode_errors": 0, "rejected": False}
+    generation = 0
+
+    async def receive(websocket):
+        async for message in websocket:
+            if isinstance(message, str):
+                continue
+            receive_time = time.perf_counter()
+            frame = unpack_frame(message)
+            try:
+                decode(frame)
+            except ValueError:
+                result["decode_errors"] += 1
+            result["frame_list"].append(
+                {
+                    "time": receive_time,
+                    "frame_id": frame["frame_id"],
+                    "generation": frame["generation"],
+                    "size": len(message),
+                    "spp": frame["spp"],
+                    # 送った最新のパラメータより古い世代のフレーム
+                    "stale": frame["generation"] < generation,
+                }
+            )
+
+    try:
+        async with connect(url, max_size=None) as websocket:
+            receive_task = asyncio.create_task(receive(websocket))
+            start = time.perf_counter()
+            for event in event_list:
+                await asyncio.sleep(max(0, start + event["time"] - time.perf_counter()))
+                if receive_task.done():
+                    break
+                await websocket.send(json.dumps(event["message"]))
+                if advances_generation(event["message"]):
+                    generation += 1
+                    result["send_time"][generation] = time.perf_counter()
+            await asyncio.sleep(drain)
+            receive_task.cancel()
+            if websocket.close_code == 1013:
+                result["rejected"] = True
+    except ConnectionClosed as e:
+        result["rejected"] = e.rcvd is not None and e.rcvd.code == 1013
+    return result
+
+
+def summarize(result_list, elapsed, percentiles=(50, 90, 99)):
+    # 全クライアントの結果を集計する
+    # 遅延 (motion-to-photon) は，パラメータを送ってから，その世代以降のフレームが最初に届くまでの時間 [ms]
+    # superseded は，その世代のフレームが1つも届かないうちに次のパラメータで置き換えられた世代の数
+    # dropped は，レンダリングプロセスが送ったがサーバが捨てたフレームの数（フレーム番号の欠け）
+    latency_list = []
+    superseded = 0
+    dropped = 0
+    frame_list = []
+    for result in result_list:
+        client_frame_list = result["frame_list"]
+        generation_set = {frame["generation"] for frame in client_frame_list}
+        index = 0
+        for generation, send_time in sorted(result["send_time"].items()):
+            superseded += generation not in generation_set
+            while index < len(client_frame_list) and (
+                client_frame_list[index]["generation"] < generation
+            ):
+                index += 1
+            if index < len(client_frame_list):
+                latency_list.append(
+                    (client_frame_list[index]["time"] - send_time) * 1000
+                )
+        frame_id_list = [frame["frame_id"] for frame in client_frame_list]
+        if frame_id_list:
+            dropped += frame_id_list[-1] - frame_id_list[0] + 1 - len(frame_id_list)
+        frame_list.extend(client_frame_list)
+
+    summary = {
+        "clients": len(result_list),
+        "rejected": sum(result["rejected"] for result in result_list),
+        "frames": len(frame_list),
+        "fps": len(frame_list) / elapsed,
+        "bytes_per_frame": (
+            float(np.mean([frame["size"] for frame in frame_list]))
+            if frame_list
+            else 0.0
+        ),
+        "stale_frames": sum(frame["stale"] for frame in frame_list),
+        "dropped_frames": dropped,
+        "generations": sum(len(result["send_time"]) for result in result_list),
+        "superseded_generations": superseded,
+        "decode_errors": sum(result["decode_errors"] for result in result_list),
+        "latency_ms": {},
+    }
+    if latency_list:
+        summary["latency_ms"]["mean"] = float(np.mean(latency_list))
+        for percentile, quantile in zip(
+            percentiles, np.percentile(latency_list, percentiles)
+        ):
+            summary["latency_ms"][f"p{percentile}"] = float(quantile)
+    return summary
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(
+    port, max_sessions, record=None, log=None, timeout=120, server_args=()
+):
+    # app/server.py をループバックのポートで起動し，接続できるようになるまで待つ
+    # サーバの出力は log に書き出す（None の場合は捨てる）
+    # server_args は機能を有効にする引数（--denoise-sample-max 256 など）
+    command = [
+        sys.executable,
+        "app/server.py",
+        "--port",
+        str(port),
+        "--max-sessions",
+        str(max_sessions),
+    ]
+    if record is not None:
+        command += ["--record", record]
+    command += list(server_args)
+    output = subprocess.DEVNULL if log is None else open(log, "w", encoding="utf-8")
+    process = subprocess.Popen(command, stdout=output, stderr=subprocess.STDOUT)
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with code {process.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return process
+        except OSError:
+            time.sleep(0.2)
+    stop_server(process)
+    raise RuntimeError("server did not start in time")
+
+
+def stop_server(process):
+    # KeyboardInterrupt で終了させ，レンダリングプロセス（daemon）も後始末させる
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+async def run(url, trace_list, drain):
+    start = time.perf_counter()
+    result_list = await asyncio.gather(
+        *(run_client(url, event_list, drain) for event_list in trace_list)
+    )
+    return result_list, time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="simulate clients against the websocket server"
+    )
+    # 指定しない場合は app/server.py をループバックの空いているポートで起動する
+    parser.add_argument("--url", default=None)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--rate", type=float, default=60, help="pointermove [Hz]")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--resolution", default="240x135")
+    parser.add_argument("--codec", default="jpeg")
+    # 記録したメッセージの列を再生する（--clients などの生成用の引数は無視する）
+    parser.add_argument("--replay", default=None)
+    parser.add_argument("--save-trace", default=None)
+    # 起動したサーバにメッセージを記録させる
+    parser.add_argument("--record", default=None)
+    parser.add_argument("--server-log", default=None)
+    # 起動したサーバにそのまま渡す引数（--server-args="--denoise-sample-max 256" のように指定する）
+    parser.add_argument("--server-args", default="")
+    # 最後のメッセージを送ってから最後のフレームを待つ時間 [s]
+    parser.add_argument("--drain", type=float, default=2.0)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args(argv)
+
+    if args.replay is not None:
+        trace_list = load_trace(args.replay)
+    else:
+        resolution = tuple(int(value) for value in args.resolution.split("x"))
+        trace_list = [
+            synthetic_trace(
+                client, args.duration, args.rate, args.seed, resolution, args.codec
+            )
+            for client in range(args.clients)
+        ]
+    if args.save_trace is not None:
+        save_trace(
+            args.save_trace,
+            [event for event_list in trace_list for event in event_list],
+        )
+
+    process = None
+    url = args.url
+    if url is None:
+        port = free_port()
+        process = start_server(
+            port,
+            len(trace_list),
+            args.record,
+            args.server_log,
+            server_args=shlex.split(args.server_args),
+        )
+        url = f"ws://127.0.0.1:{port}"
+    try:
+        result_list, elapsed = asyncio.run(run(url, trace_list, args.drain))
+    finally:
+        if process is not None:
+            stop_server(process)
+
+    summary = summarize(result_list, elapsed)
+    print(json.dumps(summary, indent=2))
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
+import cv2
+import numpy as np
 import pytest
 from app.render import Context
 
@@ -15,3 +17,13 @@ def _get_context():
     if _ctx is None:
         _ctx = Context()
     return _ctx
+
+
+@pytest.fixture(scope="function")
+def sun_env_map_path(tmp_path):
+    # 小さく非常に明るい太陽のある環境マップ
+    env_map = np.full((64, 128, 3), 0.05, dtype="f4")
+    env_map[14:17, 40:43] = 2000
+    env_map_path = str(tmp_path / "sun.hdr")
+    cv2.imwrite(env_map_path, env_map)
+    return env_map_path
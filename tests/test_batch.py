@@ -0,0 +1,119 @@
+import json
+import math
+import subprocess
+import sys
+
+import cv2
+import pytest
+
+from app.batch import load_camera_path
+
+
+def test_load_camera_path(tmp_path):
+    path = tmp_path / "turntable.json"
+    path.write_text(json.dumps({"turntable": {"frames": 4, "phi": 0.1}}))
+    pose_list = load_camera_path(str(path))
+    assert [pose["theta"] for pose in pose_list] == pytest.approx(
+        [0, math.pi / 2, math.pi, math.pi * 3 / 2]
+    )
+    assert [pose["name"] for pose in pose_list] == ["0000", "0001", "0002", "0003"]
+    assert all(pose["phi"] == 0.1 for pose in pose_list)
+
+    # キーフレームの間は線形補間する
+    path = tmp_path / "keyframes.json"
+    path.write_text(
+        json.dumps(
+            {
+                "keyframes": [
+                    {"frame": 0, "theta": 0, "move_x": 1},
+                    {"frame": 4, "theta": 2, "move_x": -1},
+                ]
+            }
+        )
+    )
+    pose_list = load_camera_path(str(path))
+    assert [pose["theta"] for pose in pose_list] == [0, 0.5, 1, 1.5, 2]
+    assert [pose["move_x"] for pose in pose_list] == [1, 0.5, 0, -0.5, -1]
+
+    # CSV の空欄や無い列は 0 とする
+    path = tmp_path / "poses.csv"
+    path.write_text("name,theta,phi\nfront,0,0.2\nside,1.5,\n")
+    pose_list = load_camera_path(str(path))
+    assert pose_list == [
+        {"theta": 0, "phi": 0.2, "move_x": 0, "move_y": 0, "name": "front"},
+        {"theta": 1.5, "phi": 0, "move_x": 0, "move_y": 0, "name": "side"},
+    ]
+
+
+def test_render_camera_path(tmp_path):
+    path = tmp_path / "turntable.json"
+    path.write_text(json.dumps({"turntable": {"frames": 3}}))
+    output = tmp_path / "output"
+
+    # GL コンテキストはプロセスごとに1つのため，別のプロセスで実行する
+    subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "app",
+            "render",
+            str(path),
+            "-o",
+            str(output),
+            "--format",
+            "jpg",
+            "--width",
+            "96",
+            "--height",
+            "54",
+            "--spp",
+            "4",
+            "--sample-per-frame",
+            "2",
+            "--env-map",
+            "tests/data/test_env_map.hdr",
+            "--processes",
+            "2",
+        ],
+        check=True,
+        timeout=120,
+    )
+    assert sorted(p.name for p in output.iterdir()) == [
+        "0000.jpg",
+        "0001.jpg",
+        "0002.jpg",
+    ]
+    image = cv2.imread(str(output / "0000.jpg"))
+    assert image.shape == (54, 96, 3)
+
+
+def test_render_camera_path_cpu(tmp_path):
+    path = tmp_path / "poses.csv"
+    path.write_text("name,theta\nfront,0\n")
+    output = tmp_path / "output"
+    subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "app",
+            "render",
+            str(path),
+            "-o",
+            str(output),
+            "--format",
+            "png",
+            "--width",
+            "32",
+            "--height",
+            "18",
+            "--spp",
+            "2",
+            "--env-map",
+            "tests/data/test_env_map.hdr",
+            "--cpu",
+        ],
+        check=True,
+        timeout=120,
+    )
+    image = cv2.imread(str(output / "front.png"))
+    assert image.shape == (18, 32, 3)
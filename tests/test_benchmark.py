@@ -0,0 +1,20 @@
+import argparse
+
+from benchmark import bench_denoise
+
+
+def test_bench_denoise(capsys):
+    # denoise_sample_max のサンプル数まで計測する（最後はデノイズせず，元の画像と同じ誤差になる）
+    args = argparse.Namespace(
+        width=96,
+        height=54,
+        sample_max=4,
+        env_map="tests/data/test_env_map.hdr",
+        reference_spp=16,
+        denoise_sample_max=4,
+    )
+    bench_denoise(args)
+    line_list = capsys.readouterr().out.splitlines()
+    assert [line.split()[0] for line in line_list] == ["1", "2", "4"]
+    rmse_list = line_list[-1].split("RMSE ")[1].split(",")[0].split(" -> ")
+    assert rmse_list[0] == rmse_list[1]
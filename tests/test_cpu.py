@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from app import cpu
+
+
+@pytest.fixture(scope="module")
+def scene():
+    return cpu.load_scene("assets/scene/default.json")
+
+
+@pytest.fixture(scope="module")
+def env_map():
+    return cpu.load_env_map("tests/data/test_env_map.hdr")
+
+
+def block_mean(image, size=6):
+    height, width = image.shape[0] // size, image.shape[1] // size
+    return (
+        image[: height * size, : width * size, :3]
+        .reshape(height, size, width, size, 3)
+        .mean(axis=(1, 3))
+    )
+
+
+def test_cpu_render_processes(scene, env_map):
+    # 乱数は行の範囲とサンプルの番号から生成するため，プロセス数によらず同じ結果となる
+    # ただし NumPy の AVX-512 の実装は配列の配置によって np.arctan2 などの最終桁が変わるため，
+    # 完全には一致しない（環境マップの参照位置が変わるのみで，光線の経路は変わらない）
+    kwargs = {"camera": {"theta": 0.3, "phi": 0.1}, "chunk_size": 256}
+    radiance = cpu.render(scene, env_map, 32, 18, 2, **kwargs)
+    assert radiance.shape == (18, 32, 3)
+    assert np.all(np.isfinite(radiance))
+    np.testing.assert_allclose(
+        cpu.render(scene, env_map, 32, 18, 2, processes=2, **kwargs),
+        radiance,
+        rtol=1e-12,
+    )
+    # sample_offset を変えると独立したサンプルになる
+    assert not np.array_equal(
+        cpu.render(scene, env_map, 32, 18, 2, sample_offset=2, **kwargs), radiance
+    )
+
+
+def test_cpu_render_matches_gpu(ctx, scene, env_map):
+    # NumPy で十分なサンプル数をとった画像を正解とし，GPU の画像の偏りを調べる
+    ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+    ctx.create_program()
+    ctx.resize(96, 54)
+    try:
+        reference = cpu.render(scene, env_map, 96, 54, 256)
+        error_list = []
+        sample = 0
+        for spp in [16, 64, 256]:
+            while sample < spp:
+                ctx.current_sample = sample + 1
+                ctx.render(16)
+                sample += 16
+            radiance = ctx.read_accumulation()[0][:, :, :3].astype("f8")
+            # 画像全体の平均値は一致し，ブロックごとの誤差はサンプル数とともに減る
+            assert radiance.mean() == pytest.approx(reference.mean(), rel=0.005)
+            error_list.append(
+                np.sqrt(np.mean((block_mean(radiance) - block_mean(reference)) ** 2))
+                / reference.mean()
+            )
+        assert error_list[-1] < error_list[0]
+        assert error_list[-1] < 0.01
+
+        # トーンマッピングも GPU の送信用画像と一致する
+        buffer = cpu.tone_map(radiance)
+        assert np.abs(buffer.astype(int) - ctx.get_buffer()).max() <= 1
+    finally:
+        ctx.resolution = (960, 540)
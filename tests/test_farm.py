@@ -0,0 +1,58 @@
+import numpy as np
+
+from app.farm import RenderFarm
+from app.render import Context
+
+
+def create_context():
+    ctx = Context(width=96, height=54)
+    ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+    ctx.create_program()
+    return ctx
+
+
+def test_render_farm(ctx):
+    ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+    ctx.create_program()
+    session = ctx.create_session()
+    ctx.resize(96, 54)
+    farm = RenderFarm(create_context, 2)
+    farm.start()
+    try:
+        # 3 サンプルを 2 サンプルと 1 サンプルに分けて，累積画像に足し合わせる
+        ctx.current_sample = 1
+        farm.render(ctx, 3)
+        assert ctx.current_sample == 4
+        farm.render(ctx, 3)
+        assert ctx.current_sample == 7
+        assert ctx.get_buffer().shape == (54, 96, 3)
+        merged = ctx.read_accumulation()[0]
+
+        # 1つのコンテキストで同じサンプル数をレンダリングした場合と，平均値が一致する
+        ctx.current_sample = 1
+        ctx.render(6)
+        local = ctx.read_accumulation()[0]
+        assert abs(merged[:, :, :3].mean() / local[:, :, :3].mean() - 1) < 0.05
+
+        # プロセスごとに異なるシード画像を用いるため，分割しても同じ画像にはならない
+        assert not np.array_equal(merged, local)
+
+        # 輝度の2次モーメントも足し合わせ，合成した累積画像で収束判定をやり直す
+        ctx.convergence_threshold = 1.0
+        ctx.convergence_sample_min = 2
+        ctx.current_sample = 1
+        farm.render(ctx, 3)
+        moment = ctx.read_accumulation()[2]
+        assert np.all(moment[:, :, 1] == 3)
+        assert ctx.converged_ratio == np.mean(moment[:, :, 2])
+        assert 0 < ctx.converged_ratio
+        assert ctx.convergence_map.max() > 0
+        ctx.current_sample = 1
+        ctx.render(3)
+        local_moment = ctx.read_accumulation()[2]
+        assert abs(moment[:, :, 0].mean() / local_moment[:, :, 0].mean() - 1) < 0.1
+    finally:
+        ctx.convergence_threshold = 0.0
+        ctx.convergence_sample_min = 16
+        farm.stop()
+        ctx.release_session(session)
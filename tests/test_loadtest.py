@@ -0,0 +1,74 @@
+import pytest
+
+from loadtest import (
+    advances_generation,
+    load_trace,
+    save_trace,
+    summarize,
+    synthetic_trace,
+)
+
+
+def test_synthetic_trace():
+    event_list = synthetic_trace(0, 10, seed=1)
+    assert event_list == synthetic_trace(0, 10, seed=1)
+    assert event_list != synthetic_trace(1, 10, seed=1)
+    assert "resolution" in event_list[0]["message"]
+    time_list = [event["time"] for event in event_list]
+    assert time_list == sorted(time_list)
+    assert time_list[-1] < 10
+
+
+def test_save_load_trace(tmp_path):
+    path = str(tmp_path / "trace.jsonl")
+    event_list = synthetic_trace(0, 3) + synthetic_trace(1, 3)
+    save_trace(path, event_list)
+    trace_list = load_trace(path)
+    assert len(trace_list) == 2
+    assert [event["message"] for event in trace_list[0]] == [
+        event["message"] for event in event_list if event["client"] == 0
+    ]
+    assert trace_list[0][0]["time"] == 0
+
+
+def test_advances_generation():
+    assert advances_generation({"theta": 0.5})
+    assert advances_generation({"theta": 0.5, "metrics": True})
+    assert not advances_generation({"metrics": True})
+
+
+def test_summarize():
+    def frame(time, frame_id, generation, stale=False):
+        return {
+            "time": time,
+            "frame_id": frame_id,
+            "generation": generation,
+            "size": 100,
+            "spp": 16,
+            "stale": stale,
+        }
+
+    # 世代 2 は世代 3 に置き換えられ，フレーム番号 2 はサーバで捨てられた
+    result = {
+        "send_time": {1: 0.0, 2: 1.0, 3: 1.01},
+        "frame_list": [
+            frame(0.05, 0, 1),
+            frame(0.5, 1, 1),
+            frame(1.1, 3, 1, stale=True),
+            frame(1.2, 4, 3),
+        ],
+        "decode_errors": 0,
+        "rejected": False,
+    }
+    rejected = {"send_time": {}, "frame_list": [], "decode_errors": 0, "rejected": True}
+    summary = summarize([result, rejected], 2.0)
+    assert summary["clients"] == 2
+    assert summary["rejected"] == 1
+    assert summary["frames"] == 4
+    assert summary["fps"] == 2
+    assert summary["stale_frames"] == 1
+    assert summary["dropped_frames"] == 1
+    assert summary["generations"] == 3
+    assert summary["superseded_generations"] == 1
+    # 世代 1: 50 ms, 世代 2, 3: 1.2 s に届いた世代 3 のフレームまで
+    assert summary["latency_ms"]["mean"] == pytest.approx((50 + 200 + 190) / 3)
@@ -0,0 +1,39 @@
+import numpy as np
+
+from app.metrics import STAGE_LIST, Metrics
+
+
+def test_metrics_summary():
+    metrics = Metrics(capacity=100)
+    for value in range(1, 151):
+        metrics.record({"path_trace": value, "encode": 1.0, "unknown": 2.0})
+
+    # 直近 capacity フレーム分のみが集計される
+    summary = metrics.summary()
+    assert set(summary) == {"path_trace", "encode"}
+    assert summary["path_trace"]["count"] == 100
+    assert summary["path_trace"]["mean"] == np.mean(np.arange(51, 151))
+    assert summary["path_trace"]["p50"] == np.percentile(np.arange(51, 151), 50)
+    assert summary["path_trace"]["p99"] == np.percentile(np.arange(51, 151), 99)
+    assert summary["encode"]["p90"] == 1.0
+
+    # 計測されなかった段階は集計から除く
+    metrics.record({"send": 3.0})
+    summary = metrics.summary()
+    assert summary["send"]["count"] == 1
+    assert summary["path_trace"]["count"] == 99
+
+
+def test_metrics_prometheus():
+    metrics = Metrics()
+    metrics.record({"path_trace": 10.0})
+    metrics.record({"path_trace": 30.0, "send": 1.0})
+
+    line_list = metrics.prometheus().splitlines()
+    assert "# TYPE vc2_stage_seconds summary" in line_list
+    assert 'vc2_stage_seconds{stage="path_trace",quantile="0.5"} 0.02' in line_list
+    assert 'vc2_stage_seconds_count{stage="path_trace"} 2' in line_list
+    assert 'vc2_stage_seconds_sum{stage="path_trace"} 0.04' in line_list
+    assert 'vc2_stage_seconds_count{stage="send"} 1' in line_list
+    assert 'vc2_stage_seconds_count{stage="encode"} 0' in line_list
+    assert len([line for line in line_list if "_count" in line]) == len(STAGE_LIST)
@@ -0,0 +1,50 @@
+import pytest
+
+from app.protocol import HEADER, pack_frame, unpack_frame
+
+
+def test_pack_frame():
+    frame = {
+        "codec": "jpeg",
+        "frame_id": 3,
+        "generation": 2,
+        "spp": 192,
+        "width": 960,
+        "height": 540,
+        "render_time": 12.5,
+        "encode_time": 1.25,
+        "map_width": 3,
+        "map_height": 2,
+        "converged": 0.5,
+        "convergence_map": bytes([0, 255, 128, 0, 255, 128]),
+        "payload": b"\xff\xd8\xff\xd9",
+    }
+    message = pack_frame(frame)
+
+    assert HEADER.size == 40
+    assert len(message) == HEADER.size + 6 + len(frame["payload"])
+    assert unpack_frame(message) == frame
+
+
+def test_pack_frame_codec():
+    frame = {
+        "codec": "raw",
+        "frame_id": 1,
+        "generation": 1,
+        "spp": 1,
+        "width": 2,
+        "height": 1,
+        "render_time": 1.0,
+        "encode_time": 0.0,
+        "map_width": 0,
+        "map_height": 0,
+        "converged": 0.0,
+        "convergence_map": b"",
+        "payload": bytes(range(8)),
+    }
+    assert unpack_frame(pack_frame(frame)) == frame
+
+
+def test_unpack_frame_invalid():
+    with pytest.raises(ValueError):
+        unpack_frame(b"0000" + bytes(HEADER.size))
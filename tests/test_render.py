@@ -1,5 +1,18 @@
+import json
+import os
+import time
+
 import cv2
 import numpy as np
+import pytest
+
+from app.render import (
+    AccumulationCache,
+    EnvMapStore,
+    TileScheduler,
+    build_bvh,
+    build_env_map_cdf,
+)
 
 
 def test_create_context(ctx):
@@ -12,6 +25,11 @@ def test_bind_data(ctx):
 
 def test_create_program(ctx):
     ctx.create_program()
+    program = ctx.program_path_trace
+
+    # 2回目以降はコンパイル済みのプログラムを使い回す
+    ctx.create_program()
+    assert ctx.program_path_trace is program
 
 
 def test_render(ctx):
@@ -49,13 +67,716 @@ def get_mssim(src1, src2):
     return mssim
 
 
-def test_get_binary(ctx):
-    reference = cv2.imread("tests/data/reference.jpg", cv2.IMREAD_COLOR)
-    rendered = cv2.imdecode(
-        np.frombuffer(ctx.get_binary(), dtype=np.uint8), cv2.IMREAD_COLOR
-    )
+def get_reference_mssim(ctx, reference_path, light_sampling, preset=None):
+    # update_reference.py と同じ条件（シード画像を初期化して 1 spp）でレンダリングして比べる
+    # preset が None の場合はロシアンルーレット無し
+    depth_max, roulette_depth = ctx.depth_max, ctx.roulette_depth
+    ctx.light_sampling = light_sampling
+    if preset is None:
+        ctx.roulette_depth = ctx.depth_max
+    else:
+        ctx.use_preset(preset)
+    try:
+        ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+        ctx.current_sample = 1
+        ctx.render(1)
+        reference = cv2.imread(reference_path, cv2.IMREAD_COLOR)
+        rendered = cv2.imdecode(
+            np.frombuffer(ctx.get_binary(), dtype=np.uint8), cv2.IMREAD_COLOR
+        )
+    finally:
+        ctx.light_sampling = True
+        ctx.depth_max, ctx.roulette_depth = depth_max, roulette_depth
     mssim = get_mssim(reference, rendered)
 
     print("\nSSIM: " + str(mssim) + "\n")
 
-    assert mssim > 0.98
+    return mssim
+
+
+def test_get_binary(ctx):
+    # 従来の設定（光源サンプリング無し）の描画結果は変わらない
+    assert get_reference_mssim(ctx, "tests/data/reference.jpg", False) > 0.98
+
+
+def test_get_binary_light_sampling(ctx):
+    assert (
+        get_reference_mssim(ctx, "tests/data/reference_light_sampling.jpg", True) > 0.98
+    )
+
+
+def test_get_binary_default(ctx):
+    # 既定の設定（光源サンプリングと balanced のロシアンルーレット）
+    assert (
+        get_reference_mssim(ctx, "tests/data/reference_default.jpg", True, "balanced")
+        > 0.98
+    )
+
+
+def test_reduce_luminance(ctx):
+    ctx.render(1)
+    average_gpu, max_gpu, converged_gpu = ctx.reduce_luminance_gpu(
+        ctx.program_reduce_luminance
+    )
+    average_numpy, max_numpy, converged_numpy = ctx.reduce_luminance_numpy()
+
+    assert np.isclose(average_gpu, average_numpy, rtol=1e-4)
+    assert np.isclose(max_gpu, max_numpy)
+    assert converged_gpu == converged_numpy == 0
+
+
+def test_gpu_reduction(ctx):
+    buffers = []
+    try:
+        for gpu_reduction in [True, False]:
+            ctx.gpu_reduction = gpu_reduction
+            ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+            ctx.render(1)
+            buffers.append(ctx.get_buffer().astype(np.int16))
+    finally:
+        ctx.gpu_reduction = True
+
+    assert np.abs(buffers[0] - buffers[1]).max() <= 1
+
+
+def test_get_binary_async(ctx):
+    ctx.readback_buffer_count = 2
+    try:
+        ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+
+        ctx.render(1)
+        assert ctx.get_binary_async() is None
+        binary_sync = ctx.get_binary()
+        ctx.render(1)
+        assert ctx.get_binary_async() == binary_sync
+        assert ctx.flush_binary_async() == [ctx.get_binary()]
+    finally:
+        ctx.readback_buffer_count = 0
+        ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+
+
+def test_create_session(ctx):
+    default_session = ctx.session
+    ctx.render(1)
+    binary_default = ctx.get_binary()
+
+    session = ctx.create_session()
+    try:
+        ctx.theta = 1.0
+        ctx.render(1)
+        binary_session = ctx.get_binary()
+        assert binary_session != binary_default
+
+        # 別のセッションでレンダリングしても，既定のセッションの状態は変わらない
+        ctx.use_session(default_session)
+        assert ctx.theta == 0
+        assert ctx.get_binary() == binary_default
+    finally:
+        ctx.release_session(session)
+        ctx.use_session(default_session)
+
+
+def test_redisplay(ctx):
+    ctx.render(1)
+    binary = ctx.get_binary()
+
+    try:
+        ctx.key_value = 0.36
+        ctx.redisplay()
+        assert ctx.get_binary() != binary
+    finally:
+        ctx.key_value = 0.18
+
+    # 累積画像は変わらないので，元の値に戻すと同じ画像になる
+    ctx.redisplay()
+    assert ctx.get_binary() == binary
+
+
+def test_adaptive_sampling(ctx):
+    ctx.convergence_threshold = 0.05
+    ctx.convergence_sample_min = 4
+    try:
+        ctx.current_sample = 1
+        ctx.render(4)
+        ctx.current_sample = 5
+        ctx.render(4)
+
+        # 背景など分散の小さい画素のみが収束済みになる
+        assert 0 < ctx.converged_ratio < 1
+        convergence_map = ctx.convergence_map
+        assert convergence_map.shape == (68, 120)
+        ctx.gpu_reduction = False
+        assert np.abs(ctx.reduce_convergence_map() - convergence_map).max() <= 1
+        ctx.gpu_reduction = True
+
+        # 収束済みの画素はサンプリングされず，残りの画素により多くのサンプルが割り当てられる
+        moment = np.frombuffer(
+            ctx.moment_image_list[~ctx.switch & 1].read(), dtype="f4"
+        ).reshape(ctx.height, ctx.width, 4)
+        converged = moment[:, :, 2] > 0.5
+        ctx.current_sample = 9
+        ctx.render(4)
+        moment_next = np.frombuffer(
+            ctx.moment_image_list[~ctx.switch & 1].read(), dtype="f4"
+        ).reshape(ctx.height, ctx.width, 4)
+        sample_count = moment_next[:, :, 1] - moment[:, :, 1]
+        assert (sample_count[converged] == 0).all()
+        assert (sample_count[~converged] > 4).all()
+    finally:
+        ctx.convergence_threshold = 0.0
+        ctx.convergence_sample_min = 16
+        ctx.gpu_reduction = True
+        ctx.current_sample = 1
+
+
+def test_build_bvh():
+    rng = np.random.default_rng(0)
+    lower = rng.uniform(-10, 10, (100, 3)).astype("f4")
+    upper = lower + rng.uniform(0, 1, (100, 3)).astype("f4")
+    node_array, order = build_bvh(lower, upper, leaf_size=4)
+
+    assert sorted(order) == list(range(100))
+    primitive_count = 0
+    for node, value in enumerate(node_array):
+        box_lower, a, box_upper, count = value[:3], value[3], value[4:7], value[7]
+        if count > 0:
+            # 葉の境界ボックスは参照するプリミティブをすべて含む
+            primitive = order[int(a) : int(a + count)]
+            assert count <= 4
+            assert (lower[primitive] >= box_lower).all()
+            assert (upper[primitive] <= box_upper).all()
+            primitive_count += count
+        else:
+            # 内部節点のスキップ先は部分木の直後の節点
+            assert node + 1 < a <= len(node_array)
+    assert primitive_count == 100
+
+
+def test_bind_scene(ctx):
+    with open("assets/scene/default.json", encoding="utf-8") as f:
+        scene = json.load(f)
+    ctx.current_sample = 1
+    ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+    ctx.render(1)
+    buffer = ctx.get_buffer().astype(np.int16)
+
+    # 光線が届かない床の下に球を追加しても，BVH をたどった結果は変わらない
+    rng = np.random.default_rng(0)
+    for center in rng.uniform([-100, -30000, -100], [100, -20000, 100], (64, 3)):
+        scene["spheres"].append(
+            {
+                "center": center.tolist(),
+                "radius": 1.0,
+                "scatter": [0.5, 0.5, 0.5],
+                "emission": [1.0, 1.0, 1.0],
+                "material": "diffuse",
+            }
+        )
+    try:
+        ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+        ctx.bind_scene(scene)
+        assert ctx.bvh_node_count > 1
+        ctx.render(1)
+        assert np.abs(ctx.get_buffer().astype(np.int16) - buffer).max() <= 1
+    finally:
+        ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+
+
+def test_build_env_map_cdf():
+    env_map = np.full((8, 16, 4), 0.5, dtype="f4")
+    env_map[2, 5] = 100
+    conditional, marginal = build_env_map_cdf(env_map)
+
+    assert conditional.shape == (8, 16, 2)
+    assert marginal.shape == (8,)
+    assert (np.diff(conditional[:, :, 0], axis=1) >= 0).all()
+    assert np.allclose(conditional[:, -1, 0], 1)
+    assert (np.diff(marginal) >= 0).all()
+    assert np.isclose(marginal[-1], 1)
+    # (u, v) 平面での確率密度の平均は 1 となる
+    assert np.isclose(conditional[:, :, 1].mean(), 1)
+
+    # 明るい画素の行と列が選ばれやすい
+    assert np.argmax(np.diff(marginal, prepend=0)) == 2
+    assert np.argmax(np.diff(conditional[2, :, 0], prepend=0)) == 5
+
+
+def read_moment(ctx):
+    buffer = np.frombuffer(
+        ctx.input_image_list[~ctx.switch & 1].read(), dtype="f4"
+    ).reshape(ctx.height, ctx.width, 4)
+    moment = np.frombuffer(
+        ctx.moment_image_list[~ctx.switch & 1].read(), dtype="f4"
+    ).reshape(ctx.height, ctx.width, 4)
+    luminance = 0.27 * buffer[:, :, 0] + 0.67 * buffer[:, :, 1] + 0.06 * buffer[:, :, 2]
+    variance = np.maximum(moment[:, :, 0] - luminance**2, 0)
+    return luminance, variance / moment[:, :, 1]
+
+
+def test_light_sampling(ctx, sun_env_map_path):
+    # 余弦に比例するサンプリングのみの場合と同じ時間だけ，光源のサンプリングを行う
+    luminance_list = []
+    noise_list = []
+    time_limit = None
+    try:
+        for light_sampling in [False, True]:
+            ctx.light_sampling = light_sampling
+            ctx.bind_data(env_map_path=sun_env_map_path)
+            sample = 0
+            start = time.perf_counter()
+            while (
+                sample < 16
+                if time_limit is None
+                else time.perf_counter() - start < time_limit
+            ):
+                ctx.current_sample = sample + 1
+                ctx.render(4)
+                sample += 4
+            if time_limit is None:
+                time_limit = time.perf_counter() - start
+            luminance, noise = read_moment(ctx)
+            luminance_list.append(luminance.mean())
+            noise_list.append(noise.mean())
+    finally:
+        ctx.light_sampling = True
+        ctx.current_sample = 1
+        ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+
+    # 同じ時間あたりの平均値の分散（ノイズ）が小さく，平均値は変わらない
+    assert noise_list[1] < noise_list[0] / 2
+    assert np.isclose(luminance_list[0], luminance_list[1], rtol=0.05)
+
+
+def test_env_map_store(ctx, sun_env_map_path, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "cache")
+    store = EnvMapStore(ctx.context, cache_dir, vram_budget=256 * 1024**2)
+    store.get("tests/data/test_env_map.hdr")
+    env_map, conditional, marginal = store.load("tests/data/test_env_map.hdr")
+    assert len(os.listdir(cache_dir)) == 3
+    assert isinstance(env_map, np.memmap)
+    assert env_map.shape == (540, 960, 4)
+
+    # 予算を超えると，使われていない期間が最も長いテクスチャから解放される
+    store.vram_budget = store.size()
+    store.get(sun_env_map_path)
+    assert list(store.texture_dict) == [sun_env_map_path]
+    store.release()
+
+    # 2回目以降はディスクのキャッシュから読み込み，HDR を復号しない
+    def imread(*args):
+        raise AssertionError("environment map was decoded again")
+
+    monkeypatch.setattr(cv2, "imread", imread)
+    store = EnvMapStore(ctx.context, cache_dir, vram_budget=256 * 1024**2)
+    store.get("tests/data/test_env_map.hdr")
+    store.release()
+
+
+def test_env_map_store_in_memory(ctx, tmp_path, monkeypatch):
+    # cache_dir が None の場合はメモリ上で復号し，何も書き出さない
+    monkeypatch.setenv("HOME", str(tmp_path))
+    store = EnvMapStore(ctx.context, None, vram_budget=256 * 1024**2)
+    env_map, conditional, marginal = store.load("tests/data/test_env_map.hdr")
+    assert not isinstance(env_map, np.memmap)
+    assert env_map.shape == (540, 960, 4)
+    store.get("tests/data/test_env_map.hdr")
+    store.release()
+    assert os.listdir(tmp_path) == []
+
+
+def test_switch_env_map(ctx, sun_env_map_path):
+    ctx.current_sample = 1
+    ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+    ctx.render(1)
+    binary = ctx.get_binary()
+
+    # コンテキストを作り直さずに，セッションごとに環境マップを切り替えられる
+    ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+    ctx.env_map = sun_env_map_path
+    try:
+        ctx.render(1)
+        assert ctx.get_binary() != binary
+    finally:
+        ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+        ctx.env_map = None
+    ctx.render(1)
+    assert ctx.get_binary() == binary
+
+
+def test_resize(ctx):
+    ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+    ctx.current_sample = 1
+    ctx.render(1)
+    binary = ctx.get_binary()
+    program_count = len(ctx.program_dict)
+
+    # 画像のみを作り直し，プログラムはコンパイルし直さない
+    ctx.resize(320, 180)
+    try:
+        ctx.render(1)
+        assert ctx.get_buffer().shape == (180, 320, 3)
+        assert len(ctx.program_dict) == program_count
+    finally:
+        ctx.resolution = (960, 540)
+
+    # シード画像の種は変わらないため，元の解像度に戻すと同じ画像になる
+    ctx.render(1)
+    assert ctx.get_binary() == binary
+
+
+def test_render_preview(ctx):
+    ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+    ctx.preview_scale = 0.25
+
+    try:
+        # 送信用画像は元の解像度で，プレビューの累積画像は縦横 1/4
+        ctx.render_preview(1)
+        assert ctx.get_buffer().shape == (540, 960, 3)
+        assert (ctx.preview_session.width, ctx.preview_session.height) == (240, 135)
+        ctx.render_preview(1)
+        assert ctx.preview_session.current_sample == 3
+
+        # カメラが変わるとプレビューもやり直す
+        ctx.theta = 0.5
+        ctx.render_preview(1)
+        assert ctx.preview_session.current_sample == 2
+
+        # 表示のみの変更はプレビューを拡大し直す
+        buffer = ctx.get_buffer()
+        ctx.gamma = 1.0
+        ctx.redisplay()
+        assert ctx.get_buffer().mean() < buffer.mean()
+    finally:
+        ctx.gamma = 2.2
+        ctx.theta = 0
+
+    # 元の解像度でレンダリングするとプレビューは使われなくなる
+    ctx.current_sample = 1
+    ctx.render(1)
+    assert ctx.preview_image is None
+
+
+def test_accumulation_cache(tmp_path):
+    array_list = [np.full((4, 4), i, dtype="f4") for i in range(2)]
+    cache = AccumulationCache(
+        sum(array.nbytes for array in array_list), spill_dir=str(tmp_path)
+    )
+    cache.put("a", 8, array_list)
+    assert cache.get("b") is None
+
+    # メモリの予算を超えると，古いものからディスクに書き出される
+    cache.put("b", 16, [array + 1 for array in array_list])
+    assert list(cache.memory_dict) == ["b"]
+    assert list(cache.disk_dict) == ["a"]
+    assert len(os.listdir(tmp_path)) == 2
+
+    # ディスクにあるものはメモリに読み戻され，代わりに "b" が書き出される
+    sample_count, restored_list = cache.get("a")
+    assert sample_count == 8
+    assert all(np.array_equal(x, y) for x, y in zip(restored_list, array_list))
+    assert list(cache.disk_dict) == ["b"]
+
+    statistics = cache.statistics()
+    assert statistics["memory_hits"] == 0
+    assert statistics["disk_hits"] == 1
+    assert statistics["misses"] == 1
+
+    cache.clear()
+    assert os.listdir(tmp_path) == []
+
+
+def test_restore_accumulation(ctx):
+    ctx.accumulation_cache = AccumulationCache(256 * 1024**2)
+    try:
+        ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+        ctx.theta = 0
+        for sample in [1, 2]:
+            ctx.current_sample = sample
+            ctx.render(1)
+        binary = ctx.get_binary()
+        ctx.save_accumulation(2)
+
+        # 初めてのカメラではキャッシュにヒットしない
+        ctx.theta = 0.5
+        assert ctx.restore_accumulation() == 0
+        ctx.current_sample = 1
+        ctx.render(1)
+
+        # 元のカメラに戻ると，累積画像とサンプル数が復元され，そのまま表示できる
+        ctx.theta = 0
+        assert ctx.restore_accumulation() == 2
+        assert ctx.current_sample == 3
+        ctx.redisplay()
+        assert ctx.get_binary() == binary
+        assert ctx.accumulation_cache.statistics()["memory_hits"] == 1
+    finally:
+        ctx.accumulation_cache = AccumulationCache(0)
+
+
+def test_profile(ctx):
+    ctx.profile = True
+    try:
+        ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+        ctx.collect_timings()
+        for sample in [1, 2]:
+            ctx.current_sample = sample
+            ctx.render(1)
+            ctx.get_buffer()
+            timing_dict = ctx.collect_timings()
+            # GPU の段階は，タイマークエリの結果が得られなかった場合（llvmpipe）に欠ける
+            assert "readback" in timing_dict
+            assert set(timing_dict) <= {
+                "path_trace",
+                "reduce_luminance",
+                "post_process",
+                "readback",
+            }
+            assert all(value >= 0 for value in timing_dict.values())
+
+        # 回収した計測結果は消える
+        assert ctx.collect_timings() == {}
+    finally:
+        ctx.profile = False
+
+    ctx.render(1)
+    assert ctx.collect_timings() == {}
+
+
+def test_codec(ctx):
+    ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+    ctx.current_sample = 1
+    ctx.render(1)
+    try:
+        ctx.codec = "png"
+        ctx.redisplay()
+        png = cv2.imdecode(np.frombuffer(ctx.get_binary(), dtype=np.uint8), -1)
+        assert png.shape == (540, 960, 3)
+
+        # raw は上下反転済みの RGBA をそのまま送る（png を復号した BGR と一致する）
+        ctx.codec = "raw"
+        ctx.redisplay()
+        raw = np.frombuffer(ctx.get_binary(), dtype=np.uint8).reshape(540, 960, 4)
+        assert np.array_equal(raw[:, :, 2::-1], png)
+        assert np.all(raw[:, :, 3] == 255)
+
+        for codec in ["jpeg", "webp"]:
+            ctx.codec = codec
+            ctx.redisplay()
+            size_list = []
+            for quality in [10, 90]:
+                ctx.quality = quality
+                image = cv2.imdecode(
+                    np.frombuffer(ctx.get_binary(), dtype=np.uint8), cv2.IMREAD_COLOR
+                )
+                assert np.abs(image.astype(np.int16) - png).mean() < 16
+                size_list.append(len(ctx.get_binary()))
+            # 品質を下げるほど小さくなる
+            assert size_list[0] < size_list[1]
+    finally:
+        ctx.codec = "jpeg"
+        ctx.quality = None
+        ctx.redisplay()
+
+
+def test_russian_roulette(ctx):
+    ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+    ctx.resize(240, 135)
+    try:
+        with pytest.raises(ValueError):
+            ctx.use_preset("unknown")
+        ctx.use_preset("final")
+        assert (ctx.depth_max, ctx.roulette_depth) == (32, 8)
+
+        # 生き残った経路を生存確率で割るため，最初の反射から打ち切っても期待値は変わらない
+        mean_list = []
+        for roulette_depth in [16, 1]:
+            ctx.depth_max = 16
+            ctx.roulette_depth = roulette_depth
+            for sample in range(0, 64, 16):
+                ctx.current_sample = sample + 1
+                ctx.render(16)
+            mean_list.append(ctx.read_accumulation()[0][:, :, :3].mean())
+        assert mean_list[1] == pytest.approx(mean_list[0], rel=0.02)
+    finally:
+        ctx.use_preset("balanced")
+        ctx.resolution = (960, 540)
+
+
+def test_denoise(ctx):
+    ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+    ctx.resize(240, 135)
+    try:
+        ctx.denoise_sample_max = 0
+        for sample in range(0, 256, 16):
+            ctx.current_sample = sample + 1
+            ctx.render(16)
+        reference = ctx.get_buffer().copy()
+
+        # 参照画像（256 spp）との SSIM をサンプル数ごとに比べる
+        raw_list, denoised_list = [], []
+        for spp in [1, 4, 16, 64]:
+            ctx.denoise_sample_max = 64
+            ctx.current_sample = 1
+            ctx.render(spp)
+            denoised = ctx.get_buffer().copy()
+            ctx.denoise_sample_max = 0
+            ctx.redisplay()
+            raw = ctx.get_buffer().copy()
+            raw_list.append(get_mssim(reference, raw))
+            denoised_list.append(get_mssim(reference, denoised))
+
+        # デノイズすると少ないサンプル数でも参照画像に近づき，
+        # 1 spp でもデノイズしない 16 spp より近い
+        for raw, denoised in zip(raw_list[:3], denoised_list[:3]):
+            assert denoised > raw
+        assert denoised_list[0] > raw_list[2]
+        assert denoised_list[0] > 0.85
+        # denoise_sample_max に達した画素は元の画像のまま
+        assert denoised_list[3] == raw_list[3]
+
+        # 累積画像を読み込んだ場合も，アルベドと法線を書き出し直してからデノイズする
+        ctx.denoise_sample_max = 64
+        ctx.current_sample = 1
+        ctx.render(4)
+        denoised = ctx.get_buffer().copy()
+        array_list = ctx.read_accumulation()
+        ctx.albedo_image.write(np.zeros((135, 240, 4), dtype="f2"))
+        ctx.normal_image.write(np.zeros((135, 240, 4), dtype="f2"))
+        ctx.load_accumulation(4, array_list)
+        ctx.redisplay()
+        assert np.array_equal(ctx.get_buffer(), denoised)
+
+        # このフレームで denoise_sample_max に達した場合はデノイズしない
+        # （呼び出し側が current_sample を進める前の redisplay も同じ）
+        ctx.current_sample = 1
+        ctx.render(64)
+        assert ctx.denoised_image is None
+        ctx.redisplay()
+        assert ctx.denoised_image is None
+    finally:
+        ctx.denoise_sample_max = 0
+        ctx.resolution = (960, 540)
+
+
+def test_tile_scheduler():
+    with pytest.raises(ValueError):
+        TileScheduler(0.01, order="unknown")
+    scheduler = TileScheduler(0.01, tile_size=64)
+    # 計測するまでは1サンプルずつ
+    assert scheduler.plan(16) == (64, 1)
+
+    # 1サンプルで予算を超える場合はタイルを小さくし，余裕がある場合はサンプル数を増やす
+    scheduler.update(64 * 64, 1, 0.08)
+    assert scheduler.plan(16) == (16, 2)
+    scheduler.cost = 1e-8
+    assert scheduler.plan(16) == (64, 16)
+    assert scheduler.plan(8) == (64, 8)
+
+    # 画像全体を覆い，中央のタイルから描画する
+    tile_list = scheduler.tiles(200, 100, 64)
+    assert sum(width * height for _, _, width, height in tile_list) == 200 * 100
+    assert tile_list[0] == (64, 0, 64, 64)
+    assert tile_list[-1] == (192, 64, 8, 36)
+
+    # 相対誤差の大きいタイルから描画する
+    scheduler = TileScheduler(0.01, tile_size=64, order="noise")
+    error = np.zeros((100, 200), dtype="f4")
+    error[:64, :64] = 1.0
+    error[64:, 192:] = 0.5
+    tile_list = scheduler.tiles(200, 100, 64, error)
+    assert tile_list[:3] == [(0, 0, 64, 64), (192, 64, 8, 36), (64, 0, 64, 64)]
+
+
+def test_tiled_dispatch(ctx):
+    ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+    ctx.resize(240, 135)
+    session = ctx.session
+    try:
+        accumulation_list = []
+        for tile_scheduler in [None, TileScheduler(0.005, tile_size=64)]:
+            ctx.tile_scheduler = tile_scheduler
+            ctx.create_session(seed=1)
+            ctx.resize(240, 135)
+            ctx.current_sample = 1
+            assert ctx.render(8) == 8
+            ctx.current_sample = 9
+            assert ctx.render(8) == 8
+            accumulation_list.append(ctx.read_accumulation())
+            ctx.release_session(ctx.session)
+            ctx.use_session(session)
+
+        # 乱数の状態と逐次平均は描画をまたいで引き継がれるため，1回で描画した場合と一致する
+        for array, tiled in zip(*accumulation_list):
+            assert np.array_equal(array, tiled)
+        assert ctx.tile_scheduler.cost > 0
+
+        # 中断すると残りのスライスを打ち切り，描画済みのタイルの画素のみサンプル数が増える
+        ctx.tile_scheduler = None
+        ctx.current_sample = 1
+        ctx.render(16)
+        # 1スライスは 64 x 64 のタイルに2サンプルずつ
+        ctx.tile_scheduler = TileScheduler(0.01, tile_size=64)
+        ctx.tile_scheduler.cost = 0.01 / (2.5 * 64 * 64)
+        call_count = 0
+
+        def interrupt():
+            nonlocal call_count
+            call_count += 1
+            return call_count > 1
+
+        ctx.current_sample = 17
+        assert ctx.render(8, interrupt=interrupt) == 0
+        assert ctx.accumulated_sample_count == 16
+        sample_count = ctx.read_accumulation()[2][:, :, 1]
+        assert sample_count[:128, 64:128].min() == 18
+        assert sample_count[:, 128:].max() == 16
+        assert np.count_nonzero(sample_count == 18) == 2 * 64 * 64
+    finally:
+        if ctx.session is not session:
+            ctx.release_session(ctx.session)
+            ctx.use_session(session)
+        ctx.tile_scheduler = None
+        ctx.resolution = (960, 540)
+
+
+def test_nominal_sample_count(ctx):
+    # render が返すサンプル数（名目のサンプル数）は，収束していない画素のモーメント画像のサンプル数と一致する
+    # 収束済みの画素はそれより少なく，適応サンプリングではその分だけ名目のサンプル数が増える
+    ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+    ctx.resize(240, 135)
+    try:
+        ctx.convergence_sample_min = 4
+        for convergence_threshold, tile_scheduler in [
+            (0.0, None),
+            (0.05, None),
+            (0.0, TileScheduler(0.005, tile_size=64)),
+            (0.05, TileScheduler(0.005, tile_size=64)),
+        ]:
+            ctx.convergence_threshold = convergence_threshold
+            ctx.tile_scheduler = tile_scheduler
+            spp = 0
+            for _ in range(4):
+                ctx.current_sample = spp + 1
+                spp += ctx.render(4)
+                assert ctx.accumulated_sample_count == spp
+                moment = ctx.read_accumulation()[2]
+                converged = moment[:, :, 2] > 0.5
+                assert moment[:, :, 1].max() == spp
+                assert (moment[:, :, 1][~converged] == spp).all()
+            if convergence_threshold > 0:
+                assert converged.any()
+                assert spp > 16
+            else:
+                assert spp == 16
+
+        # max_spp を指定した場合，適応サンプリングでもそれを超えて割り当てない
+        ctx.max_spp = str(spp + 4)
+        ctx.current_sample = spp + 1
+        assert ctx.render(4) == 4
+        assert ctx.read_accumulation()[2][:, :, 1].max() == spp + 4
+    finally:
+        ctx.convergence_threshold = 0.0
+        ctx.convergence_sample_min = 16
+        ctx.tile_scheduler = None
+        ctx.max_spp = 0
+        ctx.resolution = (960, 540)
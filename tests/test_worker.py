@@ -0,0 +1,375 @@
+import functools
+import queue
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from app.farm import RenderFarm
+from app.render import Context
+from app.worker import RenderWorker, Scheduler, downsample, psnr
+
+
+def create_context(**kwargs):
+    # RenderWorker には functools.partial で Context の引数を渡す（spawn でも pickle できる）
+    kwargs = {"width": 96, "height": 54, "sample_per_frame": 2, **kwargs}
+    ctx = Context(**kwargs)
+    ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+    ctx.create_program()
+    return ctx
+
+
+def test_render_worker():
+    worker = RenderWorker(create_context)
+    worker.start()
+    try:
+        worker.submit("key", 1, {"theta": 0.5, "max_spp": "5"})
+
+        frames = [worker.receive(timeout=60) for _ in range(3)]
+        assert [key for key, _ in frames] == ["key"] * 3
+        assert [frame["generation"] for _, frame in frames] == [1] * 3
+        assert [frame["spp"] for _, frame in frames] == [2, 4, 5]
+        assert [frame["frame_id"] for _, frame in frames] == [1, 2, 3]
+
+        _, frame = frames[-1]
+        image = cv2.imdecode(
+            np.frombuffer(frame["payload"], dtype=np.uint8), cv2.IMREAD_COLOR
+        )
+        assert image.shape == (54, 96, 3)
+    finally:
+        worker.stop()
+
+
+def test_render_worker_sessions():
+    worker = RenderWorker(create_context)
+    worker.start()
+    try:
+        worker.open("a")
+        worker.open("b", priority=3)
+        worker.submit("a", 1, {"max_spp": "8"})
+        worker.submit("b", 1, {"theta": 1.0, "max_spp": "24"})
+
+        frames = [worker.receive(timeout=60) for _ in range(16)]
+        next_frame_dict = {"a": [], "b": []}
+        for key, frame in frames:
+            next_frame_dict[key].append(frame["spp"])
+        assert next_frame_dict == {"a": [2, 4, 6, 8], "b": list(range(2, 25, 2))}
+
+        # 優先度の高いセッションほど多くのフレームが先に届く
+        assert [key for key, _ in frames[:8]].count("b") == 6
+
+        worker.close("a")
+        worker.close("b")
+    finally:
+        worker.stop()
+
+
+def test_render_worker_coalesce():
+    worker = RenderWorker(create_context)
+    worker.start()
+    try:
+        # 連続した更新は次のフレームの区切りでまとめて反映され，最新の世代のみがレンダリングされる
+        for generation in range(1, 11):
+            worker.submit(
+                "key", generation, {"theta": generation * 0.1, "max_spp": "4"}
+            )
+
+        frames = [worker.receive(timeout=60) for _ in range(2)]
+        assert [frame["generation"] for _, frame in frames] == [10, 10]
+        assert [frame["spp"] for _, frame in frames] == [2, 4]
+    finally:
+        worker.stop()
+
+
+def test_scheduler():
+    scheduler = Scheduler()
+    scheduler.add("a")
+    scheduler.add("b", priority=2)
+    assert scheduler.select() is None
+
+    scheduler.wake("a")
+    scheduler.wake("b")
+    order = []
+    for _ in range(6):
+        key = scheduler.select()
+        scheduler.charge(key, 1)
+        order.append(key)
+    assert order.count("b") == 4
+
+    # 休止していたセッションは，再開時に他のセッションの仮想時間に揃えられる
+    scheduler.sleep("a")
+    for _ in range(10):
+        scheduler.charge(scheduler.select(), 1)
+    scheduler.wake("a")
+    assert scheduler.pass_dict["a"] == scheduler.virtual_time
+
+
+def test_render_worker_display_parameters():
+    worker = RenderWorker(create_context)
+    worker.start()
+    try:
+        worker.submit("key", 1, {"max_spp": "4"})
+        frames = [worker.receive(timeout=60) for _ in range(2)]
+        assert [frame["spp"] for _, frame in frames] == [2, 4]
+
+        # 表示のみのパラメータを変えても，サンプリングはやり直されない
+        worker.submit("key", 2, {"key_value": 0.5})
+        _, frame = worker.receive(timeout=60)
+        assert frame["generation"] == 2
+        assert frame["spp"] == 4
+
+        # コーデックを変えた場合も累積画像はそのままに送り直される
+        worker.submit("key", 2, {"codec": "raw"})
+        _, frame = worker.receive(timeout=60)
+        assert frame["codec"] == "raw"
+        assert frame["spp"] == 4
+        assert len(frame["payload"]) == 54 * 96 * 4
+
+        worker.submit("key", 3, {"max_spp": "6"})
+        _, frame = worker.receive(timeout=60)
+        assert frame["spp"] == 6
+
+        # カメラが変わった場合は，始めからやり直す
+        worker.submit("key", 4, {"theta": 1.0})
+        _, frame = worker.receive(timeout=60)
+        assert frame["generation"] == 4
+        assert frame["spp"] == 2
+    finally:
+        worker.stop()
+
+
+def test_render_worker_convergence():
+    worker = RenderWorker(
+        functools.partial(
+            create_context, convergence_threshold=1.0, convergence_sample_min=2
+        )
+    )
+    worker.start()
+    try:
+        # 最大サンプル数を指定しなくても，全画素が収束した時点でサンプリングを止める
+        worker.submit("key", 1, {"theta": 0.5})
+        for _ in range(30):
+            _, frame = worker.receive(timeout=60)
+            if frame["converged"] == 1:
+                break
+        assert frame["converged"] == 1
+        assert (frame["map_width"], frame["map_height"]) == (12, 7)
+        assert frame["convergence_map"] == bytes([255] * 12 * 7)
+
+        with pytest.raises(queue.Empty):
+            worker.receive(timeout=1)
+    finally:
+        worker.stop()
+
+
+def test_render_worker_env_map(sun_env_map_path):
+    worker = RenderWorker(create_context)
+    worker.start()
+    try:
+        worker.submit("key", 1, {"max_spp": "4"})
+        frames = [worker.receive(timeout=60) for _ in range(2)]
+        assert [frame["spp"] for _, frame in frames] == [2, 4]
+
+        # 環境マップを切り替えると，始めからやり直す
+        worker.submit("key", 2, {"env_map": sun_env_map_path})
+        _, frame = worker.receive(timeout=60)
+        assert frame["generation"] == 2
+        assert frame["spp"] == 2
+    finally:
+        worker.stop()
+
+
+def test_render_worker_resolution():
+    worker = RenderWorker(create_context)
+    worker.start()
+    try:
+        worker.submit("key", 1, {"max_spp": "4"})
+        frames = [worker.receive(timeout=60) for _ in range(2)]
+        assert [frame["spp"] for _, frame in frames] == [2, 4]
+
+        # 解像度を変えると，その解像度で始めからやり直す
+        worker.submit("key", 2, {"resolution": (48, 27)})
+        _, frame = worker.receive(timeout=60)
+        assert frame["generation"] == 2
+        assert frame["spp"] == 2
+        assert (frame["width"], frame["height"]) == (48, 27)
+        image = cv2.imdecode(
+            np.frombuffer(frame["payload"], dtype=np.uint8), cv2.IMREAD_COLOR
+        )
+        assert image.shape == (27, 48, 3)
+    finally:
+        worker.stop()
+
+
+def test_render_worker_preview():
+    worker = RenderWorker(functools.partial(create_context, preview_delay=0.2))
+    worker.start()
+    try:
+        # カメラが動いた直後は，拡大したプレビューを送る（累積のサンプル数は 0 のまま）
+        worker.submit("key", 1, {"theta": 0.5, "max_spp": "4"})
+        _, frame = worker.receive(timeout=60)
+        assert frame["spp"] == 0
+        assert (frame["width"], frame["height"]) == (96, 54)
+
+        # カメラが止まってしばらくすると，元の解像度でサンプリングする
+        while frame["spp"] == 0:
+            _, frame = worker.receive(timeout=60)
+        assert frame["spp"] == 2
+        _, frame = worker.receive(timeout=60)
+        assert frame["spp"] == 4
+    finally:
+        worker.stop()
+
+
+def test_render_worker_accumulation_cache():
+    worker = RenderWorker(
+        functools.partial(create_context, accumulation_cache_budget=2**24)
+    )
+    worker.start()
+    try:
+        worker.submit("key", 1, {"theta": 0, "max_spp": "4"})
+        frames = [worker.receive(timeout=60) for _ in range(2)]
+        assert [frame["spp"] for _, frame in frames] == [2, 4]
+
+        worker.submit("key", 2, {"theta": 0.5})
+        frames = [worker.receive(timeout=60) for _ in range(2)]
+        assert [frame["spp"] for _, frame in frames] == [2, 4]
+
+        # 以前のカメラに戻ると，サンプリングをやり直さずにすぐ表示する
+        worker.submit("key", 3, {"theta": 0})
+        _, frame = worker.receive(timeout=60)
+        assert frame["generation"] == 3
+        assert frame["spp"] == 4
+        with pytest.raises(queue.Empty):
+            worker.receive(timeout=1)
+    finally:
+        worker.stop()
+
+
+def test_render_worker_farm():
+    farm = RenderFarm(create_context, 2)
+    farm.start()
+    worker = RenderWorker(create_context, farm)
+    worker.start()
+    try:
+        worker.submit("key", 1, {"theta": 0.5, "max_spp": "5"})
+        frames = [worker.receive(timeout=60) for _ in range(3)]
+        assert [frame["spp"] for _, frame in frames] == [2, 4, 5]
+
+        _, frame = frames[-1]
+        image = cv2.imdecode(
+            np.frombuffer(frame["payload"], dtype=np.uint8), cv2.IMREAD_COLOR
+        )
+        assert image.shape == (54, 96, 3)
+        worker.close("key")
+    finally:
+        worker.stop()
+        farm.stop()
+
+
+def test_render_worker_profile():
+    worker = RenderWorker(functools.partial(create_context, profile=True))
+    worker.start()
+    try:
+        worker.submit("key", 1, {"max_spp": "4"})
+
+        # フレームごとに段階ごとの時間が付く
+        for _ in range(2):
+            _, frame = worker.receive(timeout=60)
+            assert {
+                "reduce_luminance",
+                "post_process",
+                "readback",
+                "encode",
+                "render",
+            } <= set(frame["timings"])
+            assert frame["timings"]["render"] == frame["render_time"]
+    finally:
+        worker.stop()
+
+
+def test_psnr():
+    image = np.random.default_rng(0).integers(0, 256, (54, 96, 3), dtype=np.uint8)
+    assert downsample(image).shape == (6, 12, 3)
+    assert psnr(image, image) == float("inf")
+    noisy = np.clip(image.astype(np.int16) + 1, 0, 255).astype(np.uint8)
+    assert psnr(image, noisy) > 48
+    assert psnr(image, 255 - image) < 10
+
+
+def test_render_worker_frame_skip():
+    worker = RenderWorker(
+        functools.partial(create_context, frame_skip_psnr=1, keyframe_interval=60)
+    )
+    worker.start()
+    try:
+        # 世代が変わった後の最初のフレームと最後のフレームのみが送られる
+        worker.submit("key", 1, {"max_spp": "8"})
+        frames = [worker.receive(timeout=60) for _ in range(2)]
+        assert [frame["spp"] for _, frame in frames] == [2, 8]
+        assert [frame["frame_id"] for _, frame in frames] == [1, 2]
+        with pytest.raises(queue.Empty):
+            worker.receive(timeout=1)
+
+        # 表示のみのパラメータを変えた場合は送り直される
+        worker.submit("key", 2, {"key_value": 0.5})
+        _, frame = worker.receive(timeout=60)
+        assert frame["generation"] == 2
+        assert frame["spp"] == 8
+    finally:
+        worker.stop()
+
+
+def test_render_worker_tiled():
+    worker = RenderWorker(
+        functools.partial(
+            create_context,
+            sample_per_frame=16,
+            dispatch_time_budget=0.002,
+            tile_size=32,
+        )
+    )
+    worker.start()
+    try:
+        worker.submit("key", 1, {"max_spp": "32"})
+        frames = [worker.receive(timeout=60) for _ in range(2)]
+        assert [frame["spp"] for _, frame in frames] == [16, 32]
+    finally:
+        worker.stop()
+
+
+def test_render_worker_tiled_interrupt():
+    # 1フレームで 2^20 サンプル（GPU でも数秒以上）を，短いスライスに分けて描画する
+    # 打ち切られなければ，次の世代のフレームは receive の timeout までに届かない
+    worker = RenderWorker(
+        functools.partial(
+            create_context,
+            sample_per_frame=2**20,
+            dispatch_time_budget=0.002,
+            tile_size=32,
+        )
+    )
+    worker.start()
+    try:
+        worker.submit("key", 1, {"max_spp": "1"})
+        _, frame = worker.receive(timeout=60)
+        assert (frame["generation"], frame["spp"]) == (1, 1)
+
+        # サンプリングの途中で届いた更新は，残りのスライスを打ち切って反映される
+        worker.submit("key", 2, {"max_spp": ""})
+        time.sleep(0.5)
+        worker.submit("key", 3, {"theta": 0.5, "max_spp": "1"})
+        frames = [worker.receive(timeout=60)]
+        while frames[-1][1]["generation"] != 3:
+            frames.append(worker.receive(timeout=60))
+
+        # 打ち切られた世代は 1フレーム分を描き終えたフレームとしては届かず，新しい世代が届く
+        assert all(
+            frame["spp"] < 1 + 2**20 for _, frame in frames if frame["generation"] == 2
+        )
+        assert frames[-1][1]["spp"] == 1
+        with pytest.raises(queue.Empty):
+            worker.receive(timeout=1)
+    finally:
+        worker.stop(timeout=60)
@@ -2,8 +2,20 @@ import cv2
 
 from app.render import Context
 
+# tests/test_render.py の get_reference_mssim と同じ条件で，参照画像を書き出す
+# reference.jpg は従来の設定（光源サンプリングとロシアンルーレット無し）の描画結果
 ctx = Context()
-ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
 ctx.create_program()
-ctx.render(1)
-cv2.imwrite("tests/data/reference.jpg", ctx.get_buffer())
+for path, light_sampling, preset in [
+    ("tests/data/reference.jpg", False, None),
+    ("tests/data/reference_light_sampling.jpg", True, None),
+    ("tests/data/reference_default.jpg", True, "balanced"),
+]:
+    ctx.light_sampling = light_sampling
+    if preset is None:
+        ctx.roulette_depth = ctx.depth_max
+    else:
+        ctx.use_preset(preset)
+    ctx.bind_data(env_map_path="tests/data/test_env_map.hdr")
+    ctx.render(1)
+    cv2.imwrite(path, ctx.get_buffer())